@@ -0,0 +1,47 @@
+import struct
+from typing import Optional, Sequence, Tuple
+
+# capnp caps the segment count of a message, anything larger is a corrupted frame header
+MAX_SEGMENTS = 512
+
+
+def segment_table(dat: bytes, pos: int = 0) -> Optional[Tuple[int, Sequence[int]]]:
+  """Header size in bytes and segment sizes in words of the serialized message at pos, None if dat ends before the table does"""
+  # stream framing: (segment count - 1), segment sizes in words, padded to a word boundary
+  if len(dat) - pos < 4:
+    return None
+  num_segments = struct.unpack_from("<I", dat, pos)[0] + 1
+  if num_segments > MAX_SEGMENTS:
+    raise ValueError(f"invalid segment count {num_segments} in message frame header")
+  header_size = (4 * (num_segments + 1) + 7) & ~7
+  if len(dat) - pos < header_size:
+    return None
+  return header_size, struct.unpack_from(f"<{num_segments}I", dat, pos + 4)
+
+
+def root_data_section(dat: bytes) -> Optional[Tuple[int, int]]:
+  """Byte offset and size in words of the root struct's data section, None if the message layout doesn't allow reading it in place"""
+  try:
+    table = segment_table(dat)
+  except ValueError:
+    return None
+  if table is None:
+    return None
+  segment_start, segment_sizes = table
+  segment_end = min(segment_start + 8 * segment_sizes[0], len(dat))
+
+  # the root struct pointer is the first word of the first segment
+  if segment_start + 8 > segment_end:
+    return None
+  pointer = struct.unpack_from("<Q", dat, segment_start)[0]
+  data_words = (pointer >> 32) & 0xFFFF
+  if pointer & 3 != 0 or data_words == 0:
+    # far pointer, or an empty data section
+    return None
+  offset = (pointer & 0xFFFFFFFF) >> 2
+  if offset & (1 << 29):
+    offset -= 1 << 30
+  pos = segment_start + 8 * (1 + offset)
+  if pos < segment_start or pos + 8 * data_words > segment_end:
+    return None
+  return pos, data_words
@@ -7,16 +7,29 @@ import msgq
 
 import os
 import capnp
+import struct
 import time
 
-from typing import Optional, List, Union, Dict
+from collections.abc import Iterator, MutableMapping
+from dataclasses import dataclass
+from typing import Callable, Optional, List, Tuple, Union, Dict
 
 from cereal import log
+from cereal.framing import root_data_section
 from cereal.services import SERVICE_LIST
+from cereal.messaging.metrics import get_metrics
 from openpilot.common.util import MovingAverage
 
 NO_TRAVERSAL_LIMIT = 2**64-1
 
+# field offsets in the data section of Event, used to read the header of a serialized message without decoding it.
+# bool fields are stored XORed with their default
+_VALID_SLOT = log.Event.schema.fields['valid'].proto.slot
+VALID_BIT = _VALID_SLOT.offset
+VALID_DEFAULT = _VALID_SLOT.defaultValue.bool
+WHICH_BYTE = 2 * log.Event.schema.node.struct.discriminantOffset
+UNION_FIELDS = {log.Event.schema.fields[f].proto.discriminantValue: f for f in log.Event.schema.union_fields}
+
 
 def reset_context():
   msgq.context = Context()
@@ -27,6 +40,25 @@ def log_from_bytes(dat: bytes, struct: capnp.lib.capnp._StructModule = log.Event
     return msg
 
 
+def event_header(dat: bytes) -> Optional[Tuple[str, int, bool]]:
+  """Union field, logMonoTime and valid of a serialized Event without decoding it, None if the message layout doesn't allow it"""
+  section = root_data_section(dat)
+  if section is None:
+    return None
+  # logMonoTime is the first word of the data section
+  pos, data_words = section
+
+  # fields past the end of the data section were added after the message was written and have their default value
+  which = struct.unpack_from("<H", dat, pos + WHICH_BYTE)[0] if WHICH_BYTE + 2 <= 8 * data_words else 0
+  if which not in UNION_FIELDS:
+    return None
+  log_mono_time = struct.unpack_from("<Q", dat, pos)[0]
+  valid = VALID_DEFAULT
+  if VALID_BIT < 64 * data_words:
+    valid ^= bool(dat[pos + VALID_BIT // 8] & (1 << (VALID_BIT % 8)))
+  return UNION_FIELDS[which], log_mono_time, valid
+
+
 def new_message(service: Optional[str], size: Optional[int] = None, **kwargs) -> capnp.lib.capnp._DynamicStructBuilder:
   args = {
     'valid': False,
@@ -135,10 +167,64 @@ class FrequencyTracker:
     return self.min_freq <= avg_freq_recent <= self.max_freq
 
 
+@dataclass
+class ServiceTiming:
+  recv_count: int = 0
+  recv_time: float = 0.
+  decode_count: int = 0
+  decode_time: float = 0.
+
+  @property
+  def avg_recv_time(self) -> float:
+    return self.recv_time / self.recv_count if self.recv_count else 0.
+
+  @property
+  def avg_decode_time(self) -> float:
+    return self.decode_time / self.decode_count if self.decode_count else 0.
+
+
+class LazyData(MutableMapping):
+  """Messages by service name. Received buffers are kept as is and only decoded on first access, including through iteration"""
+
+  def __init__(self, decode: Callable[[str, bytes], capnp.lib.capnp._DynamicStructReader]):
+    self.pending: Dict[str, bytes] = {}
+    self._msgs: Dict[str, capnp.lib.capnp._DynamicStructReader] = {}
+    self._decode = decode
+
+  def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
+    if s in self.pending:
+      self._msgs[s] = self._decode(s, self.pending.pop(s))
+    return self._msgs[s]
+
+  def __setitem__(self, s: str, msg: capnp.lib.capnp._DynamicStructReader) -> None:
+    self.pending.pop(s, None)
+    self._msgs[s] = msg
+
+  def __delitem__(self, s: str) -> None:
+    if s not in self:
+      raise KeyError(s)
+    self.pending.pop(s, None)
+    self._msgs.pop(s, None)
+
+  def __contains__(self, s: object) -> bool:
+    return s in self._msgs or s in self.pending
+
+  def __iter__(self) -> Iterator[str]:
+    # a snapshot of the keys, values() and items() decode pending messages while iterating
+    return iter([*self._msgs, *(s for s in self.pending if s not in self._msgs)])
+
+  def __len__(self) -> int:
+    return len(self._msgs) + sum(s not in self._msgs for s in self.pending)
+
+  def copy(self) -> Dict[str, capnp.lib.capnp._DynamicStructReader]:
+    return dict(self)
+
+
 class SubMaster:
   def __init__(self, services: List[str], poll: Optional[str] = None,
                ignore_alive: Optional[List[str]] = None, ignore_avg_freq: Optional[List[str]] = None,
-               ignore_valid: Optional[List[str]] = None, addr: str = "127.0.0.1", frequency: Optional[float] = None):
+               ignore_valid: Optional[List[str]] = None, addr: str = "127.0.0.1", frequency: Optional[float] = None,
+               lazy: bool = False):
     self.frame = -1
     self.services = services
     self.seen = {s: False for s in services}
@@ -146,9 +232,14 @@ class SubMaster:
     self.recv_time = {s: 0. for s in services}
     self.recv_frame = {s: 0 for s in services}
     self.sock = {}
-    self.data = {}
     self.logMonoTime = {s: 0 for s in services}
 
+    # lazy mode keeps the received buffers and decodes a message on its first access, only the header is read on receive
+    self.lazy = lazy
+    self.data: MutableMapping[str, capnp.lib.capnp._DynamicStructReader] = LazyData(self._decode) if lazy else {}
+    self.timing = {s: ServiceTiming() for s in services}
+    self.metrics = get_metrics()
+
     # zero-frequency / on-demand services are always alive and presumed valid; all others must pass checks
     on_demand = {s: SERVICE_LIST[s].frequency <= 1e-5 for s in services}
     self.static_freq_services = set(s for s in services if not on_demand[s])
@@ -189,9 +280,36 @@ class SubMaster:
   def _check_avg_freq(self, s: str) -> bool:
     return SERVICE_LIST[s].frequency > 0.99 and (s not in self.ignore_average_freq) and (s not in self.ignore_alive)
 
+  def _decode(self, s: str, dat: bytes) -> capnp.lib.capnp._DynamicStructReader:
+    t = time.perf_counter()
+    msg = getattr(log_from_bytes(dat), s)
+    timing = self.timing[s]
+    timing.decode_time += time.perf_counter() - t
+    timing.decode_count += 1
+    return msg
+
+  def _poll(self, timeout: int) -> List[SubSocket]:
+    if self.metrics is None:
+      return self.poller.poll(timeout)
+
+    t = time.monotonic()
+    socks = self.poller.poll(timeout)
+    self.metrics.record_poll(time.monotonic() - t)
+    return socks
+
   def update(self, timeout: int = 100) -> None:
+    if self.lazy:
+      # the sockets returned by the poller are new handles, the service is read from the message header instead
+      raw_msgs, recv_times = [], []
+      for sock in self._poll(timeout) + [self.sock[s] for s in self.non_polled_services]:
+        t = time.perf_counter()
+        raw_msgs.append(sock.receive(non_blocking=True))
+        recv_times.append(time.perf_counter() - t)
+      self.update_raw_msgs(time.monotonic(), raw_msgs, recv_times)
+      return
+
     msgs = []
-    for sock in self.poller.poll(timeout):
+    for sock in self._poll(timeout):
       msgs.append(recv_one_or_none(sock))
 
     # non-blocking receive for non-polled sockets
@@ -199,6 +317,16 @@ class SubMaster:
       msgs.append(recv_one_or_none(self.sock[s]))
     self.update_msgs(time.monotonic(), msgs)
 
+  def _record_msg(self, s: str, log_mono_time: int, valid: bool, cur_time: float) -> None:
+    self.seen[s] = True
+    self.updated[s] = True
+
+    self.freq_tracker[s].record_recv_time(cur_time)
+    self.recv_time[s] = cur_time
+    self.recv_frame[s] = self.frame
+    self.logMonoTime[s] = log_mono_time
+    self.valid[s] = valid
+
   def update_msgs(self, cur_time: float, msgs: List[capnp.lib.capnp._DynamicStructReader]) -> None:
     self.frame += 1
     self.updated = dict.fromkeys(self.services, False)
@@ -207,15 +335,44 @@ class SubMaster:
         continue
 
       s = msg.which()
-      self.seen[s] = True
-      self.updated[s] = True
-
-      self.freq_tracker[s].record_recv_time(cur_time)
-      self.recv_time[s] = cur_time
-      self.recv_frame[s] = self.frame
+      self._record_msg(s, msg.logMonoTime, msg.valid, cur_time)
       self.data[s] = getattr(msg, s)
-      self.logMonoTime[s] = msg.logMonoTime
-      self.valid[s] = msg.valid
+      if self.metrics is not None:
+        self.metrics.record_recv(s, msg.logMonoTime, msg.total_size.word_count * 8, cur_time)
+
+    self._update_checks(cur_time)
+
+  def update_raw_msgs(self, cur_time: float, msgs: List[Optional[bytes]], recv_times: Optional[List[float]] = None) -> None:
+    """Same as update_msgs, for serialized Events. In lazy mode messages are only decoded on first access"""
+    self.frame += 1
+    self.updated = dict.fromkeys(self.services, False)
+    for i, dat in enumerate(msgs):
+      if dat is None:
+        continue
+
+      header = event_header(dat) if self.lazy else None
+      if header is None:
+        msg = log_from_bytes(dat)
+        s = msg.which()
+        self._record_msg(s, msg.logMonoTime, msg.valid, cur_time)
+        self.data[s] = getattr(msg, s)
+      else:
+        s = header[0]
+        self._record_msg(*header, cur_time)
+        self.data.pending[s] = dat  # type: ignore[attr-defined]
+
+      if recv_times is not None:
+        timing = self.timing[s]
+        timing.recv_time += recv_times[i]
+        timing.recv_count += 1
+      if self.metrics is not None:
+        self.metrics.record_recv(s, self.logMonoTime[s], len(dat), cur_time)
+
+    self._update_checks(cur_time)
+
+  def _update_checks(self, cur_time: float) -> None:
+    if self.metrics is not None:
+      self.metrics.maybe_report(cur_time)
 
     for s in self.static_freq_services:
       # alive if delay is within 10x the expected frequency; checks relaxed in simulator
@@ -238,6 +395,7 @@ class SubMaster:
 class PubMaster:
   def __init__(self, services: List[str]):
     self.sock = {}
+    self.metrics = get_metrics()
     for s in services:
       self.sock[s] = pub_sock(s)
 
@@ -245,6 +403,8 @@ class PubMaster:
     if not isinstance(dat, bytes):
       dat = dat.to_bytes()
     self.sock[s].send(dat)
+    if self.metrics is not None:
+      self.metrics.record_send(s, len(dat))
 
   def wait_for_readers_to_update(self, s: str, timeout: int, dt: float = 0.05) -> bool:
     for _ in range(int(timeout*(1./dt))):
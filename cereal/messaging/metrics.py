@@ -0,0 +1,150 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import numpy as np
+from typing import Callable, Dict, Optional
+
+from cereal.services import SERVICE_LIST
+
+# set MESSAGING_METRICS=1 to record latency, size, drops and poll wait of every PubMaster/SubMaster in the process
+METRICS_ENABLED = bool(int(os.getenv("MESSAGING_METRICS", "0")))
+# seconds between summaries sent to cloudlog, 0 disables them
+METRICS_REPORT_INTERVAL = float(os.getenv("MESSAGING_METRICS_INTERVAL", "60"))
+BUFFER_SIZE = 1024
+PERCENTILES = (50, 90, 99)
+
+
+class RingBuffer:
+  """Fixed size buffer of the most recent values"""
+
+  def __init__(self, size: int = BUFFER_SIZE):
+    self.buf = np.zeros(size, dtype=np.float64)
+    self.count = 0
+
+  def add(self, value: float) -> None:
+    self.buf[self.count % len(self.buf)] = value
+    self.count += 1
+
+  def values(self) -> np.ndarray:
+    """Stored values, oldest first"""
+    if self.count <= len(self.buf):
+      return self.buf[:self.count].copy()
+    i = self.count % len(self.buf)
+    return np.concatenate((self.buf[i:], self.buf[:i]))
+
+  def summary(self, scale: float = 1.) -> Dict[str, float]:
+    vals = self.values() * scale
+    if len(vals) == 0:
+      return {}
+    ret = {f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(vals, PERCENTILES), strict=True)}
+    ret["max"] = float(vals.max())
+    ret["mean"] = float(vals.mean())
+    return ret
+
+
+class ServiceMetrics:
+  def __init__(self, service: str, buffer_size: int = BUFFER_SIZE):
+    self.frequency = SERVICE_LIST[service].frequency if service in SERVICE_LIST else 0.
+    self.sent = 0
+    self.received = 0
+    self.drops = 0
+    self.last_log_mono_time = 0
+    self.latency = RingBuffer(buffer_size)
+    self.size = RingBuffer(buffer_size)
+
+  def summary(self) -> Dict:
+    return {
+      "sent": self.sent,
+      "received": self.received,
+      "drops": self.drops,
+      "latency_ms": self.latency.summary(1e3),
+      "size": self.size.summary(),
+    }
+
+
+class MessagingMetrics:
+  """
+    Latency from publish (logMonoTime) to receive, message size, drops and poll wait time of the sockets of a process.
+    Only the most recent values are kept, in ring buffers.
+  """
+
+  def __init__(self, name: str, buffer_size: int = BUFFER_SIZE, report_interval: float = METRICS_REPORT_INTERVAL,
+               report: Optional[Callable[[Dict], None]] = None):
+    self.name = name
+    self.buffer_size = buffer_size
+    self.services: Dict[str, ServiceMetrics] = {}
+    self.poll_wait = RingBuffer(buffer_size)
+    self.report_interval = report_interval
+    self.report = report
+    self.last_report = time.monotonic()
+
+  def _service(self, s: str) -> ServiceMetrics:
+    m = self.services.get(s)
+    if m is None:
+      m = self.services[s] = ServiceMetrics(s, self.buffer_size)
+    return m
+
+  def record_send(self, s: str, size: int) -> None:
+    m = self._service(s)
+    m.sent += 1
+    m.size.add(size)
+
+  def record_recv(self, s: str, log_mono_time: int, size: int, recv_time: float) -> None:
+    """recv_time is the time.monotonic() of the receive, the clock logMonoTime is based on"""
+    m = self._service(s)
+    m.received += 1
+    m.size.add(size)
+    m.latency.add(recv_time - log_mono_time * 1e-9)
+
+    # SubMaster sockets conflate, messages the subscriber was too slow for count as drops too
+    if m.last_log_mono_time > 0 and m.frequency > 0:
+      m.drops += max(round((log_mono_time - m.last_log_mono_time) * 1e-9 * m.frequency) - 1, 0)
+    m.last_log_mono_time = log_mono_time
+
+  def record_poll(self, wait: float) -> None:
+    self.poll_wait.add(wait)
+
+  def summary(self) -> Dict:
+    return {
+      "name": self.name,
+      "pid": os.getpid(),
+      "poll_wait_ms": self.poll_wait.summary(1e3),
+      "services": {s: m.summary() for s, m in self.services.items()},
+    }
+
+  def dump(self, path: Optional[str] = None) -> str:
+    """Writes the summary as JSON, returns the path"""
+    if path is None:
+      path = f"/tmp/messaging_metrics_{self.name}_{os.getpid()}.json"
+    with open(path, "w") as f:
+      json.dump(self.summary(), f, indent=2)
+    return path
+
+  def maybe_report(self, cur_time: float) -> None:
+    if self.report is None or self.report_interval <= 0 or cur_time - self.last_report < self.report_interval:
+      return
+    self.last_report = cur_time
+    self.report(self.summary())
+
+
+def cloudlog_report(summary: Dict) -> None:
+  from openpilot.common.swaglog import cloudlog
+  cloudlog.event("messaging metrics", **summary)
+
+
+_metrics: Optional[MessagingMetrics] = None
+
+
+def get_metrics() -> Optional[MessagingMetrics]:
+  """Metrics shared by the sockets of this process, None unless enabled"""
+  global _metrics
+  if _metrics is None and METRICS_ENABLED:
+    metrics = _metrics = MessagingMetrics(os.path.basename(sys.argv[0]) or "python", report=cloudlog_report)
+
+    # dump on demand with `kill -USR2 <pid>`, unless the process handles the signal itself
+    if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGUSR2) == signal.SIG_DFL:
+      signal.signal(signal.SIGUSR2, lambda *_: metrics.dump())
+  return _metrics
@@ -0,0 +1,56 @@
+import json
+import numpy as np
+
+from cereal.messaging.metrics import MessagingMetrics, RingBuffer
+
+
+class TestRingBuffer:
+  def test_values(self):
+    buf = RingBuffer(4)
+    assert len(buf.values()) == 0
+    assert buf.summary() == {}
+
+    for i in range(3):
+      buf.add(i)
+    assert buf.values().tolist() == [0, 1, 2]
+
+    for i in range(3, 10):
+      buf.add(i)
+    assert buf.values().tolist() == [6, 7, 8, 9]
+    assert buf.summary()["max"] == 9
+    assert buf.summary()["mean"] == 7.5
+
+
+class TestMessagingMetrics:
+  def test_recv(self):
+    metrics = MessagingMetrics("test")
+    freq = metrics._service("carState").frequency
+    dt = int(1e9 / freq)
+
+    # every third message is missed
+    t = 10 * 10**9
+    for i in range(30):
+      if i % 3 != 2:
+        metrics.record_recv("carState", t + i * dt, 100, (t + i * dt) * 1e-9 + 0.002)
+
+    m = metrics.services["carState"]
+    assert m.received == 20
+    assert m.drops == 9
+    np.testing.assert_allclose(m.latency.values(), 0.002, atol=1e-6)
+    assert m.size.summary()["max"] == 100
+
+  def test_report(self, tmp_path):
+    reports = []
+    metrics = MessagingMetrics("test", report_interval=1., report=reports.append)
+    metrics.record_send("carState", 200)
+    metrics.record_poll(0.01)
+
+    metrics.maybe_report(metrics.last_report + 0.5)
+    assert len(reports) == 0
+    metrics.maybe_report(metrics.last_report + 1.5)
+    assert len(reports) == 1
+    assert reports[0]["services"]["carState"]["sent"] == 1
+    assert reports[0]["poll_wait_ms"]["max"] == 10.
+
+    with open(metrics.dump(str(tmp_path / "metrics.json"))) as f:
+      assert json.load(f) == reports[0]
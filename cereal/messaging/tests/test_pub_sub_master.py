@@ -121,6 +121,50 @@ class TestSubMaster:
     sm.update(1000)
     assert sm[sock].vEgo == n
 
+  def test_lazy(self):
+    socks = ["carState", "controlsState"]
+    pm = messaging.PubMaster(socks)
+    sm = messaging.SubMaster(socks, poll="carState", lazy=True)
+    zmq_sleep()
+
+    for valid in (True, False):
+      msg = random_carstate()
+      msg.valid = valid
+      pm.send("carState", msg)
+      sm.update(1000)
+      assert sm.updated["carState"] and not sm.updated["controlsState"]
+      assert sm.logMonoTime["carState"] == msg.logMonoTime
+      assert sm.valid["carState"] == valid
+
+      # only decoded on access
+      assert sm.timing["carState"].decode_count == 0
+      assert_carstate(msg.carState, sm["carState"])
+      assert_carstate(msg.carState, sm["carState"])
+      assert sm.timing["carState"].decode_count == 1
+      assert sm.timing["carState"].recv_count == 1
+      sm.timing["carState"] = messaging.ServiceTiming()
+
+    # iterating and copying decode pending messages too
+    for get_msgs in (dict, lambda data: dict(data.items()), lambda data: dict(zip(data.keys(), data.values(), strict=True))):
+      msg = random_carstate()
+      pm.send("carState", msg)
+      sm.update(1000)
+      assert "carState" in sm.data.pending
+      assert_carstate(msg.carState, get_msgs(sm.data)["carState"])
+      assert not sm.data.pending
+
+  def test_event_header(self):
+    for sock in random_socks():
+      for valid in (True, False):
+        try:
+          msg = messaging.new_message(sock, valid=valid)
+        except Exception:
+          msg = messaging.new_message(sock, random.randrange(50), valid=valid)
+        dat = msg.to_bytes()
+        assert messaging.event_header(dat) == (sock, msg.logMonoTime, valid)
+        # truncated messages are decoded instead
+        assert all(messaging.event_header(dat[:n]) is None for n in range(16))
+
 
 class TestPubMaster:
 
@@ -1,10 +1,20 @@
 import io
 import os
+import base64
+import itertools
 import tempfile
 import contextlib
+import urllib.parse
 import zstandard as zstd
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 
 LOG_COMPRESSION_LEVEL = 10 # little benefit up to level 15. level ~17 is a small step change
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_BLOCK_SIZE = 8 * 1024 * 1024
+# large files are uploaded in concurrent blocks on wifi when enabled
+MULTIPART_UPLOAD = os.getenv("MULTIPART_UPLOAD") is not None
+MULTIPART_MIN_SIZE = 32 * 1e6
 
 
 class CallbackReader:
@@ -41,18 +51,102 @@ def atomic_write_in_dir(path: str, mode: str = 'w', buffering: int = -1, encodin
   os.replace(tmp_file_name, path)
 
 
-def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.BufferedIOBase, int]:
+def compressed_chunks(f: io.BufferedIOBase, chunk_size: int = UPLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+  compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
+  yield from compressor.read_to_iter(f, read_size=chunk_size, write_size=chunk_size)
+
+
+class CompressedUploadStream(io.RawIOBase):
+  """Compresses a file chunk by chunk as it's read, so the compressed file is never fully in memory"""
+  def __init__(self, filepath: str, size: int | None = None):
+    self.f = open(filepath, "rb")
+    # requests sends this as the Content-Length, the body is sent with chunked transfer encoding when it's None
+    self.len = size
+    self._chunks = compressed_chunks(self.f)
+    self._buf = memoryview(b"")
+    self._pos = 0
+
+  def readable(self) -> bool:
+    return True
+
+  def tell(self) -> int:
+    return self._pos
+
+  def readinto(self, b) -> int:
+    while not self._buf:
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        return 0
+      self._buf = memoryview(chunk)
+
+    n = min(len(b), len(self._buf))
+    b[:n] = self._buf[:n]
+    self._buf = self._buf[n:]
+    self._pos += n
+    return n
+
+  def close(self) -> None:
+    self.f.close()
+    super().close()
+
+
+def get_upload_stream(filepath: str, should_compress: bool, precompute_size: bool = False) -> tuple[io.IOBase, int | None]:
   if not should_compress:
     file_size = os.path.getsize(filepath)
     file_stream = open(filepath, "rb")
     return file_stream, file_size
 
-  # Compress the file on the fly
+  # Compress the file on the fly, the size is unknown and the body is sent with chunked transfer encoding
+  if not precompute_size:
+    return CompressedUploadStream(filepath), None
+
+  # for servers that need a Content-Length, the whole file is compressed in memory ahead
   compressed_stream = io.BytesIO()
   compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
-
   with open(filepath, "rb") as f:
     compressor.copy_stream(f, compressed_stream)
-    compressed_size = compressed_stream.tell()
-    compressed_stream.seek(0)
-    return compressed_stream, compressed_size
+  compressed_size = compressed_stream.tell()
+  compressed_stream.seek(0)
+  return compressed_stream, compressed_size
+
+
+def get_upload_chunks(filepath: str, should_compress: bool, block_size: int = UPLOAD_BLOCK_SIZE) -> Iterator[bytes]:
+  """The upload body of get_upload_stream, in blocks of block_size bytes"""
+  stream, _ = get_upload_stream(filepath, should_compress, precompute_size=False)
+  with stream:
+    while block := stream.read(block_size):
+      # the compressed stream returns what's left of the current chunk
+      while len(block) < block_size and (more := stream.read(block_size - len(block))):
+        block += more
+      yield block
+
+
+def upload_blocks(put: Callable, url: str, headers: dict[str, str], blocks: Iterator[bytes], workers: int = 4, timeout: float = 30):
+  """
+    Uploads to an Azure blob SAS url in blocks, with up to workers blocks in flight, then commits the block list.
+    Returns the response of the block list commit, or of the first failed block.
+  """
+  # the blob type is only set when the whole blob is put at once
+  headers = {k: v for k, v in headers.items() if k.lower() != "x-ms-blob-type"}
+  block_ids: list[str] = []
+  pending: list[Future] = []
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for block in itertools.chain(blocks, [None]):
+      if block is not None:
+        block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+        block_ids.append(block_id)
+        block_url = f"{url}&comp=block&blockid={urllib.parse.quote(block_id, safe='')}"
+        pending.append(executor.submit(put, block_url, data=block, headers=headers, timeout=timeout))
+
+      # keeps memory bounded to the blocks being uploaded, waits for all of them after the last one
+      while pending and (block is None or len(pending) >= workers):
+        response = pending.pop(0).result()
+        if response.status_code not in (200, 201):
+          for future in pending:
+            future.cancel()
+          return response
+
+  block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+  body = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'
+  return put(f"{url}&comp=blocklist", data=body, headers=headers, timeout=timeout)
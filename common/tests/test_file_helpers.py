@@ -1,7 +1,11 @@
 import os
+import zstandard as zstd
+from types import SimpleNamespace
+from urllib.parse import unquote
 from uuid import uuid4
 
-from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.common import file_helpers
+from openpilot.common.file_helpers import atomic_write_in_dir, get_upload_chunks, get_upload_stream, upload_blocks
 
 
 class TestFileHelpers:
@@ -17,3 +21,50 @@ class TestFileHelpers:
 
   def test_atomic_write_in_dir(self):
     self.run_atomic_write_func(atomic_write_in_dir)
+
+  def test_compressed_upload_stream(self, tmp_path, mocker):
+    path = tmp_path / "rlog"
+    dat = os.urandom(1024 * 1024) + b"\0" * 4 * 1024 * 1024
+    path.write_bytes(dat)
+
+    # streamed by default, the size is only known when it's compressed ahead
+    for kwargs in ({}, {"precompute_size": True}):
+      compressor_mock = mocker.patch.object(file_helpers.zstd, "ZstdCompressor", wraps=zstd.ZstdCompressor)
+      stream, size = get_upload_stream(str(path), True, **kwargs)
+      with stream:
+        assert isinstance(stream, file_helpers.CompressedUploadStream) != bool(kwargs)
+        compressed = stream.read()
+      assert size == (len(compressed) if kwargs else None)
+      # compressed once, not once more only to measure it
+      assert compressor_mock.call_count == 1
+      assert zstd.ZstdDecompressor().decompressobj().decompress(compressed) == dat
+      mocker.stopall()
+
+    blocks = list(get_upload_chunks(str(path), True, block_size=256 * 1024))
+    assert all(len(b) == 256 * 1024 for b in blocks[:-1])
+    assert b"".join(blocks) == compressed
+
+  def test_upload_blocks(self):
+    puts = []
+
+    def put(url, data, headers, timeout):
+      puts.append((url, data, headers))
+      return SimpleNamespace(status_code=404 if data == b"fail" else 201)
+
+    blocks = [b"a", b"b", b"c"]
+    response = upload_blocks(put, "https://blob/rlog.zst?sig=1", {"x-ms-blob-type": "BlockBlob", "a": "b"}, iter(blocks), workers=2)
+    assert response.status_code == 201
+    assert [p[1] for p in puts[:-1]] == blocks
+    assert all(p[2] == {"a": "b"} for p in puts)
+
+    url, body, _ = puts[-1]
+    assert url.endswith("&comp=blocklist")
+    # base64 block ids end with padding, which has to be escaped in the url but not in the block list
+    block_ids = [unquote(p[0].split("blockid=")[1]) for p in puts[:-1]]
+    assert all("=" not in p[0].split("blockid=")[1] for p in puts[:-1])
+    assert body.endswith("".join(f"<Latest>{i}</Latest>" for i in block_ids) + "</BlockList>")
+
+    puts.clear()
+    response = upload_blocks(put, "https://blob/rlog.zst?sig=1", {}, iter([b"a", b"fail", b"c", b"d"]), workers=1)
+    assert response.status_code == 404
+    assert not any(p[0].endswith("&comp=blocklist") for p in puts)
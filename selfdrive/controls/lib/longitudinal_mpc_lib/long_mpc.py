@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import os
 import time
+import concurrent.futures
+from typing import NamedTuple
 import numpy as np
 from cereal import log
 from opendbc.car.interfaces import ACCEL_MIN, ACCEL_MAX
@@ -58,6 +60,10 @@ STOP_DISTANCE = 6.0
 CRUISE_MIN_ACCEL = -1.2
 CRUISE_MAX_ACCEL = 1.6
 
+# radarState lead fields used by the MPC, for solving scenarios in a batch
+LEAD_DTYPE = np.dtype([('status', bool), ('dRel', np.float64), ('vLead', np.float64), ('aLeadK', np.float64),
+                       ('aLeadTau', np.float64), ('modelProb', np.float64)])
+
 def get_jerk_factor(personality=log.LongitudinalPersonality.standard):
   if personality==log.LongitudinalPersonality.relaxed:
     return 1.0
@@ -228,6 +234,8 @@ class LongitudinalMpc:
     self.solver = AcadosOcpSolverCython(MODEL_NAME, ACADOS_SOLVER_TYPE, N)
     self.reset()
     self.source = SOURCES[2]
+    self.last_solution_status = 0
+    self.last_x_sol, self.last_u_sol = self.x_sol, self.u_sol
 
   def reset(self):
     # self.solver = AcadosOcpSolverCython(MODEL_NAME, ACADOS_SOLVER_TYPE, N)
@@ -440,6 +448,10 @@ class LongitudinalMpc:
 
     self.prev_a = np.interp(T_IDXS + self.dt, T_IDXS, self.a_solution)
 
+    # reset() clears the status and solution, keep the ones from this solve for offline users
+    self.last_solution_status = self.solution_status
+    self.last_x_sol, self.last_u_sol = self.x_sol, self.u_sol
+
     t = time.monotonic()
     if self.solution_status != 0:
       if t > self.last_cloudlog_t + 5.0:
@@ -451,6 +463,87 @@ class LongitudinalMpc:
     # lin {self.time_linearization:.2e} qp_iter {qp_iter}, reset {reset}")
 
 
+class BatchRadarState(NamedTuple):
+  leadOne: np.record
+  leadTwo: np.record
+
+
+class BatchSolution(NamedTuple):
+  x_sol: np.ndarray
+  u_sol: np.ndarray
+  solution_status: np.ndarray
+  solve_time: np.ndarray
+  source: np.ndarray
+
+
+def _solve_batch(mpc, v_ego, a_ego, v_cruise, leads, personality, iterations):
+  n = len(v_ego)
+  sol = BatchSolution(np.zeros((n, N+1, X_DIM)), np.zeros((n, N)), np.zeros(n, dtype=int), np.zeros(n), np.empty(n, dtype=f'<U{max(map(len, SOURCES))}'))
+  leads = leads.view(np.recarray)
+  # model trajectories are not used in ACC mode
+  x, v, a, j = np.zeros((4, N+1))
+
+  for i in range(n):
+    # every scenario starts from a reset solver like the first plan after engaging,
+    # then warm starts each SQP_RTI iteration from the previous one
+    mpc.reset()
+    radarstate = BatchRadarState(leads[i, 0], leads[i, 1])
+    for k in range(iterations):
+      # like the planner, the change in accel is only free on the first plan after a reset
+      mpc.set_weights(prev_accel_constraint=k > 0, personality=int(personality[i]))
+      mpc.set_cur_state(v_ego[i], a_ego[i])
+      mpc.update(radarstate, v_cruise[i], x, v, a, j, personality=int(personality[i]))
+      sol.solve_time[i] += mpc.solve_time
+    # a failed solve resets the mpc, report what the solver returned instead
+    sol.x_sol[i] = mpc.last_x_sol
+    sol.u_sol[i] = mpc.last_u_sol[:, 0]
+    sol.solution_status[i] = mpc.last_solution_status
+    sol.source[i] = mpc.source
+  return sol
+
+
+# one solver per pool process, reused for all the scenarios it gets
+_batch_mpc = None
+
+def _init_batch_worker(dt):
+  global _batch_mpc
+  _batch_mpc = LongitudinalMpc(dt=dt)
+
+
+def _solve_batch_chunk(*args):
+  return _solve_batch(_batch_mpc, *args)
+
+
+def solve_batch(v_ego, a_ego, v_cruise, leads, personality=log.LongitudinalPersonality.standard, iterations=10, workers=None, dt=DT_MDL):
+  """
+  Solve many ACC scenarios offline, spread over a process pool.
+
+  v_ego, a_ego, v_cruise and personality are per scenario (or broadcast), leads is a
+  LEAD_DTYPE array of shape (scenarios, 2) with leadOne and leadTwo as in radarState.
+  Each scenario is solved with `iterations` SQP_RTI steps. Returns a BatchSolution with
+  the stacked x_sol, u_sol and acados status of the last iteration (before any reset on
+  failure), the plan source, and the acados solve time summed over the iterations of each scenario.
+  """
+  v_ego = np.asarray(v_ego, dtype=np.float64)
+  n = len(v_ego)
+  args = (v_ego,
+          np.broadcast_to(np.asarray(a_ego, dtype=np.float64), n),
+          np.broadcast_to(np.asarray(v_cruise, dtype=np.float64), n),
+          np.asarray(leads, dtype=LEAD_DTYPE).reshape(n, 2),
+          np.broadcast_to(np.asarray(personality, dtype=int), n))
+
+  workers = min(workers or os.cpu_count() or 1, n)
+  if workers <= 1:
+    return _solve_batch(LongitudinalMpc(dt=dt), *args, iterations)
+
+  # a few chunks per worker to even out the load, results are concatenated in order
+  chunks = np.array_split(np.arange(n), workers * 4)
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(dt,)) as pool:
+    futures = [pool.submit(_solve_batch_chunk, *(arg[idx] for arg in args), iterations) for idx in chunks if len(idx)]
+    results = [f.result() for f in futures]
+  return BatchSolution(*(np.concatenate(field) for field in zip(*results, strict=True)))
+
+
 if __name__ == "__main__":
   ocp = gen_long_ocp()
   AcadosOcpSolver.generate(ocp, json_file=JSON_FILE)
@@ -29,6 +29,9 @@ V_EGO_STATIONARY = 4.   # no stationary object flag below this speed
 RADAR_TO_CENTER = 2.7   # (deprecated) RADAR is ~ 2.7m ahead from center of car
 RADAR_TO_CAMERA = 1.52  # RADAR is ~ 1.5m ahead from center of mesh frame
 
+# below this many tracks, NumPy's per call overhead is larger than doing the math per track
+MIN_VECTORIZED_TRACKS = 64
+
 
 class KalmanParams:
   def __init__(self, dt: float):
@@ -52,66 +55,142 @@ class KalmanParams:
     self.K = [[np.interp(dt, dts, K0)], [np.interp(dt, dts, K1)]]
 
 
-class Track:
-  def __init__(self, identifier: int, v_lead: float, kalman_params: KalmanParams):
-    self.identifier = identifier
-    self.cnt = 0
-    self.aLeadTau = FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL)
-    self.K_A = kalman_params.A
-    self.K_C = kalman_params.C
-    self.K_K = kalman_params.K
-    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
-
-  def update(self, d_rel: float, y_rel: float, v_rel: float, v_lead: float, measured: float):
-    # relative values, copy
-    self.dRel = d_rel   # LONG_DIST
-    self.yRel = y_rel   # -LAT_DIST
-    self.vRel = v_rel   # REL_SPEED
-    self.vLead = v_lead
-    self.measured = measured   # measured or estimate
+# a track column, an array when the tracks are updated vectorized and a tuple when they're updated one at a time
+Column = np.ndarray | tuple
+
+
+def _to_tuple(column: Column) -> tuple:
+  return tuple(column.tolist()) if isinstance(column, np.ndarray) else column
+
+
+class RadarTracks:
+  """
+  Radar tracks as columns with one row per track, in the order the tracks first appeared.
+  The lead Kalman filters and the lead acceleration time constant filters are updated for all tracks at once,
+  or one track at a time with tuples as columns when there are fewer than MIN_VECTORIZED_TRACKS.
+  """
+  def __init__(self, kalman_params: KalmanParams):
+    kf = KF1D([[0.0], [0.0]], kalman_params.A, kalman_params.C, kalman_params.K)
+    # Python floats for the per track update
+    self.A_K = (float(kf.A_K_0), float(kf.A_K_1), float(kf.A_K_2), float(kf.A_K_3))
+    self.K = (float(kf.K0_0), float(kf.K1_0))
+    self.a_lead_tau_alpha = FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL).alpha
+
+    self.index: dict[int, int] = {}  # track id to row
+    self.identifier: Column = ()
+    self.cnt: Column = ()
+    self.dRel: Column = ()
+    self.yRel: Column = ()
+    self.vRel: Column = ()
+    self.vLead: Column = ()
+    self.measured: Column = ()
+    self.vLeadK: Column = ()
+    self.aLeadK: Column = ()
+    self.aLeadTau: Column = ()
+
+  def __len__(self) -> int:
+    return len(self.identifier)
+
+  def update(self, ar_pts: dict[int, list[float]], v_ego: float):
+    """Replaces the tracks with the radar points, keeping the filter state of tracks that are still present"""
+    prev_index = self.index
+    # the same tracks as last time is the usual case
+    same_tracks = ar_pts.keys() == prev_index.keys()
+    if not same_tracks:
+      # existing tracks keep their order, new ones are added after them
+      track_ids = [track_id for track_id in prev_index if track_id in ar_pts] + [track_id for track_id in ar_pts if track_id not in prev_index]
+      self.index = {track_id: i for i, track_id in enumerate(track_ids)}
+
+    if len(ar_pts) < MIN_VECTORIZED_TRACKS:
+      self._update_per_track(ar_pts, v_ego, prev_index)
+    else:
+      self._update_vectorized(ar_pts, v_ego, prev_index, same_tracks)
 
-    # computed velocity and accelerations
-    if self.cnt > 0:
-      self.kf.update(self.vLead)
+  def _update_vectorized(self, ar_pts: dict[int, list[float]], v_ego: float, prev_index: dict[int, int], same_tracks: bool):
+    pts = np.array([ar_pts[track_id] for track_id in self.index], dtype=np.float64).reshape(-1, 4)
+    self.dRel, self.yRel, self.vRel, self.measured = pts.T
+    # align v_ego by a fixed time to align it with the radar measurement
+    self.vLead = self.vRel + v_ego
 
-    self.vLeadK = float(self.kf.x[SPEED][0])
-    self.aLeadK = float(self.kf.x[ACCEL][0])
+    if same_tracks:
+      x0, x1, a_lead_tau = self.vLeadK, self.aLeadK, self.aLeadTau
+    else:
+      # new tracks start with the measured speed and no acceleration
+      self.identifier = np.array(list(self.index), dtype=np.uint64)
+      keep = np.array([prev_index[track_id] for track_id in self.index if track_id in prev_index], dtype=np.int64)
+      new = len(self) - len(keep)
+      self.cnt = np.concatenate([np.asarray(self.cnt, dtype=np.int64)[keep], np.zeros(new, dtype=np.int64)])
+      x0 = np.concatenate([np.asarray(self.vLeadK, dtype=np.float64)[keep], self.vLead[len(keep):]])
+      x1 = np.concatenate([np.asarray(self.aLeadK, dtype=np.float64)[keep], np.zeros(new)])
+      a_lead_tau = np.concatenate([np.asarray(self.aLeadTau, dtype=np.float64)[keep], np.full(new, _LEAD_ACCEL_TAU)])
+
+    # computed velocity and accelerations, same as KF1D.update for every track seen before
+    seen = self.cnt > 0
+    self.vLeadK = np.where(seen, self.A_K[0] * x0 + self.A_K[1] * x1 + self.K[0] * self.vLead, x0)
+    self.aLeadK = np.where(seen, self.A_K[2] * x0 + self.A_K[3] * x1 + self.K[1] * self.vLead, x1)
 
     # Learn if constant acceleration
-    if abs(self.aLeadK) < 0.5:
-      self.aLeadTau.x = _LEAD_ACCEL_TAU
-    else:
-      self.aLeadTau.update(0.0)
+    alpha = self.a_lead_tau_alpha
+    self.aLeadTau = np.where(np.abs(self.aLeadK) < 0.5, _LEAD_ACCEL_TAU, (1. - alpha) * a_lead_tau + alpha * 0.0)
 
     self.cnt += 1
 
-  def get_RadarState(self, model_prob: float = 0.0):
+  def _update_per_track(self, ar_pts: dict[int, list[float]], v_ego: float, prev_index: dict[int, int]):
+    # the same as _update_vectorized, one track at a time
+    prev_cnt, prev_v_lead_k, prev_a_lead_k, prev_a_lead_tau = _to_tuple(self.cnt), _to_tuple(self.vLeadK), _to_tuple(self.aLeadK), _to_tuple(self.aLeadTau)
+    (a_k_0, a_k_1, a_k_2, a_k_3), (k_0, k_1) = self.A_K, self.K
+    alpha = self.a_lead_tau_alpha
+    tracks = []
+    for track_id in self.index:
+      d_rel, y_rel, v_rel, measured = ar_pts[track_id]
+      v_lead = v_rel + v_ego
+      j = prev_index.get(track_id)
+      if j is not None:
+        cnt, v_lead_k, a_lead_k, a_lead_tau = prev_cnt[j], prev_v_lead_k[j], prev_a_lead_k[j], prev_a_lead_tau[j]
+        if cnt > 0:
+          v_lead_k, a_lead_k = a_k_0 * v_lead_k + a_k_1 * a_lead_k + k_0 * v_lead, a_k_2 * v_lead_k + a_k_3 * a_lead_k + k_1 * v_lead
+      else:
+        cnt, v_lead_k, a_lead_k, a_lead_tau = 0, v_lead, 0.0, _LEAD_ACCEL_TAU
+      a_lead_tau = _LEAD_ACCEL_TAU if abs(a_lead_k) < 0.5 else (1. - alpha) * a_lead_tau + alpha * 0.0
+      tracks.append((track_id, d_rel, y_rel, v_rel, measured, v_lead, v_lead_k, a_lead_k, a_lead_tau, cnt + 1))
+
+    (self.identifier, self.dRel, self.yRel, self.vRel, self.measured, self.vLead,
+     self.vLeadK, self.aLeadK, self.aLeadTau, self.cnt) = tuple(zip(*tracks, strict=True)) if len(tracks) else ((),) * 10
+
+  def get_RadarState(self, i: int, model_prob: float = 0.0):
     return {
-      "dRel": float(self.dRel),
-      "yRel": float(self.yRel),
-      "vRel": float(self.vRel),
-      "vLead": float(self.vLead),
-      "vLeadK": float(self.vLeadK),
-      "aLeadK": float(self.aLeadK),
-      "aLeadTau": float(self.aLeadTau.x),
+      "dRel": float(self.dRel[i]),
+      "yRel": float(self.yRel[i]),
+      "vRel": float(self.vRel[i]),
+      "vLead": float(self.vLead[i]),
+      "vLeadK": float(self.vLeadK[i]),
+      "aLeadK": float(self.aLeadK[i]),
+      "aLeadTau": float(self.aLeadTau[i]),
       "status": True,
       "fcw": self.is_potential_fcw(model_prob),
       "modelProb": model_prob,
       "radar": True,
-      "radarTrackId": self.identifier,
+      "radarTrackId": int(self.identifier[i]),
     }
 
-  def potential_low_speed_lead(self, v_ego: float):
+  def closest_potential_low_speed_lead(self, v_ego: float) -> int | None:
     # stop for stuff in front of you and low speed, even without model confirmation
     # Radar points closer than 0.75, are almost always glitches on toyota radars
-    return abs(self.yRel) < 1.0 and (v_ego < V_EGO_STATIONARY) and (0.75 < self.dRel < 25)
+    if v_ego >= V_EGO_STATIONARY:
+      return None
+
+    if isinstance(self.dRel, tuple):
+      low_speed = [(d_rel, i) for i, (d_rel, y_rel) in enumerate(zip(self.dRel, self.yRel, strict=True)) if abs(y_rel) < 1.0 and 0.75 < d_rel < 25]
+      return min(low_speed)[1] if len(low_speed) else None
+
+    low_speed = (np.abs(self.yRel) < 1.0) & (0.75 < self.dRel) & (self.dRel < 25)
+    return int(np.argmin(np.where(low_speed, self.dRel, np.inf))) if np.any(low_speed) else None
 
   def is_potential_fcw(self, model_prob: float):
     return model_prob > .9
 
   def __str__(self):
-    ret = f"x: {self.dRel:4.1f}  y: {self.yRel:4.1f}  v: {self.vRel:4.1f}  a: {self.aLeadK:4.1f}"
-    return ret
+    return "\n".join(f"x: {self.dRel[i]:4.1f}  y: {self.yRel[i]:4.1f}  v: {self.vRel[i]:4.1f}  a: {self.aLeadK[i]:4.1f}" for i in range(len(self)))
 
 
 def laplacian_pdf(x: float, mu: float, b: float):
@@ -119,27 +198,55 @@ def laplacian_pdf(x: float, mu: float, b: float):
   return math.exp(-abs(x-mu)/b)
 
 
-def match_vision_to_track(v_ego: float, lead: capnp._DynamicStructReader, tracks: dict[int, Track]):
-  offset_vision_dist = lead.x[0] - RADAR_TO_CAMERA
+def laplacian_pdf_vectorized(x: np.ndarray, mu: np.ndarray, b: np.ndarray):
+  b = np.maximum(b, 1e-4)
+  return np.exp(-np.abs(x-mu)/b)
 
-  def prob(c):
-    prob_d = laplacian_pdf(c.dRel, offset_vision_dist, lead.xStd[0])
-    prob_y = laplacian_pdf(c.yRel, -lead.y[0], lead.yStd[0])
-    prob_v = laplacian_pdf(c.vRel + v_ego, lead.v[0], lead.vStd[0])
 
-    # This isn't exactly right, but it's a good heuristic
-    return prob_d * prob_y * prob_v
+# np.exp and math.exp can differ in the last bits, far less than this
+NP_EXP_RTOL = 1e-9
+# below this, probabilities can be subnormal and lose precision
+MIN_NORMAL_PROB = 1e-290
+
 
-  track = max(tracks.values(), key=prob)
+def match_vision_to_tracks(v_ego: float, leads: list[capnp._DynamicStructReader], tracks: RadarTracks) -> list[int | None]:
+  """Row of the track matching each vision lead, or None"""
+  lead_params = [(lead.x[0] - RADAR_TO_CAMERA, -lead.y[0], lead.v[0], max(lead.xStd[0], 1e-4), max(lead.yStd[0], 1e-4), max(lead.vStd[0], 1e-4))
+                 for lead in leads]
 
-  # if no 'sane' match is found return -1
-  # stationary radar points can be false positives
-  dist_sane = abs(track.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
-  vel_sane = (abs(track.vRel + v_ego - lead.v[0]) < 10) or (v_ego + track.vRel > 3)
-  if dist_sane and vel_sane:
-    return track
+  def probs(lead, rows):
+    offset, y, v, x_std, y_std, v_std = lead
+    # This isn't exactly right, but it's a good heuristic
+    # laplacian_pdf of distance, lateral position and speed, with the std already clipped
+    return [math.exp(-abs(d_rel-offset)/x_std) * math.exp(-abs(y_rel-y)/y_std) * math.exp(-abs(v_rel+v_ego-v)/v_std) for d_rel, y_rel, v_rel in rows]
+
+  best = []
+  if isinstance(tracks.dRel, tuple):
+    rows = list(zip(tracks.dRel, tracks.yRel, tracks.vRel, strict=True))
+    for lead in lead_params:
+      lead_probs = probs(lead, rows)
+      best.append(lead_probs.index(max(lead_probs)))
   else:
-    return None
+    # distance, lateral and speed probabilities of all tracks for every lead
+    mu, b = np.array(lead_params).T.reshape(2, 3, -1, 1)
+    prob_d, prob_y, prob_v = laplacian_pdf_vectorized(np.stack([tracks.dRel, tracks.yRel, tracks.vRel + v_ego])[:, None], mu, b)
+    for lead, lead_probs in zip(lead_params, prob_d * prob_y * prob_v, strict=True):
+      # the tracks that may be the most likely are ranked again with math.exp, so the pick is the same as one track at a time
+      max_prob = lead_probs.max()
+      candidates = np.flatnonzero(lead_probs >= max_prob * (1 - NP_EXP_RTOL)) if max_prob > MIN_NORMAL_PROB else np.arange(len(tracks))
+      exact_probs = probs(lead, zip(tracks.dRel[candidates].tolist(), tracks.yRel[candidates].tolist(), tracks.vRel[candidates].tolist(), strict=True))
+      best.append(int(candidates[exact_probs.index(max(exact_probs))]))
+
+  matches: list[int | None] = []
+  for i, lead in zip(best, lead_params, strict=True):
+    offset, v = lead[0], lead[2]
+    # if no 'sane' match is found return -1
+    # stationary radar points can be false positives
+    d_rel, v_rel = tracks.dRel[i], tracks.vRel[i]
+    dist_sane = abs(d_rel - offset) < max([(offset)*.25, 5.0])
+    vel_sane = (abs(v_rel + v_ego - v) < 10) or (v_ego + v_rel > 3)
+    matches.append(i if dist_sane and vel_sane else None)
+  return matches
 
 
 def get_RadarState_from_vision(lead_msg: capnp._DynamicStructReader, v_ego: float, model_v_ego: float):
@@ -160,29 +267,28 @@ def get_RadarState_from_vision(lead_msg: capnp._DynamicStructReader, v_ego: floa
   }
 
 
-def get_lead(v_ego: float, ready: bool, tracks: dict[int, Track], lead_msg: capnp._DynamicStructReader,
+def get_lead(v_ego: float, ready: bool, tracks: RadarTracks, lead_msg: capnp._DynamicStructReader, match: int | None,
              model_v_ego: float, CP: structs.CarParams, CP_SP: structs.CarParamsSP, low_speed_override: bool = True) -> dict[str, Any]:
   # Determine leads, this is where the essential logic happens
+  # match is the row of the track matched to this lead by match_vision_to_tracks
   if len(tracks) > 0 and ready and lead_msg.prob > .5:
-    track = match_vision_to_track(v_ego, lead_msg, tracks)
+    track = match
   else:
     track = None
 
   lead_dict = {'status': False}
   if track is not None:
-    lead_dict = track.get_RadarState(lead_msg.prob)
+    lead_dict = tracks.get_RadarState(track, lead_msg.prob)
     lead_dict = get_custom_yrel(CP, CP_SP, lead_dict, lead_msg)
   elif (track is None) and ready and (lead_msg.prob > .5):
     lead_dict = get_RadarState_from_vision(lead_msg, v_ego, model_v_ego)
 
   if low_speed_override:
-    low_speed_tracks = [c for c in tracks.values() if c.potential_low_speed_lead(v_ego)]
-    if len(low_speed_tracks) > 0:
-      closest_track = min(low_speed_tracks, key=lambda c: c.dRel)
-
+    closest_track = tracks.closest_potential_low_speed_lead(v_ego)
+    if closest_track is not None:
       # Only choose new track if it is actually closer than the previous one
-      if (not lead_dict['status']) or (closest_track.dRel < lead_dict['dRel']):
-        lead_dict = closest_track.get_RadarState()
+      if (not lead_dict['status']) or (tracks.dRel[closest_track] < lead_dict['dRel']):
+        lead_dict = tracks.get_RadarState(closest_track)
 
   return lead_dict
 
@@ -203,8 +309,8 @@ class RadarD:
 
     self.current_time = 0.0
 
-    self.tracks: dict[int, Track] = {}
     self.kalman_params = KalmanParams(DT_MDL)
+    self.tracks = RadarTracks(self.kalman_params)
 
     self.v_ego = 0.0
     self.v_ego_hist = deque([0.0], maxlen=int(round(delay / DT_MDL))+1)
@@ -226,22 +332,8 @@ class RadarD:
 
     ar_pts = {pt.trackId: [pt.dRel, pt.yRel, pt.vRel, pt.measured] for pt in rr.points}
 
-    # *** remove missing points from meta data ***
-    for ids in list(self.tracks.keys()):
-      if ids not in ar_pts:
-        self.tracks.pop(ids, None)
-
-    # *** compute the tracks ***
-    for ids in ar_pts:
-      rpt = ar_pts[ids]
-
-      # align v_ego by a fixed time to align it with the radar measurement
-      v_lead = rpt[2] + self.v_ego_hist[0]
-
-      # create the track if it doesn't exist or it's a new track
-      if ids not in self.tracks:
-        self.tracks[ids] = Track(ids, v_lead, self.kalman_params)
-      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
+    # *** remove missing points, add new ones and compute the tracks ***
+    self.tracks.update(ar_pts, self.v_ego_hist[0])
 
     # *** publish radarState ***
     self.radar_state_valid = sm.all_checks()
@@ -256,8 +348,11 @@ class RadarD:
       model_v_ego = self.v_ego
     leads_v3 = sm['modelV2'].leadsV3
     if len(leads_v3) > 1:
-      self.radar_state.leadOne = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[0], model_v_ego, self.CP, self.CP_SP, low_speed_override=True)
-      self.radar_state.leadTwo = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[1], model_v_ego, self.CP, self.CP_SP, low_speed_override=False)
+      leads = [leads_v3[0], leads_v3[1]]
+      matches = match_vision_to_tracks(self.v_ego, leads, self.tracks) if len(self.tracks) > 0 and self.ready else [None, None]
+      self.radar_state.leadOne = get_lead(self.v_ego, self.ready, self.tracks, leads[0], matches[0], model_v_ego, self.CP, self.CP_SP, low_speed_override=True)
+      self.radar_state.leadTwo = get_lead(self.v_ego, self.ready, self.tracks, leads[1], matches[1], model_v_ego, self.CP, self.CP_SP,
+                                          low_speed_override=False)
 
   def publish(self, pm: messaging.PubMaster):
     assert self.radar_state is not None
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Compares the radard track table with the previous implementation of one Track object per radar point,
+for different numbers of tracks, and checks both give the same leads.
+"""
+import math
+import time
+import numpy as np
+from types import SimpleNamespace
+
+from openpilot.common.filter_simple import FirstOrderFilter
+from openpilot.common.realtime import DT_MDL
+from openpilot.common.simple_kalman import KF1D
+from openpilot.selfdrive.controls.radard import KalmanParams, RadarTracks, match_vision_to_tracks, get_lead, get_RadarState_from_vision, \
+                                                _LEAD_ACCEL_TAU, RADAR_TO_CAMERA, V_EGO_STATIONARY
+
+FRAMES = 400
+TRACK_COUNTS = (8, 16, 32, 64, 128)
+
+
+class Track:
+  def __init__(self, identifier, v_lead, kalman_params):
+    self.identifier = identifier
+    self.cnt = 0
+    self.aLeadTau = FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL)
+    self.kf = KF1D([[v_lead], [0.0]], kalman_params.A, kalman_params.C, kalman_params.K)
+
+  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
+    self.dRel, self.yRel, self.vRel, self.vLead, self.measured = d_rel, y_rel, v_rel, v_lead, measured
+    if self.cnt > 0:
+      self.kf.update(self.vLead)
+    self.vLeadK = float(self.kf.x[0][0])
+    self.aLeadK = float(self.kf.x[1][0])
+    if abs(self.aLeadK) < 0.5:
+      self.aLeadTau.x = _LEAD_ACCEL_TAU
+    else:
+      self.aLeadTau.update(0.0)
+    self.cnt += 1
+
+  def get_RadarState(self, model_prob=0.0):
+    return {"dRel": float(self.dRel), "yRel": float(self.yRel), "vRel": float(self.vRel), "vLead": float(self.vLead),
+            "vLeadK": float(self.vLeadK), "aLeadK": float(self.aLeadK), "aLeadTau": float(self.aLeadTau.x), "status": True,
+            "fcw": model_prob > .9, "modelProb": model_prob, "radar": True, "radarTrackId": self.identifier}
+
+
+def laplacian_pdf(x, mu, b):
+  b = max(b, 1e-4)
+  return math.exp(-abs(x-mu)/b)
+
+
+def match_vision_to_track(v_ego, lead, tracks):
+  offset_vision_dist = lead.x[0] - RADAR_TO_CAMERA
+
+  def prob(c):
+    prob_d = laplacian_pdf(c.dRel, offset_vision_dist, lead.xStd[0])
+    prob_y = laplacian_pdf(c.yRel, -lead.y[0], lead.yStd[0])
+    prob_v = laplacian_pdf(c.vRel + v_ego, lead.v[0], lead.vStd[0])
+    return prob_d * prob_y * prob_v
+
+  track = max(tracks.values(), key=prob)
+  dist_sane = abs(track.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
+  vel_sane = (abs(track.vRel + v_ego - lead.v[0]) < 10) or (v_ego + track.vRel > 3)
+  return track if dist_sane and vel_sane else None
+
+
+def get_lead_tracks(v_ego, tracks, lead_msg, model_v_ego, low_speed_override):
+  track = match_vision_to_track(v_ego, lead_msg, tracks) if len(tracks) > 0 and lead_msg.prob > .5 else None
+  lead_dict = {'status': False}
+  if track is not None:
+    lead_dict = track.get_RadarState(lead_msg.prob)
+  elif lead_msg.prob > .5:
+    lead_dict = get_RadarState_from_vision(lead_msg, v_ego, model_v_ego)
+  if low_speed_override:
+    low_speed_tracks = [c for c in tracks.values() if abs(c.yRel) < 1.0 and (v_ego < V_EGO_STATIONARY) and (0.75 < c.dRel < 25)]
+    if len(low_speed_tracks) > 0:
+      closest_track = min(low_speed_tracks, key=lambda c: c.dRel)
+      if (not lead_dict['status']) or (closest_track.dRel < lead_dict['dRel']):
+        lead_dict = closest_track.get_RadarState()
+  return lead_dict
+
+
+def update_tracks(tracks, ar_pts, v_ego, kalman_params):
+  for ids in list(tracks.keys()):
+    if ids not in ar_pts:
+      tracks.pop(ids, None)
+  for ids, rpt in ar_pts.items():
+    v_lead = rpt[2] + v_ego
+    if ids not in tracks:
+      tracks[ids] = Track(ids, v_lead, kalman_params)
+    tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
+
+
+def make_frames(num_tracks, rng):
+  """Radar points that move around, with tracks disappearing and new ones appearing, and two vision leads"""
+  frames = []
+  ids = list(range(num_tracks))
+  next_id = num_tracks
+  d = rng.uniform(5, 100, num_tracks)
+  for frame in range(FRAMES):
+    if rng.random() < 0.2:
+      ids[rng.integers(num_tracks)] = next_id
+      next_id += 1
+    d += rng.normal(0, 0.3, num_tracks)
+    v_ego = 2.0 if frame % 100 < 20 else 20.0 + math.sin(frame * 0.01)
+    y, v = rng.normal(0, 2, num_tracks), rng.normal(0, 3, num_tracks)
+    ar_pts = {i: [float(d[j]), float(y[j]), float(v[j]), 1.0] for j, i in enumerate(ids)}
+
+    leads = []
+    for j in (0, 1):
+      lead = SimpleNamespace(x=[float(d[j]) + RADAR_TO_CAMERA + rng.normal(0, 1)], y=[float(-y[j])], v=[float(v[j]) + v_ego],
+                             xStd=[1.0], yStd=[0.5], vStd=[1.0], a=[0.0], prob=0.9 if j == 0 else 0.6)
+      leads.append(lead)
+    frames.append((ar_pts, v_ego, leads))
+  return frames
+
+
+def run_previous(frames, kalman_params):
+  tracks: dict = {}
+  out = []
+  for ar_pts, v_ego, leads in frames:
+    update_tracks(tracks, ar_pts, v_ego, kalman_params)
+    out.append((get_lead_tracks(v_ego, tracks, leads[0], v_ego, True), get_lead_tracks(v_ego, tracks, leads[1], v_ego, False)))
+  return out
+
+
+def run_table(frames, kalman_params):
+  tracks = RadarTracks(kalman_params)
+  cp = SimpleNamespace(brand="toyota", flags=0)
+  cp_sp = SimpleNamespace(flags=0)
+  out = []
+  for ar_pts, v_ego, leads in frames:
+    tracks.update(ar_pts, v_ego)
+    matches = match_vision_to_tracks(v_ego, leads, tracks) if len(tracks) > 0 else [None, None]
+    out.append((get_lead(v_ego, True, tracks, leads[0], matches[0], v_ego, cp, cp_sp, low_speed_override=True),
+                get_lead(v_ego, True, tracks, leads[1], matches[1], v_ego, cp, cp_sp, low_speed_override=False)))
+  return out
+
+
+if __name__ == "__main__":
+  kalman_params = KalmanParams(DT_MDL)
+  rng = np.random.default_rng(0)
+
+  print(f"{FRAMES} frames, track update and both leads")
+  for num_tracks in TRACK_COUNTS:
+    frames = make_frames(num_tracks, rng)
+    results = {}
+    for name, run in (("previous", run_previous), ("table", run_table)):
+      t = time.perf_counter()
+      results[name] = run(frames, kalman_params)
+      results[name + "_t"] = (time.perf_counter() - t) / FRAMES
+
+    assert results["previous"] == results["table"], "leads differ"
+    print(f"  {num_tracks:3d} tracks: previous {results['previous_t'] * 1e6:7.1f} us, table {results['table_t'] * 1e6:7.1f} us")
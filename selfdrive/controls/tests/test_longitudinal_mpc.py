@@ -0,0 +1,45 @@
+import numpy as np
+
+from cereal import log
+from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import LEAD_DTYPE, solve_batch
+
+
+def make_scenarios(n, seed=0):
+  rng = np.random.default_rng(seed)
+  leads = np.zeros((n, 2), dtype=LEAD_DTYPE)
+  leads['status'] = rng.random((n, 2)) < 0.7
+  leads['dRel'] = rng.uniform(10., 100., (n, 2))
+  leads['vLead'] = rng.uniform(0., 30., (n, 2))
+  leads['aLeadK'] = rng.uniform(-2., 2., (n, 2))
+  leads['aLeadTau'] = 1.5
+  leads['modelProb'] = 1.0
+  personality = rng.choice([log.LongitudinalPersonality.relaxed, log.LongitudinalPersonality.standard, log.LongitudinalPersonality.aggressive], n)
+  return rng.uniform(0., 30., n), rng.uniform(-1., 1., n), rng.uniform(10., 35., n), leads, personality
+
+
+class TestLongitudinalMpcBatch:
+  def test_pool_matches_serial(self):
+    scenarios = make_scenarios(24)
+    serial = solve_batch(*scenarios, workers=1)
+    pooled = solve_batch(*scenarios, workers=3)
+    for field, a, b in zip(serial._fields, serial, pooled, strict=True):
+      assert len(a) == 24
+      np.testing.assert_array_equal(a, b, err_msg=field)
+
+  def test_scenarios(self):
+    leads = np.zeros((2, 2), dtype=LEAD_DTYPE)
+    leads[0, 0] = (True, 30., 0., 0., 1.5, 1.0)
+    sol = solve_batch([20., 10.], 0., [20., 30.], leads)
+    assert np.all(sol.solution_status == 0)
+    assert list(sol.source) == ['lead0', 'cruise']
+
+    # brake for the stopped lead, speed up to the set speed without one
+    assert sol.x_sol[0, 1, 2] < -1.0
+    assert sol.x_sol[1, 1, 2] > 0.5
+
+  def test_failure_reported(self):
+    # the mpc resets itself after a failed solve, the batch still reports the failure
+    leads = np.zeros((2, 2), dtype=LEAD_DTYPE)
+    sol = solve_batch([float('nan'), 10.], 0., 20., leads, iterations=1)
+    assert sol.solution_status[0] != 0
+    assert sol.solution_status[1] == 0
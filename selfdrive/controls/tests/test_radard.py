@@ -0,0 +1,95 @@
+import math
+import numpy as np
+import pytest
+from types import SimpleNamespace
+
+from openpilot.common.filter_simple import FirstOrderFilter
+from openpilot.common.realtime import DT_MDL
+from openpilot.common.simple_kalman import KF1D
+from openpilot.selfdrive.controls.radard import KalmanParams, RadarTracks, _LEAD_ACCEL_TAU, MIN_VECTORIZED_TRACKS, RADAR_TO_CAMERA, \
+                                               laplacian_pdf, match_vision_to_tracks
+from openpilot.selfdrive.controls.tests.benchmark_radard import make_frames, run_previous, run_table
+
+
+class TestRadarTracks:
+  def test_update(self):
+    kalman_params = KalmanParams(DT_MDL)
+    tracks = RadarTracks(kalman_params)
+    filters: dict[int, tuple[KF1D, FirstOrderFilter]] = {}
+
+    rng = np.random.default_rng(0)
+    ids = list(range(MIN_VECTORIZED_TRACKS - 5))
+    next_id = len(ids)
+    for frame in range(500):
+      # replace a track now and then
+      if frame % 7 == 0:
+        ids[rng.integers(len(ids))] = next_id
+        next_id += 1
+      # go back and forth between updating the tracks one at a time and vectorized
+      if frame % 50 == 0:
+        if len(ids) < MIN_VECTORIZED_TRACKS:
+          ids += list(range(next_id, next_id + 10))
+          next_id += 10
+        else:
+          ids = [ids[i] for i in sorted(rng.choice(len(ids), len(ids) - 10, replace=False))]
+      v_ego = 20.0 + np.sin(frame * 0.1)
+      ar_pts = {i: [float(rng.uniform(5, 100)), float(rng.normal(0, 2)), float(rng.normal(0, 3) * (1 + frame % 3)), 1.0] for i in rng.permutation(ids)}
+      tracks.update(ar_pts, v_ego)
+
+      # filters of the tracks in the order they first appeared, same as one KF1D and FirstOrderFilter per track
+      filters = {i: filters[i] for i in filters if i in ar_pts}
+      for i, (_, _, v_rel, _) in ar_pts.items():
+        if i not in filters:
+          filters[i] = (KF1D([[v_rel + v_ego], [0.0]], kalman_params.A, kalman_params.C, kalman_params.K), FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL))
+        else:
+          filters[i][0].update(v_rel + v_ego)
+        kf, a_lead_tau = filters[i]
+        if abs(kf.x[1][0]) < 0.5:
+          a_lead_tau.x = _LEAD_ACCEL_TAU
+        else:
+          a_lead_tau.update(0.0)
+
+      assert list(tracks.identifier) == list(filters)
+      assert list(tracks.dRel) == [ar_pts[i][0] for i in filters]
+      assert list(tracks.vLeadK) == [kf.x[0][0] for kf, _ in filters.values()]
+      assert list(tracks.aLeadK) == [kf.x[1][0] for kf, _ in filters.values()]
+      assert list(tracks.aLeadTau) == [f.x for _, f in filters.values()]
+
+    tracks.update({}, 0.0)
+    assert len(tracks) == 0
+
+  @pytest.mark.parametrize("num_tracks", [4, MIN_VECTORIZED_TRACKS - 1, MIN_VECTORIZED_TRACKS, 128])
+  def test_leads(self, num_tracks):
+    # same leads as with one Track object per radar point
+    frames = make_frames(num_tracks, np.random.default_rng(num_tracks))
+    kalman_params = KalmanParams(DT_MDL)
+    assert run_previous(frames, kalman_params) == run_table(frames, kalman_params)
+
+  def test_match_across_threshold(self):
+    # the match doesn't depend on the number of tracks, also for tracks with (nearly) equal probabilities
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+      pts = rng.uniform([5., -3., -5.], [60., 3., 5.], (MIN_VECTORIZED_TRACKS - 1, 3))
+      pts[1] = pts[0]
+      pts[2] = np.nextafter(pts[0], np.inf)
+      pts[3, 0] = math.nextafter(pts[0, 0], -math.inf)
+      ar_pts = {i: [*map(float, pt), 1.0] for i, pt in enumerate(rng.permutation(pts))}
+      v_ego = float(rng.uniform(0., 30.))
+      leads = [SimpleNamespace(x=[float(pts[0, 0]) + RADAR_TO_CAMERA + rng.normal(0, std)], y=[-float(pts[0, 1])], v=[float(pts[0, 2]) + v_ego],
+                               xStd=[std], yStd=[std], vStd=[std]) for std in (0.01, 1.0, 100.0)]
+
+      per_track = RadarTracks(KalmanParams(DT_MDL))
+      per_track.update(ar_pts, v_ego)
+      # a far away track makes it vectorized, it's added last and never the most likely one
+      vectorized = RadarTracks(KalmanParams(DT_MDL))
+      vectorized.update({**ar_pts, 100: [1e4, 0.0, 0.0, 1.0]}, v_ego)
+      assert len(per_track) < MIN_VECTORIZED_TRACKS <= len(vectorized)
+
+      matches = match_vision_to_tracks(v_ego, leads, per_track)
+      assert match_vision_to_tracks(v_ego, leads, vectorized) == matches
+
+      # and it's the first of the most likely tracks, as with one Track object per radar point
+      for lead, match in zip(leads, matches, strict=True):
+        probs = [laplacian_pdf(d, lead.x[0] - RADAR_TO_CAMERA, lead.xStd[0]) * laplacian_pdf(y, -lead.y[0], lead.yStd[0]) *
+                 laplacian_pdf(v + v_ego, lead.v[0], lead.vStd[0]) for d, y, v, _ in ar_pts.values()]
+        assert match is None or match == probs.index(max(probs))
@@ -52,28 +52,49 @@ def rotate_std(rot_matrix, std_in):
 
 
 class NPQueue:
-  def __init__(self, maxlen: int, rowsize: int) -> None:
+  """
+    Fixed size queue of rows, oldest first, with O(1) append.
+    Rows are written twice, at i and i + maxlen, so the queue is always a contiguous slice of the buffer.
+  """
+  def __init__(self, maxlen: int, rowsize: int, buf: np.ndarray = None) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.empty((2 * maxlen, rowsize)) if buf is None else buf
+    assert self.buf.shape == (2 * maxlen, rowsize)
+    self.start = 0
+    self.count = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
+    return self.count
+
+  @property
+  def arr(self) -> np.ndarray:
+    """Rows oldest first, a view into the buffer"""
+    return self.buf[self.start:self.start + self.count]
 
   def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
+    i = (self.start + self.count) % self.maxlen
+    self.buf[i] = pt
+    self.buf[i + self.maxlen] = pt
+    if self.count < self.maxlen:
+      self.count += 1
     else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+      self.start = (self.start + 1) % self.maxlen
 
 
 class PointBuckets:
-  def __init__(self, x_bounds: list[tuple[float, float]], min_points: list[float], min_points_total: int, points_per_bucket: int, rowsize: int) -> None:
+  def __init__(self, x_bounds: list[tuple[float, float]], min_points: list[float], min_points_total: int, points_per_bucket: int, rowsize: int,
+               track_moments: bool = False) -> None:
     self.x_bounds = x_bounds
-    self.buckets = {bounds: NPQueue(maxlen=points_per_bucket, rowsize=rowsize) for bounds in x_bounds}
+    # all buckets share one buffer, so points can be sampled across them without concatenating
+    self.points = np.empty((len(x_bounds), 2 * points_per_bucket, rowsize))
+    self.buckets = {bounds: NPQueue(maxlen=points_per_bucket, rowsize=rowsize, buf=self.points[i]) for i, bounds in enumerate(x_bounds)}
     self.buckets_min_points = dict(zip(x_bounds, min_points, strict=True))
     self.min_points_total = min_points_total
 
+    # sum of the outer products of all points, updated as points are added and evicted
+    self.moments = np.zeros((rowsize, rowsize)) if track_moments else None
+    self.moment_updates = 0
+
   def __len__(self) -> int:
     return sum([len(v) for v in self.buckets.values()])
 
@@ -94,11 +115,35 @@ class PointBuckets:
   def add_point(self, x: float, y: float) -> None:
     raise NotImplementedError
 
+  def append(self, bounds: tuple[float, float], pt: list[float]) -> None:
+    bucket = self.buckets[bounds]
+    if self.moments is None:
+      bucket.append(pt)
+      return
+
+    if len(bucket) == bucket.maxlen:
+      self.moments -= np.outer(bucket.arr[0], bucket.arr[0])
+    bucket.append(pt)
+    self.moments += np.outer(bucket.arr[-1], bucket.arr[-1])
+
+    # recompute from the points once in a while, so rounding errors of the evictions don't accumulate
+    self.moment_updates += 1
+    if self.moment_updates >= self.points.shape[0] * self.points.shape[1]:
+      self.moments = sum((x.arr.T @ x.arr for x in self.buckets.values()), np.zeros_like(self.moments))
+      self.moment_updates = 0
+
   def get_points(self, num_points: int = None) -> Any:
-    points = np.vstack([x.arr for x in self.buckets.values()])
+    """Points of all buckets in bucket order, oldest first, or a random sample of them"""
     if num_points is None:
-      return points
-    return points[np.random.choice(np.arange(len(points)), min(len(points), num_points), replace=False)]
+      return np.concatenate([x.arr for x in self.buckets.values()])
+
+    # sample indices into the concatenated points, then gather only those from the buffer
+    counts = np.array([len(x) for x in self.buckets.values()])
+    starts = np.array([x.start for x in self.buckets.values()])
+    ends = np.cumsum(counts)
+    idxs = np.random.choice(np.arange(ends[-1]), min(ends[-1], num_points), replace=False)
+    bucket = np.searchsorted(ends, idxs, side='right')
+    return self.points[bucket, starts[bucket] + idxs - (ends - counts)[bucket]]
 
   def load_points(self, points: list[list[float]]) -> None:
     for point in points:
@@ -2,8 +2,6 @@
 import os
 import numpy as np
 import capnp
-from collections import deque
-from functools import partial
 
 import cereal.messaging as messaging
 from cereal import car, log
@@ -42,38 +40,35 @@ def masked_normalized_cross_correlation(expected_sig: np.ndarray, actual_sig: np
   """
 
   eps = np.finfo(np.float64).eps
-  expected_sig = np.asarray(expected_sig, dtype=np.float64)
-  actual_sig = np.asarray(actual_sig, dtype=np.float64)
-
-  expected_sig[~mask] = 0.0
-  actual_sig[~mask] = 0.0
+  expected_sig = np.where(mask, expected_sig, 0.0)
+  actual_sig = np.where(mask, actual_sig, 0.0)
+  mask = mask.astype(np.float64)
 
   rotated_expected_sig = expected_sig[::-1]
   rotated_mask = mask[::-1]
 
-  fft = partial(np.fft.fft, n=n)
+  # all signals are real, transform them together with real FFTs
+  actual_sig_fft, rotated_expected_sig_fft, actual_mask_fft, rotated_mask_fft, actual_squared_fft, rotated_expected_squared_fft = \
+    np.fft.rfft(np.stack([actual_sig, rotated_expected_sig, mask, rotated_mask, actual_sig ** 2, rotated_expected_sig ** 2]), n=n)
 
-  actual_sig_fft = fft(actual_sig)
-  rotated_expected_sig_fft = fft(rotated_expected_sig)
-  actual_mask_fft = fft(mask.astype(np.float64))
-  rotated_mask_fft = fft(rotated_mask.astype(np.float64))
+  number_overlap_masked_samples, masked_correlated_actual_fft, masked_correlated_expected_fft, numerator, actual_sig_denom, expected_sig_denom = \
+    np.fft.irfft(np.stack([
+      rotated_mask_fft * actual_mask_fft,
+      rotated_mask_fft * actual_sig_fft,
+      actual_mask_fft * rotated_expected_sig_fft,
+      rotated_expected_sig_fft * actual_sig_fft,
+      rotated_mask_fft * actual_squared_fft,
+      actual_mask_fft * rotated_expected_squared_fft,
+    ]), n=n)
 
-  number_overlap_masked_samples = np.fft.ifft(rotated_mask_fft * actual_mask_fft).real
   number_overlap_masked_samples[:] = np.round(number_overlap_masked_samples)
   number_overlap_masked_samples[:] = np.fmax(number_overlap_masked_samples, eps)
-  masked_correlated_actual_fft = np.fft.ifft(rotated_mask_fft * actual_sig_fft).real
-  masked_correlated_expected_fft = np.fft.ifft(actual_mask_fft * rotated_expected_sig_fft).real
 
-  numerator = np.fft.ifft(rotated_expected_sig_fft * actual_sig_fft).real
   numerator -= masked_correlated_actual_fft * masked_correlated_expected_fft / number_overlap_masked_samples
 
-  actual_squared_fft = fft(actual_sig ** 2)
-  actual_sig_denom = np.fft.ifft(rotated_mask_fft * actual_squared_fft).real
   actual_sig_denom -= masked_correlated_actual_fft ** 2 / number_overlap_masked_samples
   actual_sig_denom[:] = np.fmax(actual_sig_denom, 0.0)
 
-  rotated_expected_squared_fft = fft(rotated_expected_sig ** 2)
-  expected_sig_denom = np.fft.ifft(actual_mask_fft * rotated_expected_squared_fft).real
   expected_sig_denom -= masked_correlated_expected_fft ** 2 / number_overlap_masked_samples
   expected_sig_denom[:] = np.fmax(expected_sig_denom, 0.0)
 
@@ -90,29 +85,140 @@ def masked_normalized_cross_correlation(expected_sig: np.ndarray, actual_sig: np
   return ncc
 
 
+def normalized_correlation(sums: np.ndarray) -> np.ndarray:
+  """
+  ncc from sums over the overlapping samples where both signals are okay, rows are
+  the number of samples, sum of expected, actual, expected * actual, expected ** 2 and actual ** 2
+  """
+  eps = np.finfo(np.float64).eps
+  count, expected, actual, product, expected_squared, actual_squared = sums
+  count = np.fmax(np.round(count), eps)
+
+  numerator = product - actual * expected / count
+  actual_denom = np.fmax(actual_squared - actual ** 2 / count, 0.0)
+  expected_denom = np.fmax(expected_squared - expected ** 2 / count, 0.0)
+  denom = np.sqrt(actual_denom * expected_denom)
+
+  # zero-out samples with very small denominators
+  tol = 1e3 * eps * np.max(np.abs(denom), keepdims=True)
+  nonzero_indices = denom > tol
+
+  ncc = np.zeros_like(denom, dtype=np.float64)
+  ncc[nonzero_indices] = numerator[nonzero_indices] / denom[nonzero_indices]
+  np.clip(ncc, -1, 1, out=ncc)
+  return ncc
+
+
+class MaskedLagCorrelation:
+  """
+  masked_normalized_cross_correlation of a sliding window at a few lags, where lag k pairs expected[j] with actual[j + k].
+  The sums over the sample pairs of each lag are updated as samples enter and leave the window, so an update is O(lags).
+  """
+  def __init__(self, lags: np.ndarray, window_len: int):
+    self.lags = lags
+    self.window_len = window_len
+    self.sums = np.zeros((6, len(lags)))
+    self.updates = 0
+
+    # after a sample is appended, the evicted sample's pairs are at |k| - 1 (itself at lag 0) and the new sample's at -1 - |k|
+    k = np.abs(lags)
+    self.pos, self.neg = lags >= 0, lags < 0
+    self.old_idx = np.maximum(k - 1, 0)
+    self.old_actual_evicted = ~self.pos | (k == 0)
+    self.old_at_lag_zero = k == 0
+    self.new_idx = -1 - k
+
+    # (evicted pairs, new pairs) x lags, reused every update
+    self.expected = np.empty((2, len(lags)))
+    self.actual = np.empty((2, len(lags)))
+    self.okay = np.empty((2, len(lags)), dtype=bool)
+    self.pair_buf = np.empty((6, 2, len(lags)))
+
+  @staticmethod
+  def pair_sums(expected: np.ndarray, actual: np.ndarray, okay: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    out = np.empty((6, *expected.shape)) if out is None else out
+    w, we, wa, wea, wee, waa = out
+    w[:] = okay
+    np.multiply(w, expected, out=we)
+    np.multiply(w, actual, out=wa)
+    np.multiply(we, actual, out=wea)
+    np.multiply(we, expected, out=wee)
+    np.multiply(wa, actual, out=waa)
+    return out
+
+  def recompute(self, desired: np.ndarray, actual: np.ndarray, okay: np.ndarray):
+    n = len(desired)
+    for i, k in enumerate(self.lags):
+      e, a = slice(max(0, -k), min(n, n - k)), slice(max(0, k), min(n, n + k))
+      self.sums[:, i] = self.pair_sums(desired[e], actual[a], okay[e] & okay[a]).sum(axis=1)
+    self.updates = 0
+
+  def update(self, evicted: tuple[float, float, bool], desired: np.ndarray, actual: np.ndarray, okay: np.ndarray):
+    """Updates with the window after a sample was appended, the window before it started with the evicted sample"""
+    evicted_desired, evicted_actual, evicted_okay = evicted
+    e, a, w = self.expected, self.actual, self.okay
+
+    np.take(desired, self.old_idx, out=e[0])
+    e[0, self.pos] = evicted_desired
+    np.take(desired, self.new_idx, out=e[1])
+    e[1, self.neg] = desired[-1]
+
+    np.take(actual, self.old_idx, out=a[0])
+    a[0, self.old_actual_evicted] = evicted_actual
+    np.take(actual, self.new_idx, out=a[1])
+    a[1, self.pos] = actual[-1]
+
+    np.take(okay, self.old_idx, out=w[0])
+    w[0, self.old_at_lag_zero] = True
+    w[0] &= evicted_okay
+    np.take(okay, self.new_idx, out=w[1])
+    w[1] &= okay[-1]
+
+    pair_sums = self.pair_sums(e, a, w, out=self.pair_buf)
+    self.sums += pair_sums[:, 1]
+    self.sums -= pair_sums[:, 0]
+
+    # recompute once per window, so rounding errors don't accumulate
+    self.updates += 1
+    if self.updates >= self.window_len:
+      self.recompute(desired, actual, okay)
+
+  def get(self) -> np.ndarray:
+    return normalized_correlation(self.sums)
+
+
 class Points:
-  def __init__(self, num_points: int):
-    self.times = deque[float]([0.0] * num_points, maxlen=num_points)
-    self.okay = deque[bool]([False] * num_points, maxlen=num_points)
-    self.desired = deque[float]([0.0] * num_points, maxlen=num_points)
-    self.actual = deque[float]([0.0] * num_points, maxlen=num_points)
+  """Sliding window of samples, each written at i and i + num_points, so the window is always a contiguous view"""
+  def __init__(self, num_points: int, lags: np.ndarray):
+    self.times = np.zeros(2 * num_points)
+    self.okay = np.zeros(2 * num_points, dtype=bool)
+    self.desired = np.zeros(2 * num_points)
+    self.actual = np.zeros(2 * num_points)
+    self.start = 0
+    self.correlation = MaskedLagCorrelation(lags, num_points)
 
   @property
   def num_points(self):
-    return len(self.desired)
+    return len(self.desired) // 2
 
   @property
   def num_okay(self):
-    return np.count_nonzero(self.okay)
+    return np.count_nonzero(self.okay[self.start:self.start + self.num_points])
 
   def update(self, t: float, desired: float, actual: float, okay: bool):
-    self.times.append(t)
-    self.okay.append(okay)
-    self.desired.append(desired)
-    self.actual.append(actual)
+    n, i = self.num_points, self.start
+    evicted = self.desired[i], self.actual[i], self.okay[i]
+
+    for arr, value in ((self.times, t), (self.okay, okay), (self.desired, desired), (self.actual, actual)):
+      arr[i] = arr[i + n] = value
+    self.start = (i + 1) % n
+
+    _, desired_window, actual_window, okay_window = self.get()
+    self.correlation.update(evicted, desired_window, actual_window, okay_window)
 
   def get(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-    return np.array(self.times), np.array(self.desired), np.array(self.actual), np.array(self.okay)
+    window = slice(self.start, self.start + self.num_points)
+    return self.times[window], self.desired[window], self.actual[window], self.okay[window]
 
 
 class BlockAverage:
@@ -196,7 +302,9 @@ class LateralLagEstimator:
 
   def reset(self, initial_lag: float, valid_blocks: int):
     window_len = int(self.window_sec / self.dt)
-    self.points = Points(window_len)
+    # lags from 0 to MAX_LAG, with a border on both sides for the confidence
+    max_lag_samples = int(MAX_LAG / self.dt)
+    self.points = Points(window_len, np.arange(-CORR_BORDER_OFFSET, max_lag_samples + CORR_BORDER_OFFSET))
     self.block_avg = BlockAverage(self.block_count, self.block_size, valid_blocks, initial_lag)
 
   def get_msg(self, valid: bool, debug: bool = False) -> capnp._DynamicStructBuilder:
@@ -292,14 +400,14 @@ class LateralLagEstimator:
     if not self.points_enough():
       return
 
-    times, desired, actual, okay = self.points.get()
+    times, _, _, okay = self.points.get()
     # check if there are any new valid data points since the last update
     is_valid = self.points_valid()
     if self.last_estimate_t != 0 and times[0] <= self.last_estimate_t:
       new_values_start_idx = next(-i for i, t in enumerate(reversed(times)) if t <= self.last_estimate_t)
       is_valid = is_valid and not (new_values_start_idx == 0 or not np.any(okay[new_values_start_idx:]))
 
-    delay, corr, confidence = self.actuator_delay(desired, actual, okay, self.dt, MAX_LAG)
+    delay, corr, confidence = self.lag_from_ncc(self.points.correlation.get(), self.dt)
     if corr < self.min_ncc or confidence < self.min_confidence or not is_valid:
       return
 
@@ -315,10 +423,13 @@ class LateralLagEstimator:
     ncc = masked_normalized_cross_correlation(expected_sig, actual_sig, mask, padded_size)
 
     # only consider lags from 0 to max_lag
-    roi = np.s_[len(expected_sig) - 1: len(expected_sig) - 1 + max_lag_samples]
-    extended_roi = np.s_[roi.start - CORR_BORDER_OFFSET: roi.stop + CORR_BORDER_OFFSET]
-    roi_ncc = ncc[roi]
-    extended_roi_ncc = ncc[extended_roi]
+    extended_roi = np.s_[len(expected_sig) - 1 - CORR_BORDER_OFFSET: len(expected_sig) - 1 + max_lag_samples + CORR_BORDER_OFFSET]
+    return LateralLagEstimator.lag_from_ncc(ncc[extended_roi], dt)
+
+  @staticmethod
+  def lag_from_ncc(extended_roi_ncc: np.ndarray, dt: float) -> tuple[float, float, float]:
+    """Lag, correlation and confidence from the ncc at lags from -CORR_BORDER_OFFSET to max lag + CORR_BORDER_OFFSET"""
+    roi_ncc = extended_roi_ncc[CORR_BORDER_OFFSET:-CORR_BORDER_OFFSET]
 
     max_corr_index = np.argmax(roi_ncc)
     corr = roi_ncc[max_corr_index]
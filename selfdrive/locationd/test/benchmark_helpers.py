@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compares the ring buffer NPQueue and PointBuckets with the previous implementation,
+which grew with np.append, shifted the whole array when full and stacked all buckets for every sample.
+"""
+import time
+import numpy as np
+
+from openpilot.selfdrive.locationd.torqued import TorqueBuckets, STEER_BUCKET_BOUNDS, MIN_BUCKET_POINTS, POINTS_PER_BUCKET, \
+                                                 MIN_POINTS_TOTAL, FIT_POINTS_TOTAL
+
+N = 20000
+N_SAMPLES = 200
+
+
+class ShiftingNPQueue:
+  def __init__(self, maxlen: int, rowsize: int) -> None:
+    self.maxlen = maxlen
+    self.arr = np.empty((0, rowsize))
+
+  def __len__(self) -> int:
+    return len(self.arr)
+
+  def append(self, pt: list[float]) -> None:
+    if len(self.arr) < self.maxlen:
+      self.arr = np.append(self.arr, [pt], axis=0)
+    else:
+      self.arr[:-1] = self.arr[1:]
+      self.arr[-1] = pt
+
+
+class StackingTorqueBuckets(TorqueBuckets):
+  def __init__(self, *args, **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self.buckets = {bounds: ShiftingNPQueue(maxlen=POINTS_PER_BUCKET, rowsize=3) for bounds in self.x_bounds}
+
+  def get_points(self, num_points: int = None):
+    points = np.vstack([x.arr for x in self.buckets.values()])
+    if num_points is None:
+      return points
+    return points[np.random.choice(np.arange(len(points)), min(len(points), num_points), replace=False)]
+
+
+def benchmark(cls, xs, ys):
+  points = cls(x_bounds=STEER_BUCKET_BOUNDS, min_points=MIN_BUCKET_POINTS, min_points_total=MIN_POINTS_TOTAL,
+               points_per_bucket=POINTS_PER_BUCKET, rowsize=3)
+
+  t = time.perf_counter()
+  for x, y in zip(xs, ys, strict=True):
+    points.add_point(x, y)
+  t_add = (time.perf_counter() - t) / len(xs)
+
+  np.random.seed(0)
+  t = time.perf_counter()
+  for _ in range(N_SAMPLES):
+    sample = points.get_points(FIT_POINTS_TOTAL)
+  t_sample = (time.perf_counter() - t) / N_SAMPLES
+  return t_add, t_sample, sample
+
+
+if __name__ == "__main__":
+  rng = np.random.default_rng(0)
+  xs, ys = rng.uniform(-0.5, 0.5, N).tolist(), rng.normal(size=N).tolist()
+
+  results = {name: benchmark(cls, xs, ys) for name, cls in [("previous", StackingTorqueBuckets), ("ring buffer", TorqueBuckets)]}
+  np.testing.assert_array_equal(results["previous"][2], results["ring buffer"][2])
+
+  print(f"{N} points, {len(STEER_BUCKET_BOUNDS)} buckets of {POINTS_PER_BUCKET}, samples of {FIT_POINTS_TOTAL}")
+  for name, (t_add, t_sample, _) in results.items():
+    print(f"  {name:>12}: add_point {t_add * 1e6:6.2f} us, get_points {t_sample * 1e6:7.1f} us")
@@ -4,8 +4,9 @@ import time
 import pytest
 
 from cereal import messaging, log, car
-from openpilot.selfdrive.locationd.lagd import LateralLagEstimator, retrieve_initial_lag, masked_normalized_cross_correlation, \
+from openpilot.selfdrive.locationd.lagd import LateralLagEstimator, Points, retrieve_initial_lag, masked_normalized_cross_correlation, \
                                                BLOCK_NUM_NEEDED, BLOCK_SIZE, MIN_OKAY_WINDOW_SEC
+from openpilot.selfdrive.locationd.helpers import fft_next_good_size
 from openpilot.selfdrive.test.process_replay.migration import migrate, migrate_carParams
 from openpilot.selfdrive.locationd.test.test_locationd_scenarios import TEST_ROUTE
 from openpilot.common.params import Params
@@ -86,6 +87,19 @@ class TestLagd:
     corr = masked_normalized_cross_correlation(desired_sig, actual_sig, mask, 200)[len(desired_sig) - 1:len(desired_sig) + 20]
     assert np.argmax(corr) in range(lag_frames - MAX_ERR_FRAMES, lag_frames + MAX_ERR_FRAMES + 1)
 
+  def test_incremental_ncc(self):
+    window, lags = 300, np.arange(-5, 25)
+    points = Points(window, lags)
+
+    # the window starts out with zeros, then slides through the signal
+    # with almost no samples, the FFT ncc is rounding noise where the sums are exactly 0
+    for i in range(3 * window):
+      points.update(i * DT, np.sin(i * 0.3) + np.random.normal(0, 0.1), np.sin((i - 7) * 0.3), random.uniform(0, 1) < 0.7)
+      if i > window // 4 and i % 97 == 0:
+        _, desired, actual, okay = points.get()
+        ncc = masked_normalized_cross_correlation(desired, actual, okay, fft_next_good_size(window + lags[-1] + 1))
+        np.testing.assert_allclose(points.correlation.get(), ncc[window - 1 + lags], atol=1e-9)
+
   def test_empty_estimator(self):
     mocked_CP = car.CarParams(steerActuatorDelay=0.8)
     estimator = LateralLagEstimator(mocked_CP, DT)
@@ -1,5 +1,7 @@
+import numpy as np
+
 from cereal import car
-from openpilot.selfdrive.locationd.torqued import TorqueEstimator
+from openpilot.selfdrive.locationd.torqued import TorqueEstimator, TorqueBuckets, STEER_BUCKET_BOUNDS, MIN_BUCKET_POINTS
 
 
 def test_cal_percent():
@@ -23,3 +25,40 @@ def test_cal_percent():
 
   msg = est.get_msg()
   assert msg.liveTorqueParameters.calPerc == 100
+
+
+def test_point_buckets():
+  points = TorqueBuckets(x_bounds=STEER_BUCKET_BOUNDS, min_points=MIN_BUCKET_POINTS, min_points_total=100, points_per_bucket=50, rowsize=3)
+  added: dict[tuple[float, float], list] = {bounds: [] for bounds in STEER_BUCKET_BOUNDS}
+
+  rng = np.random.default_rng(0)
+  for x, y in zip(rng.uniform(-0.5, 0.5, 1000), rng.normal(size=1000), strict=True):
+    points.add_point(x, y)
+    bounds = next(b for b in STEER_BUCKET_BOUNDS if b[0] <= x < b[1])
+    added[bounds] = (added[bounds] + [[x, 1.0, y]])[-50:]
+
+    if rng.random() < 0.05:
+      # same points and order as stacking the buckets, same random sample
+      expected = np.array([p for b in STEER_BUCKET_BOUNDS for p in added[b]])
+      np.testing.assert_array_equal(points.get_points(), expected)
+      np.random.seed(0)
+      sample = points.get_points(40)
+      np.random.seed(0)
+      np.testing.assert_array_equal(sample, expected[np.random.choice(np.arange(len(expected)), min(len(expected), 40), replace=False)])
+
+
+def test_incremental_fit():
+  est = TorqueEstimator(car.CarParams(), incremental_fit=True)
+  est_svd = TorqueEstimator(car.CarParams())
+  est_svd.fit_points = 2 ** 31  # fit all points
+
+  # enough points for the buckets to evict the oldest ones
+  rng = np.random.default_rng(0)
+  steer = rng.uniform(-0.5, 0.5, 15000)
+  lat_acc = 1.7 * steer + 0.05 + rng.normal(0, 0.2, len(steer))
+  for i, (x, y) in enumerate(zip(steer, lat_acc, strict=True)):
+    est.filtered_points.add_point(x, y)
+    est_svd.filtered_points.add_point(x, y)
+
+    if i % 5000 == 4999:
+      np.testing.assert_allclose(est.estimate_params(), est_svd.estimate_params(), rtol=1e-6)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
+import os
 import numpy as np
-from collections import deque, defaultdict
 
 import cereal.messaging as messaging
 from cereal import car, log
@@ -9,7 +9,7 @@ from openpilot.common.params import Params
 from openpilot.common.realtime import config_realtime_process, DT_MDL
 from openpilot.common.filter_simple import FirstOrderFilter
 from openpilot.common.swaglog import cloudlog
-from openpilot.selfdrive.locationd.helpers import PointBuckets, ParameterEstimator, PoseCalibrator, Pose
+from openpilot.selfdrive.locationd.helpers import NPQueue, PointBuckets, ParameterEstimator, PoseCalibrator, Pose
 from openpilot.sunnypilot.livedelay.helpers import get_lat_delay
 
 HISTORY = 5  # secs
@@ -46,17 +46,19 @@ class TorqueBuckets(PointBuckets):
   def add_point(self, x, y):
     for bound_min, bound_max in self.x_bounds:
       if (x >= bound_min) and (x < bound_max):
-        self.buckets[(bound_min, bound_max)].append([x, 1.0, y])
+        self.append((bound_min, bound_max), [x, 1.0, y])
         break
 
 
 class TorqueEstimator(ParameterEstimator):
-  def __init__(self, CP, decimated=False, track_all_points=False):
+  def __init__(self, CP, decimated=False, track_all_points=False, incremental_fit=False):
     super().__init__()
     self.CP = CP
     self.hist_len = int(HISTORY / DT_MDL)
     self.lag = 0.0
     self.track_all_points = track_all_points  # for offline analysis, without max lateral accel or max steer torque filters
+    # fit all points from running sums of their outer products, instead of a sample of them
+    self.incremental_fit = incremental_fit
     if decimated:
       self.min_bucket_points = MIN_BUCKET_POINTS / 10
       self.min_points_total = MIN_POINTS_TOTAL_QLOG
@@ -137,15 +139,24 @@ class TorqueEstimator(ParameterEstimator):
   def reset(self):
     self.resets += 1.0
     self.decay = MIN_FILTER_DECAY
-    self.raw_points = defaultdict(lambda: deque(maxlen=self.hist_len))
+    # rows of (t, lat_active), (t, steer_torque) and (t, vego, steer_override)
+    self.raw_points = {
+      "carControl": NPQueue(maxlen=self.hist_len, rowsize=2),
+      "carOutput": NPQueue(maxlen=self.hist_len, rowsize=2),
+      "carState": NPQueue(maxlen=self.hist_len, rowsize=3),
+    }
     self.filtered_points = TorqueBuckets(x_bounds=STEER_BUCKET_BOUNDS,
                                          min_points=self.min_bucket_points,
                                          min_points_total=self.min_points_total,
                                          points_per_bucket=POINTS_PER_BUCKET,
-                                         rowsize=3)
+                                         rowsize=3,
+                                         track_moments=self.incremental_fit)
     self.all_torque_points = []
 
   def estimate_params(self):
+    if self.incremental_fit:
+      return self.estimate_params_from_moments()
+
     points = self.filtered_points.get_points(self.fit_points)
     # total least square solution as both x and y are noisy observations
     # this is empirically the slope of the hysteresis parallelogram as opposed to the line through the diagonals
@@ -159,6 +170,25 @@ class TorqueEstimator(ParameterEstimator):
       slope = offset = friction_coeff = np.nan
     return slope, offset, friction_coeff
 
+  def estimate_params_from_moments(self):
+    # same total least squares solution as the svd of all points, the right singular vectors are the eigenvectors of points.T @ points
+    moments = self.filtered_points.moments
+    try:
+      _, v = np.linalg.eigh(moments)
+      slope, offset = -v[0:2, 0] / v[2, 0]
+
+      # std of the points across the fitted line, from the means and second moments of (x, y)
+      n = moments[1, 1]
+      mean = moments[[0, 2], 1] / n
+      second = moments[np.ix_([0, 2], [0, 2])] / n
+      direction = slope2rot(slope)[:, 1]
+      var = direction @ second @ direction - (direction @ mean) ** 2
+      friction_coeff = np.sqrt(max(var, 0.0)) * FRICTION_FACTOR
+    except np.linalg.LinAlgError as e:
+      cloudlog.exception(f"Error computing live torque params: {e}")
+      slope = offset = friction_coeff = np.nan
+    return slope, offset, friction_coeff
+
   def update_params(self, params):
     self.decay = min(self.decay + DT_MDL, MAX_FILTER_DECAY)
     for param, value in params.items():
@@ -167,23 +197,19 @@ class TorqueEstimator(ParameterEstimator):
 
   def handle_log(self, t, which, msg):
     if which == "carControl":
-      self.raw_points["carControl_t"].append(t + self.lag)
-      self.raw_points["lat_active"].append(msg.latActive)
+      self.raw_points["carControl"].append([t + self.lag, msg.latActive])
     elif which == "carOutput":
-      self.raw_points["carOutput_t"].append(t + self.lag)
-      self.raw_points["steer_torque"].append(-msg.actuatorsOutput.torque)
+      self.raw_points["carOutput"].append([t + self.lag, -msg.actuatorsOutput.torque])
     elif which == "carState":
-      self.raw_points["carState_t"].append(t + self.lag)
       # TODO: check if high aEgo affects resulting lateral accel
-      self.raw_points["vego"].append(msg.vEgo)
-      self.raw_points["steer_override"].append(msg.steeringPressed)
+      self.raw_points["carState"].append([t + self.lag, msg.vEgo, msg.steeringPressed])
     elif which == "liveCalibration":
       self.calibrator.feed_live_calib(msg)
     elif which == "liveDelay":
       self.lag = get_lat_delay(self.params, msg.lateralDelay)
     # calculate lateral accel from past steering torque
     elif which == "livePose":
-      if len(self.raw_points['steer_torque']) == self.hist_len:
+      if len(self.raw_points['carOutput']) == self.hist_len:
         device_pose = Pose.from_live_pose(msg)
         calibrated_pose = self.calibrator.build_calibrated_pose(device_pose)
         angular_velocity_calibrated = calibrated_pose.angular_velocity
@@ -191,12 +217,13 @@ class TorqueEstimator(ParameterEstimator):
         yaw_rate = angular_velocity_calibrated.yaw
         roll = device_pose.orientation.roll
         # check lat active up to now (without lag compensation)
+        car_control, car_output, car_state = (self.raw_points[s].arr for s in ("carControl", "carOutput", "carState"))
         lat_active = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL),
-                               self.raw_points['carControl_t'], self.raw_points['lat_active']).astype(bool)
+                               car_control[:, 0], car_control[:, 1]).astype(bool)
         steer_override = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL),
-                                   self.raw_points['carState_t'], self.raw_points['steer_override']).astype(bool)
-        vego = np.interp(t, self.raw_points['carState_t'], self.raw_points['vego'])
-        steer = np.interp(t, self.raw_points['carOutput_t'], self.raw_points['steer_torque']).item()
+                                   car_state[:, 0], car_state[:, 2]).astype(bool)
+        vego = np.interp(t, car_state[:, 0], car_state[:, 1])
+        steer = np.interp(t, car_output[:, 0], car_output[:, 1]).item()
         lateral_acc = (vego * yaw_rate) - (np.sin(roll) * ACCELERATION_DUE_TO_GRAVITY).item()
         if all(lat_active) and not any(steer_override) and (vego > MIN_VEL) and (abs(steer) > STEER_MIN_THRESHOLD):
           if abs(lateral_acc) <= LAT_ACC_THRESHOLD:
@@ -244,13 +271,14 @@ class TorqueEstimator(ParameterEstimator):
 
 
 def main(demo=False):
+  INCREMENTAL_FIT = bool(int(os.getenv("TORQUED_INCREMENTAL_FIT", "0")))
   config_realtime_process([0, 1, 2, 3], 5)
 
   pm = messaging.PubMaster(['liveTorqueParameters'])
   sm = messaging.SubMaster(['carControl', 'carOutput', 'carState', 'liveCalibration', 'livePose', 'liveDelay'], poll='livePose')
 
   params = Params()
-  estimator = TorqueEstimator(messaging.log_from_bytes(params.get("CarParams", block=True), car.CarParams))
+  estimator = TorqueEstimator(messaging.log_from_bytes(params.get("CarParams", block=True), car.CarParams), incremental_fit=INCREMENTAL_FIT)
 
   while True:
     sm.update()
@@ -4,21 +4,20 @@ import math
 import capnp
 import numbers
 import dictdiffer
-from collections import Counter
+import numpy as np
+from collections import Counter, defaultdict
+from typing import Any
 
 from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.log_time_series import RaggedArray, msgs_to_columns
 
 EPSILON = sys.float_info.epsilon
+FLOAT_TYPES = ("float32", "float64")
 
 
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key in ignore:
+def _clear_fields(msg, ignore_paths):
+  for keys in ignore_paths:
     attr = msg
-    keys = key.split(".")
-    if msg.which() != keys[0] and len(keys) > 1:
-      continue
-
     for k in keys[:-1]:
       # indexing into list
       if k.isdigit():
@@ -39,6 +38,87 @@ def remove_ignored_fields(msg, ignore):
   return msg
 
 
+def _ignore_paths(ignore, which):
+  # fields of other message types don't apply, top level fields like logMonoTime apply to all
+  return [keys for keys in (key.split(".") for key in ignore) if keys[0] == which or len(keys) == 1]
+
+
+def remove_ignored_fields(msg, ignore):
+  msg = msg.as_builder()
+  return _clear_fields(msg, _ignore_paths(ignore, msg.which()))
+
+
+def _outside_tolerance(diff, tolerance):
+  # Dictdiffer only supports relative tolerance, we also want to check for absolute
+  # TODO: add this to dictdiffer
+  try:
+    if diff[0] == "change":
+      a, b = diff[2]
+      finite = math.isfinite(a) and math.isfinite(b)
+      if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+        return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+  except TypeError:
+    pass
+  return True
+
+
+def _float_paths(schema, prefix=()):
+  # float fields and lists of floats, through nested structs and groups outside of unions
+  paths = []
+  for name in schema.non_union_fields:
+    field = schema.fields[name]
+    typ = field.proto.slot.type if field.proto.which() == "slot" else None
+    if typ is None or typ.which() == "struct":
+      paths.extend(_float_paths(field.schema, (*prefix, name)))
+    elif typ.which() in FLOAT_TYPES or (typ.which() == "list" and typ.list.elementType.which() in FLOAT_TYPES):
+      paths.append([*prefix, name])
+  return paths
+
+
+def _outside_tolerance_arr(a, b, tolerance):
+  with np.errstate(invalid="ignore"):
+    outside = ~(np.isfinite(a) & np.isfinite(b))
+    outside |= np.abs(a - b) > np.maximum(tolerance, tolerance * np.maximum(np.abs(a), np.abs(b)))
+  return (a != b) & outside
+
+
+def _rows_outside_tolerance(col1, col2, tolerance):
+  if isinstance(col1, np.ndarray) and isinstance(col2, np.ndarray) and col1.shape == col2.shape:
+    return _outside_tolerance_arr(col1, col2, tolerance).reshape(len(col1), -1).any(axis=1)
+
+  # lists of different lengths are always outside of tolerance, the others are compared by element
+  col1, col2 = (c if isinstance(c, RaggedArray) else RaggedArray.from_2d(c) for c in (col1, col2))
+  outside = np.diff(col1.offsets) != np.diff(col2.offsets)
+  same = np.flatnonzero(~outside)
+  a, b = col1.take(same), col2.take(same)
+  rows = np.repeat(same, np.diff(a.offsets))
+  outside[rows[_outside_tolerance_arr(a.values, b.values, tolerance)]] = True
+  return outside
+
+
+def _find_outside_tolerance(msgs, float_paths, tolerance):
+  """
+  Returns which of the (msg1, msg2) pairs of one message type may have a difference outside of tolerance.
+  Float fields of all pairs are compared as columns, pairs with a difference in any other field are always returned.
+  """
+  which = msgs[0][0].which()
+  outside = np.zeros(len(msgs), dtype=bool)
+  if len(float_paths):
+    projection = {which: ["/".join(path) for path in float_paths]}
+    columns1, columns2 = (msgs_to_columns((m[k].as_reader() for m in msgs), projection)[which] for k in (0, 1))
+    for name in projection[which]:
+      outside |= _rows_outside_tolerance(columns1[name], columns2[name], tolerance)
+
+  # anything else has to be equal
+  clear_paths = [[which, *path] for path in float_paths]
+  for j, (msg1, msg2) in enumerate(msgs):
+    if not outside[j]:
+      msg1 = _clear_fields(msg1.as_reader().as_builder(), clear_paths)
+      msg2 = _clear_fields(msg2.as_reader().as_builder(), clear_paths)
+      outside[j] = msg1.to_bytes() != msg2.to_bytes()
+  return np.flatnonzero(outside).tolist()
+
+
 def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
   if ignore_fields is None:
     ignore_fields = []
@@ -56,36 +136,41 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter(m.which() for m in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
-  diff = []
-  for msg1, msg2 in zip(log1, log2, strict=True):
-    if msg1.which() != msg2.which():
+  # ignored and float fields are resolved once per message type
+  ignore_paths: dict[str, list[list[str]]] = {}
+  float_paths: dict[str, list[list[str]]] = {}
+  # messages that differ after removing ignored fields, by type
+  differing: defaultdict[str, list[tuple[int, Any, Any]]] = defaultdict(list)
+  for i, (msg1, msg2) in enumerate(zip(log1, log2, strict=True)):
+    which = msg1.which()
+    if which != msg2.which():
       raise Exception("msgs not aligned between logs")
 
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
+    if which not in ignore_paths:
+      ignore_paths[which] = _ignore_paths(ignore_fields, which)
+      field = msg1.schema.fields[which]
+      is_struct = field.proto.which() == "group" or field.proto.slot.type.which() == "struct"
+      float_paths[which] = _float_paths(field.schema) if is_struct else []
+    msg1 = _clear_fields(msg1.as_builder(), ignore_paths[which])
+    msg2 = _clear_fields(msg2.as_builder(), ignore_paths[which])
 
     if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
-
-      diff.extend(dd)
+      differing[which].append((i, msg1, msg2))
+
+  # small numeric differences are the most common, only diff the dicts of messages with differences outside of tolerance
+  to_diff = []
+  for which, msgs in differing.items():
+    flagged = _find_outside_tolerance([(msg1, msg2) for _, msg1, msg2 in msgs], float_paths[which], tolerance)
+    to_diff.extend(msgs[j] for j in flagged)
+  to_diff.sort(key=lambda m: m[0])
+
+  diff = []
+  for _, msg1, msg2 in to_diff:
+    msg1_dict = msg1.as_reader().to_dict(verbose=True)
+    msg2_dict = msg2.as_reader().to_dict(verbose=True)
+
+    dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
+    diff.extend(d for d in dd if _outside_tolerance(d, tolerance))
   return diff
 
 
@@ -61,7 +61,8 @@ def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
   for i, msg in enumerate(lr):
     grouped[msg.which()].append(i)
 
-  replace_ops, add_ops, del_ops = [], [], []
+  replace_ops, add_ops = [], []
+  del_ops: set[int] = set()
   for migration in migration_funcs:
     assert hasattr(migration, "inputs") and hasattr(migration, "product"), "Migration functions must use @migration decorator"
     if migration.product in grouped: # skip if product already exists
@@ -72,15 +73,15 @@ def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
     r_ops, a_ops, d_ops = migration(msg_gen)
     replace_ops.extend(r_ops)
     add_ops.extend(a_ops)
-    del_ops.extend(d_ops)
+    del_ops.update(d_ops)
 
   for index, msg in replace_ops:
     lr[index] = msg
-  for index in sorted(del_ops, reverse=True):
-    del lr[index]
-  for msg in add_ops:
-    lr.append(msg)
-  lr = sorted(lr, key=lambda x: x.logMonoTime)
+  # one pass instead of shifting the rest of the list for every deleted message
+  if del_ops:
+    lr = [msg for index, msg in enumerate(lr) if index not in del_ops]
+  lr.extend(add_ops)
+  lr.sort(key=lambda x: x.logMonoTime)
 
   return lr
 
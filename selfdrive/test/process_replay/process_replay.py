@@ -4,6 +4,7 @@ import time
 import copy
 import heapq
 import signal
+import struct
 from collections import Counter
 from dataclasses import dataclass, field
 from itertools import islice
@@ -11,10 +12,12 @@ from typing import Any
 from collections.abc import Callable, Iterable
 from tqdm import tqdm
 import capnp
+import numpy as np
 from openpilot.system.hardware.hw import Paths
 
 import cereal.messaging as messaging
 from cereal import car
+from cereal.framing import root_data_section
 from cereal.services import SERVICE_LIST
 from msgq.visionipc import VisionIpcServer, get_endpoint_name as vipc_get_endpoint_name
 from opendbc.car.can_definitions import CanData
@@ -37,6 +40,18 @@ PROC_REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
 FAKEDATA = os.path.join(PROC_REPLAY_DIR, "fakedata/")
 
 
+def _set_log_mono_time(dat: bytes, log_mono_time: int) -> bytes | None:
+  """Sets logMonoTime of a serialized Event without rebuilding it, None if the message layout doesn't allow it"""
+  section = root_data_section(dat)
+  if section is None:
+    return None
+
+  # logMonoTime is the first word of the data section
+  buf = bytearray(dat)
+  struct.pack_into("<Q", buf, section[0], log_mono_time)
+  return bytes(buf)
+
+
 class LauncherWithCapture:
   def __init__(self, capture: ProcessOutputCapture, launcher: Callable):
     self.capture = capture
@@ -138,13 +153,33 @@ class ProcessConfig:
       self.main_pub = self.should_recv_callback.trigger_msg_type
 
 
+@dataclass
+class ReplayStats:
+  wall_time: float = 0.
+  msg_count: int = 0
+  # time to publish the inputs of a cycle and collect the outputs of the previous one
+  step_times: list[float] = field(default_factory=list)
+
+  @property
+  def throughput(self) -> float:
+    return self.msg_count / self.wall_time if self.wall_time > 0 else 0.
+
+  def step_latency(self, percentile: float) -> float:
+    return float(np.percentile(self.step_times, percentile)) if len(self.step_times) else 0.
+
+
 class ProcessContainer:
   def __init__(self, cfg: ProcessConfig):
     self.prefix = OpenpilotPrefix(create_dirs_on_enter=False, clean_dirs_on_exit=False)
     self.cfg = copy.deepcopy(cfg)
     self.process = copy.deepcopy(managed_processes[cfg.proc_name])
+    self.launcher = self.process.launcher
     self.msg_queue: list[capnp._DynamicStructReader] = []
+    # serialized messages by id, to publish them without rebuilding. shared by the containers of a replay
+    self.msg_bytes: dict[int, bytes | memoryview] = {}
     self.cnt = 0
+    self.stats = ReplayStats()
+    self.start_time = 0.
     self.pm: messaging.PubMaster | None = None
     self.sockets: list[messaging.SubSocket] | None = None
     self.rc: ReplayContext | None = None
@@ -164,6 +199,11 @@ class ProcessContainer:
   def subs(self) -> list[str]:
     return self.cfg.subs
 
+  @property
+  def reusable(self) -> bool:
+    # vision buffers and publishers changed by config callbacks are set up for the log of one replay
+    return len(self.cfg.vision_pubs) == 0 and self.cfg.config_callback is None
+
   def _clean_env(self):
     for k in self.environ_config.keys():
       if k in os.environ:
@@ -211,8 +251,9 @@ class ProcessContainer:
     self.cfg.vision_pubs = [meta.camera_state for meta in streams_metas if meta.camera_state in self.cfg.vision_pubs]
 
   def _start_process(self):
+    self.process.launcher = self.launcher
     if self.capture is not None:
-      self.process.launcher = LauncherWithCapture(self.capture, self.process.launcher)
+      self.process.launcher = LauncherWithCapture(self.capture, self.launcher)
     self.process.prepare()
     self.process.start()
 
@@ -221,6 +262,12 @@ class ProcessContainer:
     all_msgs: LogIterable, frs: dict[str, FrameReader] | None,
     fingerprint: str | None, capture_output: bool
   ):
+    self.msg_queue = []
+    self.msg_bytes = {}
+    self.cnt = 0
+    self.stats = ReplayStats()
+    self.start_time = time.monotonic()
+
     with self.prefix as p:
       self.prefix.create_dirs()
       self._setup_env(params_config, environ_config)
@@ -229,44 +276,71 @@ class ProcessContainer:
         params = Params()
         self.cfg.config_callback(params, self.cfg, all_msgs)
 
-      self.rc = ReplayContext(self.cfg)
-      self.rc.open_context()
+      if self.rc is None:
+        self.rc = ReplayContext(self.cfg)
+        self.rc.open_context()
 
-      self.pm = messaging.PubMaster(self.cfg.pubs)
-      self.sockets = [messaging.sub_sock(s, timeout=100) for s in self.cfg.subs]
+        self.pm = messaging.PubMaster(self.cfg.pubs)
+        self.sockets = [messaging.sub_sock(s, timeout=100) for s in self.cfg.subs]
+      else:
+        # warm container, only the process is started again. other containers may have changed the fake prefix since
+        messaging.toggle_fake_events(True)
+        messaging.set_fake_prefix(self.cfg.proc_name)
 
       if len(self.cfg.vision_pubs) != 0:
         assert frs is not None
         self._setup_vision_ipc(all_msgs, frs)
         assert self.vipc_server is not None
 
-      if capture_output:
-        self.capture = ProcessOutputCapture(self.cfg.proc_name, p.prefix)
+      self.capture = ProcessOutputCapture(self.cfg.proc_name, p.prefix) if capture_output else None
 
       self._start_process()
 
       if self.cfg.init_callback is not None:
         self.cfg.init_callback(self.rc, self.pm, all_msgs, fingerprint)
 
-  def stop(self):
+  def stop(self, keep_warm: bool = False):
+    """Stops the process. With keep_warm, the sockets and replay context are kept to start the process again for another log"""
     with self.prefix:
       self.process.signal(signal.SIGKILL)
       self.process.stop()
-      self.rc.close_context()
-      self.prefix.clean_dirs()
+      if self.start_time > 0:
+        self.stats.wall_time = time.monotonic() - self.start_time
+        self.start_time = 0.
+
+      if keep_warm:
+        assert self.reusable and self.rc is not None and self.sockets is not None
+        # outputs, sync events and params of the killed process must not leak into the next replay
+        for socket in self.sockets:
+          messaging.drain_sock(socket)
+        for event in self.rc.events.values():
+          event.recv_called_event.clear()
+          event.recv_ready_event.clear()
+        Params().clear_all()
+      else:
+        if self.rc is not None:
+          self.rc.close_context()
+          self.rc = None
+        self.prefix.clean_dirs()
       self._clean_env()
 
   def get_output_msgs(self, start_time: int):
     assert self.rc and self.sockets
 
     output_msgs = []
+    log_mono_time = start_time + int(self.cfg.processing_time * 1e9)
     self.rc.wait_for_recv_called()
     for socket in self.sockets:
-      ms = messaging.drain_sock(socket)
-      for m in ms:
-        m = m.as_builder()
-        m.logMonoTime = start_time + int(self.cfg.processing_time * 1e9)
-        output_msgs.append(m.as_reader())
+      for dat in messaging.drain_sock_raw(socket):
+        new_dat = _set_log_mono_time(dat, log_mono_time)
+        if new_dat is not None:
+          m = messaging.log_from_bytes(new_dat)
+          self.msg_bytes[id(m)] = new_dat
+        else:
+          builder = messaging.log_from_bytes(dat).as_builder()
+          builder.logMonoTime = log_mono_time
+          m = builder.as_reader()
+        output_msgs.append(m)
     return output_msgs
 
   def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, FrameReader] | None) -> list[capnp._DynamicStructReader]:
@@ -278,7 +352,9 @@ class ProcessContainer:
       end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
 
     self.msg_queue.append(msg)
+    self.stats.msg_count += 1
     if end_of_cycle:
+      step_start = time.monotonic()
       with self.prefix, Timeout(self.cfg.timeout, error_msg=f"timed out testing process {repr(self.cfg.proc_name)}"):
         # call recv to let sub-sockets reconnect, after we know the process is ready
         if self.cnt == 0:
@@ -294,7 +370,9 @@ class ProcessContainer:
         output_msgs = self.get_output_msgs(msg.logMonoTime)
 
         for m in self.msg_queue:
-          self.pm.send(m.which(), m.as_builder())
+          # publish the logged bytes when known, rebuilding each message is most of the replay overhead
+          dat = self.msg_bytes.get(id(m))
+          self.pm.send(m.which(), bytes(dat) if dat is not None else m.as_builder())
           # send frames if needed
           if self.vipc_server is not None and m.which() in self.cfg.vision_pubs:
             camera_state = getattr(m, m.which())
@@ -309,6 +387,7 @@ class ProcessContainer:
         if trigger_empty_recv:
           self.rc.unlock_sockets()
         self.cnt += 1
+      self.stats.step_times.append(time.monotonic() - step_start)
     assert self.process.proc.is_alive()
 
     return output_msgs
@@ -616,8 +695,13 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False,
+  warm_containers: dict[str, ProcessContainer] = None, replay_stats: dict[str, ReplayStats] = None
 ) -> list[capnp._DynamicStructReader]:
+  """
+  warm_containers keeps reusable process containers between calls, keyed by process name. The caller stops them when done.
+  replay_stats is filled with the timing of each replayed process.
+  """
   if isinstance(cfg, Iterable):
     cfgs = list(cfg)
   else:
@@ -627,7 +711,8 @@ def replay_process(
                          manager_states=True,
                          panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
                          camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress,
+                                      warm_containers, replay_stats, getattr(lr, "raw_events", None))
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -643,7 +728,9 @@ def replay_process(
 
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  warm_containers: dict[str, ProcessContainer] | None = None, replay_stats: dict[str, ReplayStats] | None = None,
+  raw_events: Callable[[list[capnp._DynamicStructReader]], Iterable[bytes | memoryview]] | None = None
 ) -> list[capnp._DynamicStructReader]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
@@ -665,9 +752,12 @@ def _replay_multi_process(
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
   log_msgs = []
   containers = []
+  completed = False
   try:
     for cfg in cfgs:
-      container = ProcessContainer(cfg)
+      container = warm_containers.pop(cfg.proc_name, None) if warm_containers is not None else None
+      if container is None:
+        container = ProcessContainer(cfg)
       containers.append(container)
       container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
 
@@ -677,6 +767,12 @@ def _replay_multi_process(
     pubs_to_containers = {pub: [container for container in containers if pub in container.pubs] for pub in all_pubs}
 
     pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
+    # logged bytes of the messages, and outputs of each process as it republishes them to the others
+    msg_bytes: dict[int, bytes | memoryview] = {}
+    if raw_events is not None:
+      msg_bytes.update(zip(map(id, pub_msgs), raw_events(pub_msgs), strict=True))
+    for container in containers:
+      container.msg_bytes = msg_bytes
     # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
     external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
     internal_pub_queue: list[capnp._DynamicStructReader] = []
@@ -705,13 +801,20 @@ def _replay_multi_process(
     for container in containers:
       last_time = log_msgs[-1].logMonoTime if len(log_msgs) > 0 else int(time.monotonic() * 1e9)
       log_msgs.extend(container.get_output_msgs(last_time))
+    completed = True
   finally:
     for container in containers:
-      container.stop()
+      keep_warm = completed and warm_containers is not None and container.reusable
+      container.stop(keep_warm)
       if captured_output_store is not None:
         assert container.capture is not None
         out, err = container.capture.read_outerr()
         captured_output_store[container.cfg.proc_name] = {"out": out, "err": err}
+      if replay_stats is not None:
+        replay_stats[container.cfg.proc_name] = container.stats
+      if keep_warm:
+        assert warm_containers is not None
+        warm_containers[container.cfg.proc_name] = container
 
   return log_msgs
 
@@ -3,6 +3,7 @@ import argparse
 import concurrent.futures
 import os
 import sys
+import time
 from collections import defaultdict
 from tqdm import tqdm
 from typing import Any
@@ -11,8 +12,8 @@ from opendbc.car.car_helpers import interface_names
 from openpilot.common.git import get_commit
 from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
-from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, replay_process, \
-                                                                   check_most_messages_valid
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, ProcessContainer, ReplayStats, \
+                                                                   replay_process, check_most_messages_valid
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.logreader import LogReader, save_log
 
@@ -92,12 +93,15 @@ def handle_output_file(cur_log_fn, local):
     os.remove(cur_log_fn)
 
 
-def run_test_process(data):
+def run_test_process(data, warm_containers=None):
   segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
   res = None
+  stats = None
   if not args.upload_only:
     lr = LogReader.from_bytes(lr_dat)
-    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+    replay_stats: dict[str, ReplayStats] = {}
+    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs, warm_containers, replay_stats)
+    stats = replay_stats.get(cfg.proc_name)
     # save logs so we can upload when updating refs
     save_log(cur_log_fn, log_msgs)
 
@@ -105,7 +109,37 @@ def run_test_process(data):
     print(f'Processing: {os.path.basename(cur_log_fn)}')
     handle_output_file(cur_log_fn, args.local)
 
-  return (segment, cfg.proc_name, res)
+  return (segment, cfg.proc_name, res, stats)
+
+
+def run_test_processes(batch):
+  # all tests in a batch replay the same process, so its container is reused between segments when the config allows
+  warm_containers: dict[str, ProcessContainer] = {}
+  try:
+    return [run_test_process(data, warm_containers) for data in batch]
+  finally:
+    for container in warm_containers.values():
+      container.stop()
+
+
+def shard_tests(pool_args, num_workers):
+  """Groups the tests of each process into batches, with a few batches per worker to balance segments of different length"""
+  batch_size = max(1, len(pool_args) // (2 * num_workers))
+  tests_by_proc = defaultdict(list)
+  for data in pool_args:
+    tests_by_proc[data[1].proc_name].append(data)
+  batches = [tests[i:i + batch_size] for tests in tests_by_proc.values() for i in range(0, len(tests), batch_size)]
+  # start the largest batches first
+  return sorted(batches, key=len, reverse=True)
+
+
+def format_replay_stats(stats, wall_time):
+  lines = [f"{'process':<16}{'segment':<48}{'time (s)':>10}{'steps':>8}{'p50 step (ms)':>15}{'p99 step (ms)':>15}{'msgs/s':>10}"]
+  for (segment, proc), st in sorted(stats.items(), key=lambda kv: (kv[0][1], kv[0][0])):
+    lines.append(f"{proc:<16}{segment:<48}{st.wall_time:>10.2f}{len(st.step_times):>8}{st.step_latency(50) * 1e3:>15.2f}" +
+                 f"{st.step_latency(99) * 1e3:>15.2f}{st.throughput:>10.0f}")
+  lines.append(f"{len(stats)} replays in {wall_time:.1f}s ({len(stats) / wall_time * 3600:.0f} per hour)")
+  return "\n".join(lines)
 
 
 def get_log_data(segment):
@@ -114,7 +148,7 @@ def get_log_data(segment):
     return (segment, f.read())
 
 
-def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
+def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None, warm_containers=None, replay_stats=None):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -123,7 +157,7 @@ def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=Non
   ref_log_msgs = list(LogReader(ref_log_path))
 
   try:
-    log_msgs = replay_process(cfg, lr, disable_progress=True)
+    log_msgs = replay_process(cfg, lr, disable_progress=True, warm_containers=warm_containers, replay_stats=replay_stats)
   except Exception as e:
     raise Exception("failed on segment: " + segment) from e
 
@@ -268,12 +302,24 @@ if __name__ == "__main__":
         log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
 
     results: Any = defaultdict(dict)
-    p2 = pool.map(run_test_process, pool_args)
-    for (segment, proc, result) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
-      if not args.upload_only:
-        results[segment][proc] = result
+    replay_stats: dict[tuple[str, str], ReplayStats] = {}
+    start_time = time.monotonic()
+    batches = shard_tests(pool_args, args.jobs)
+    p2 = pool.map(run_test_processes, batches)
+    with tqdm(desc="Running Tests", total=len(pool_args)) as pbar:
+      for batch_results in p2:
+        for (segment, proc, result, stats) in batch_results:
+          if not args.upload_only:
+            results[segment][proc] = result
+          if stats is not None:
+            replay_stats[(segment, proc)] = stats
+        pbar.update(len(batch_results))
+    run_time = time.monotonic() - start_time
 
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
+  if len(replay_stats):
+    print(format_replay_stats(replay_stats, run_time))
+
   if not upload:
     with open(os.path.join(PROC_REPLAY_DIR, "diff.txt"), "w") as f:
       f.write(diff_long)
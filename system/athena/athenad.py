@@ -20,7 +20,7 @@ from datetime import datetime
 from functools import partial, total_ordering
 from queue import Queue
 from typing import cast
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
 
 import requests
 from requests.adapters import HTTPAdapter, DEFAULT_POOLBLOCK
@@ -32,7 +32,7 @@ import cereal.messaging as messaging
 from cereal import log
 from cereal.services import SERVICE_LIST
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import CallbackReader, get_upload_stream
+from openpilot.common.file_helpers import MULTIPART_MIN_SIZE, MULTIPART_UPLOAD, CallbackReader, get_upload_chunks, get_upload_stream, upload_blocks
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware import HARDWARE, PC
@@ -295,7 +295,8 @@ def upload_handler(end_event: threading.Event) -> None:
 
         cloudlog.event("athena.upload_handler.upload_start", fn=fn, sz=sz, network_type=network_type, metered=metered, retry_count=item.retry_count)
 
-        with _do_upload(item, partial(cb, sm, item, tid, end_event)) as response:
+        multipart = MULTIPART_UPLOAD and not metered and network_type == NetworkType.wifi and sz >= MULTIPART_MIN_SIZE
+        with _do_upload(item, partial(cb, sm, item, tid, end_event), multipart) as response:
           if response.status_code not in (200, 201, 401, 403, 412):
             cloudlog.event("athena.upload_handler.retry", status_code=response.status_code, fn=fn, sz=sz, network_type=network_type, metered=metered)
             retry_upload(tid, end_event)
@@ -316,7 +317,15 @@ def upload_handler(end_event: threading.Event) -> None:
       cloudlog.exception("athena.upload_handler.exception")
 
 
-def _do_upload(upload_item: UploadItem, callback: Callable = None) -> requests.Response:
+def _callback_blocks(blocks: Iterator[bytes], callback: Callable, total: int) -> Iterator[bytes]:
+  sent = 0
+  for block in blocks:
+    yield block
+    sent += len(block)
+    callback(total, sent)
+
+
+def _do_upload(upload_item: UploadItem, callback: Callable = None, multipart: bool = False) -> requests.Response:
   path = upload_item.path
   compress = False
 
@@ -325,13 +334,28 @@ def _do_upload(upload_item: UploadItem, callback: Callable = None) -> requests.R
     path = strip_zst_extension(path)
     compress = True
 
+  # blocks can only be put to blob SAS urls
+  if multipart and "?" in upload_item.url:
+    blocks = get_upload_chunks(path, compress)
+    if callback:
+      # the compressed size isn't known ahead, progress is relative to the file size
+      blocks = _callback_blocks(blocks, callback, os.path.getsize(path))
+    return upload_blocks(UPLOAD_SESS.put, upload_item.url, upload_item.headers, blocks)
+
   stream = None
   try:
     stream, content_length = get_upload_stream(path, compress)
-    response = UPLOAD_SESS.put(upload_item.url,
-                               data=CallbackReader(stream, callback, content_length) if callback else stream,
-                               headers={**upload_item.headers, 'Content-Length': str(content_length)},
-                               timeout=30)
+    headers = dict(upload_item.headers)
+    if content_length is not None:
+      headers['Content-Length'] = str(content_length)
+    data = stream
+    if callback and content_length is not None:
+      data = CallbackReader(stream, callback, content_length)
+    elif callback:
+      # compressed on the fly and sent with chunked transfer encoding, the progress is how much of the file was compressed
+      file_size = os.path.getsize(path)
+      data = CallbackReader(stream, lambda _: callback(file_size, stream.f.tell()))
+    response = UPLOAD_SESS.put(upload_item.url, data=data, headers=headers, timeout=30)
     return response
   finally:
     if stream:
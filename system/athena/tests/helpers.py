@@ -64,7 +64,12 @@ class MockWebsocket:
 
 class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
   def do_PUT(self):
-    length = int(self.headers['Content-Length'])
-    self.rfile.read(length)
+    if self.headers['Transfer-Encoding'] == 'chunked':
+      while length := int(self.rfile.readline().split(b';')[0], 16):
+        self.rfile.read(length + 2)
+      self.rfile.readline()
+    else:
+      length = int(self.headers['Content-Length'])
+      self.rfile.read(length)
     self.send_response(201, "Created")
     self.end_headers()
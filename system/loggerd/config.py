@@ -27,3 +27,13 @@ def get_available_bytes(default: int) -> int:
     available_bytes = default
 
   return available_bytes
+
+
+def get_total_bytes(default: int) -> int:
+  try:
+    statvfs = os.statvfs(Paths.log_root())
+    total_bytes = statvfs.f_blocks * statvfs.f_frsize
+  except OSError:
+    total_bytes = default
+
+  return total_bytes
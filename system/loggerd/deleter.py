@@ -2,16 +2,23 @@
 import os
 import shutil
 import threading
+from collections.abc import Callable
+from dataclasses import dataclass
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.config import get_available_bytes, get_available_percent
-from openpilot.system.loggerd.uploader import listdir_by_creation
+from openpilot.system.loggerd.config import get_available_bytes, get_available_percent, get_total_bytes
+from openpilot.system.loggerd.uploader import UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE, listdir_by_creation
 from openpilot.system.loggerd.xattr_cache import getxattr
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
 
 DELETE_LAST = ['boot', 'crash']
+# files the uploader uploads on its own, a directory counts as uploaded once all of them are
+UPLOADED_FILES = ['qlog', 'qlog.zst', 'qcamera.ts']
+# deletion order, the first criterion matters most and older directories go first within the same priority.
+# add not_uploaded to delete uploaded segments before the ones with files left to upload
+DELETE_PRIORITY = os.getenv("DELETER_PRIORITY", "delete_last,preserved").split(",")
 
 PRESERVE_ATTR_NAME = 'user.preserve'
 PRESERVE_ATTR_VALUE = b'1'
@@ -22,10 +29,10 @@ def has_preserve_xattr(d: str) -> bool:
   return getxattr(os.path.join(Paths.log_root(), d), PRESERVE_ATTR_NAME) == PRESERVE_ATTR_VALUE
 
 
-def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
+def get_preserved_segments(dirs_by_creation: list[str], has_preserve: Callable[[str], bool] = has_preserve_xattr) -> set[str]:
   # skip deleting most recent N preserved segments (and their prior segment)
   preserved = set()
-  for n, d in enumerate(filter(has_preserve_xattr, reversed(dirs_by_creation))):
+  for n, d in enumerate(filter(has_preserve, reversed(dirs_by_creation))):
     if n == PRESERVE_COUNT:
       break
     date_str, _, seg_str = d.rpartition("--")
@@ -45,29 +52,118 @@ def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
   return preserved
 
 
+def get_bytes_to_free() -> int:
+  available_bytes = get_available_bytes(default=MIN_BYTES + 1)
+  available_percent = get_available_percent(default=MIN_PERCENT + 1)
+  total_bytes = get_total_bytes(default=0)
+  return int(max(MIN_BYTES - available_bytes, (MIN_PERCENT - available_percent) / 100 * total_bytes, 0))
+
+
+@dataclass
+class LogDir:
+  # bytes on disk, None while the directory is locked
+  size: int | None = None
+  preserve: bool = False
+  uploaded: bool = False
+
+
+class LogDirIndex:
+  """
+    Size and preserve/uploaded flags of the log directories, kept between deletions.
+    A directory is measured once it's unlocked. The preserve flag is read on every refresh, the uploaded flag until it's set.
+  """
+
+  def __init__(self, root: str):
+    self.root = root
+    self.dirs: dict[str, LogDir] = {}
+
+  def refresh(self) -> list[str]:
+    """Updates the index, returns the directories by creation"""
+    dirs = listdir_by_creation(self.root)
+    for d in set(self.dirs) - set(dirs):
+      del self.dirs[d]
+
+    for d in dirs:
+      entry = self.dirs.setdefault(d, LogDir())
+      path = os.path.join(self.root, d)
+      # set by loggerd while the segment is being written, and when the user bookmarks it
+      entry.preserve = self._is_preserved(path)
+      # files keep being added to the DELETE_LAST directories without locks
+      if entry.size is None or d in DELETE_LAST:
+        entry.size = self._measure(path)
+      if entry.size is not None and not entry.uploaded and "not_uploaded" in DELETE_PRIORITY:
+        entry.uploaded = self._is_uploaded(path)
+    return dirs
+
+  @staticmethod
+  def _is_preserved(path: str) -> bool:
+    try:
+      return getxattr(path, PRESERVE_ATTR_NAME, cached=False) == PRESERVE_ATTR_VALUE
+    except OSError:
+      return False
+
+  @staticmethod
+  def _measure(path: str) -> int | None:
+    try:
+      files = list(os.scandir(path))
+      if any(f.name.endswith(".lock") for f in files):
+        return None
+      return sum(f.stat(follow_symlinks=False).st_blocks * 512 for f in files)
+    except OSError:
+      return None
+
+  @staticmethod
+  def _is_uploaded(path: str) -> bool:
+    for name in UPLOADED_FILES:
+      fn = os.path.join(path, name)
+      try:
+        if os.path.exists(fn) and getxattr(fn, UPLOAD_ATTR_NAME, cached=False) != UPLOAD_ATTR_VALUE:
+          return False
+      except OSError:
+        return False
+    return True
+
+  def delete_order(self, dirs_by_creation: list[str]) -> list[str]:
+    preserved_dirs = get_preserved_segments(dirs_by_creation, lambda d: self.dirs[d].preserve)
+    priorities = {
+      "delete_last": lambda d: d in DELETE_LAST,
+      "preserved": lambda d: d in preserved_dirs,
+      "not_uploaded": lambda d: not self.dirs[d].uploaded,
+    }
+    keys = [priorities[p] for p in DELETE_PRIORITY if p in priorities]
+    return sorted(dirs_by_creation, key=lambda d: tuple(k(d) for k in keys))
+
+  def delete(self, bytes_to_free: int) -> int:
+    """Deletes directories in priority order until bytes_to_free are freed, returns the bytes freed"""
+    freed = 0
+    for delete_dir in self.delete_order(self.refresh()):
+      if freed >= bytes_to_free:
+        break
+
+      entry = self.dirs[delete_dir]
+      delete_path = os.path.join(self.root, delete_dir)
+      if entry.size is None or any(name.endswith(".lock") for name in os.listdir(delete_path)):
+        continue
+
+      try:
+        cloudlog.info(f"deleting {delete_path}")
+        shutil.rmtree(delete_path)
+        freed += entry.size
+        del self.dirs[delete_dir]
+      except OSError:
+        cloudlog.exception(f"issue deleting {delete_path}")
+    return freed
+
+
 def deleter_thread(exit_event: threading.Event):
+  index = LogDirIndex(Paths.log_root())
   while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
-
-    if out_of_percent or out_of_bytes:
-      dirs = listdir_by_creation(Paths.log_root())
-      preserved_dirs = get_preserved_segments(dirs)
-
-      # remove the earliest directory we can
-      for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
-        delete_path = os.path.join(Paths.log_root(), delete_dir)
-
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
-          continue
-
-        try:
-          cloudlog.info(f"deleting {delete_path}")
-          shutil.rmtree(delete_path)
-          break
-        except OSError:
-          cloudlog.exception(f"issue deleting {delete_path}")
-      exit_event.wait(.1)
+    bytes_to_free = get_bytes_to_free()
+
+    if bytes_to_free > 0:
+      # free all the space needed in one batch, the next check catches anything the sizes missed
+      freed = index.delete(bytes_to_free)
+      exit_event.wait(.1 if freed else 1)
     else:
       exit_event.wait(30)
 
@@ -5,7 +5,10 @@ from pathlib import Path
 from collections.abc import Sequence
 
 import openpilot.system.loggerd.deleter as deleter
+import openpilot.system.loggerd.uploader as uploader
 from openpilot.common.timeout import Timeout, TimeoutException
+from openpilot.system.hardware.hw import Paths
+from openpilot.system.loggerd.xattr_cache import setxattr
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
 Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
@@ -90,6 +93,46 @@ class TestDeleter(UploaderTestCase):
       self.make_file_with_data("crash", self.seg_format2[:-4]),
     ])
 
+  def test_delete_uploaded_first(self, mocker):
+    mocker.patch.object(deleter, "DELETE_PRIORITY", ["delete_last", "preserved", "not_uploaded"])
+    self.assertDeleteOrder([
+      self.make_file_with_data(self.seg_format.format(1), "qlog", upload_xattr=uploader.UPLOAD_ATTR_VALUE),
+      self.make_file_with_data(self.seg_format2.format(0), "qlog", upload_xattr=uploader.UPLOAD_ATTR_VALUE),
+      self.make_file_with_data(self.seg_format.format(0), "qlog"),
+      self.make_file_with_data(self.seg_format2.format(3), "qlog", upload_xattr=uploader.UPLOAD_ATTR_VALUE,
+                               preserve_xattr=deleter.PRESERVE_ATTR_VALUE),
+    ])
+
+  def test_preserve_after_measure(self):
+    f_paths = [self.make_file_with_data(self.seg_format.format(i), self.f_type) for i in range(2)]
+    index = deleter.LogDirIndex(Paths.log_root())
+    assert index.delete_order(index.refresh()) == [f.parent.name for f in f_paths]
+
+    # preserved after the directory was measured
+    setxattr(str(f_paths[0].parent), deleter.PRESERVE_ATTR_NAME, deleter.PRESERVE_ATTR_VALUE)
+    assert index.delete_order(index.refresh()) == [f.parent.name for f in f_paths[::-1]]
+
+  def test_delete_batch(self):
+    f_paths = [self.make_file_with_data(self.seg_format.format(i), self.f_type, 1) for i in range(4)]
+
+    # 1.5 MB short of the minimum, deleting two segments is enough
+    block_size = 4096
+    def fake_statvfs(d):
+      available = deleter.MIN_BYTES - 1.5 * 1024 * 1024 + sum(not f.exists() for f in f_paths) * 1024 * 1024
+      return Stats(f_bavail=available / block_size, f_blocks=2 * available / block_size, f_frsize=block_size)
+    deleter.os.statvfs = fake_statvfs
+
+    self.start_thread()
+    try:
+      with Timeout(2, "Timeout waiting for files to be deleted"):
+        while f_paths[1].exists():
+          time.sleep(0.01)
+      time.sleep(0.5)
+    finally:
+      self.join_thread()
+
+    assert [f.exists() for f in f_paths] == [False, False, True, True]
+
   def test_no_delete_when_available_space(self):
     f_path = self.make_file_with_data(self.seg_dir, self.f_type)
 
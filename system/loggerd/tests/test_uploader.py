@@ -148,6 +148,24 @@ class TestUploader(UploaderTestCase):
 
     assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
 
+  def test_upload_files_created_while_running(self):
+    self.start_thread()
+    time.sleep(0.25)
+
+    seg_nums = [self.seg_num, self.seg_num + 1]
+    for i in seg_nums:
+      self.seg_dir = self.seg_format.format(i)
+      self.gen_files(lock=False)
+      time.sleep(0.25)
+
+    # allow enough time that files could upload twice if there is a bug in the logic
+    time.sleep(1)
+    self.join_thread()
+
+    exp_order = self.gen_order(seg_nums, [])
+    assert len(log_handler.upload_ignored) == 0, "Some files were ignored"
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "New files not uploaded exactly once"
+
   def test_no_upload_with_lock_file(self):
     self.start_thread()
 
@@ -7,12 +7,12 @@ import threading
 import time
 import traceback
 import datetime
-from collections.abc import Iterator
+import heapq
 
 from cereal import log
 import cereal.messaging as messaging
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import get_upload_stream
+from openpilot.common.file_helpers import MULTIPART_MIN_SIZE, MULTIPART_UPLOAD, get_upload_chunks, get_upload_stream, upload_blocks
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
@@ -62,6 +62,9 @@ def listdir_by_creation(d: str) -> list[str]:
     cloudlog.exception("listdir_by_creation failed")
     return []
 
+def get_route(logdir: str) -> str:
+  return logdir.rsplit('--', 1)[0]
+
 def clear_locks(root: str) -> None:
   for logdir in os.listdir(root):
     path = os.path.join(root, logdir)
@@ -73,6 +76,178 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
+class UploadQueue:
+  """
+    Files waiting for upload, in upload order: everything in the immediate folders first,
+    then the priority files by directory creation order.
+    A directory is only listed again when its modification time changes, files that were uploaded
+    or removed since are dropped when they reach the top of a heap.
+  """
+
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int]):
+    self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+
+    self.root_mtime: int | None = None
+    # modification time of each directory when it was last listed, None to list it on the next refresh
+    self.dir_mtime: dict[str, int | None] = {}
+    self.dir_files: dict[str, list[str]] = {}
+    # key -> heap item of every file waiting for upload
+    self.files: dict[str, tuple] = {}
+
+    self.immediate: list[tuple] = []
+    self.priority: list[tuple] = []
+    # qcameras are only uploaded for requested routes on metered connections, so they also get a heap per route
+    self.qcameras: list[tuple] = []
+    self.route_qcameras: dict[str, list[tuple]] = {}
+
+  def refresh(self) -> None:
+    try:
+      root_mtime = os.stat(self.root).st_mtime_ns
+    except OSError:
+      root_mtime = None
+
+    if root_mtime is None or root_mtime != self.root_mtime:
+      self.root_mtime = self._settled_mtime(root_mtime)
+      logdirs = set(listdir_by_creation(self.root))
+      for logdir in list(self.dir_mtime):
+        if logdir not in logdirs:
+          self._remove_dir(logdir)
+      for logdir in logdirs:
+        self.dir_mtime.setdefault(logdir, None)
+
+    for logdir, mtime in list(self.dir_mtime.items()):
+      try:
+        cur_mtime = os.stat(os.path.join(self.root, logdir)).st_mtime_ns
+      except OSError:
+        self._remove_dir(logdir)
+        continue
+      if cur_mtime != mtime:
+        self._scan_dir(logdir)
+        self.dir_mtime[logdir] = self._settled_mtime(cur_mtime)
+
+  @staticmethod
+  def _settled_mtime(mtime: int | None) -> int | None:
+    # timestamps are coarse, a directory modified again within the same tick would keep its mtime
+    if mtime is None or time.time() - mtime / 1e9 < 2.:  # noqa: TID251
+      return None
+    return mtime
+
+  def _remove_dir(self, logdir: str) -> None:
+    self.dir_mtime.pop(logdir, None)
+    for key in self.dir_files.pop(logdir, []):
+      self.files.pop(key, None)
+
+    # heaps of routes that are never requested are otherwise only cleaned up on metered connections
+    route = get_route(logdir)
+    if route in self.route_qcameras:
+      heap = [i for i in self.route_qcameras[route] if self.files.get(os.path.join(i[3], i[2])) is i]
+      if heap:
+        heapq.heapify(heap)
+        self.route_qcameras[route] = heap
+      else:
+        del self.route_qcameras[route]
+
+  def _scan_dir(self, logdir: str) -> None:
+    for key in self.dir_files.pop(logdir, []):
+      self.files.pop(key, None)
+
+    path = os.path.join(self.root, logdir)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      return
+
+    if any(name.endswith(".lock") for name in names):
+      return
+
+    dir_sort = tuple(get_directory_sort(logdir))
+    keys = []
+    for name in names:
+      key = os.path.join(logdir, name)
+      fn = os.path.join(path, name)
+      immediate = any(f in fn for f in self.immediate_folders)
+      if not immediate and name not in self.immediate_priority:
+        continue
+
+      # skip files already uploaded
+      try:
+        is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+      except OSError:
+        cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
+        # deleter could have deleted, so skip
+        continue
+      if is_uploaded:
+        continue
+
+      item = (dir_sort, self.immediate_priority.get(name, 1000), name, logdir)
+      self.files[key] = item
+      keys.append(key)
+      if immediate:
+        heapq.heappush(self.immediate, item)
+      elif name == "qcamera.ts":
+        heapq.heappush(self.qcameras, item)
+        heapq.heappush(self.route_qcameras.setdefault(get_route(logdir), []), item)
+      else:
+        heapq.heappush(self.priority, item)
+    self.dir_files[logdir] = keys
+
+  def _is_waiting(self, item: tuple) -> bool:
+    _, _, name, logdir = item
+    key = os.path.join(logdir, name)
+    if self.files.get(key) is not item:
+      return False
+    try:
+      if getxattr(os.path.join(self.root, key), UPLOAD_ATTR_NAME) != UPLOAD_ATTR_VALUE:
+        return True
+    except OSError:
+      pass
+    self.files.pop(key, None)
+    return False
+
+  def _peek(self, heap: list[tuple]) -> tuple | None:
+    while heap and not self._is_waiting(heap[0]):
+      heapq.heappop(heap)
+    return heap[0] if heap else None
+
+  def _next_immediate(self, metered: bool) -> tuple | None:
+    if not metered:
+      return self._peek(self.immediate)
+
+    # limit uploading on metered connections
+    skipped = []
+    while (item := self._peek(self.immediate)) is not None:
+      _, _, name, logdir = item
+      try:
+        ctime = os.path.getctime(os.path.join(self.root, logdir, name))
+      except OSError:
+        ctime = 0
+      dt = datetime.timedelta(hours=12)
+      if not (logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt):
+        break
+      skipped.append(heapq.heappop(self.immediate))
+    for s in skipped:
+      heapq.heappush(self.immediate, s)
+    return item
+
+  def next_file(self, metered: bool, requested_routes: list[str]) -> tuple[str, str, str] | None:
+    item = self._next_immediate(metered)
+    if item is None:
+      if metered:
+        qcameras = [self._peek(self.route_qcameras[r]) for r in requested_routes if r in self.route_qcameras]
+      else:
+        qcameras = [self._peek(self.qcameras)]
+      candidates = [i for i in [self._peek(self.priority), *qcameras] if i is not None]
+      item = min(candidates) if candidates else None
+
+    if item is None:
+      return None
+    _, _, name, logdir = item
+    key = os.path.join(logdir, name)
+    return name, key, os.path.join(self.root, key)
+
+
 class Uploader:
   def __init__(self, dongle_id: str, root: str):
     self.dongle_id = dongle_id
@@ -86,60 +261,16 @@ class Uploader:
 
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
-
-  def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
-    r = self.params.get("AthenadRecentlyViewedRoutes")
-    requested_routes = [] if r is None else [route for route in r.split(",") if route]
-
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
-          continue
-
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
-
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
-
-        yield name, key, fn
+    self.queue = UploadQueue(root, self.immediate_folders, self.immediate_priority)
 
   def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
-
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
-
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
+    r = self.params.get("AthenadRecentlyViewedRoutes")
+    requested_routes = [] if r is None else [route.split('|')[-1] for route in r.split(",") if route]
 
-    return None
+    self.queue.refresh()
+    return self.queue.next_file(metered, requested_routes)
 
-  def do_upload(self, key: str, fn: str):
+  def do_upload(self, key: str, fn: str, multipart: bool = False):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
     if url_resp.status_code == 412:
       return url_resp
@@ -155,6 +286,9 @@ class Uploader:
     stream = None
     try:
       compress = key.endswith('.zst') and not fn.endswith('.zst')
+      # blocks can only be put to blob SAS urls
+      if multipart and "?" in url:
+        return upload_blocks(requests.put, url, headers, get_upload_chunks(fn, compress))
       stream, _ = get_upload_stream(fn, compress)
       response = requests.put(url, data=stream, headers=headers, timeout=10)
       return response
@@ -182,8 +316,9 @@ class Uploader:
 
       stat = None
       last_exc = None
+      multipart = MULTIPART_UPLOAD and not metered and network_type == NetworkType.wifi and sz >= MULTIPART_MIN_SIZE
       try:
-        stat = self.do_upload(key, fn)
+        stat = self.do_upload(key, fn, multipart)
       except Exception as e:
         last_exc = (e, traceback.format_exc())
 
@@ -4,9 +4,9 @@ import xattr
 
 _cached_attributes: dict[tuple, bytes | None] = {}
 
-def getxattr(path: str, attr_name: str) -> bytes | None:
+def getxattr(path: str, attr_name: str, cached: bool = True) -> bytes | None:
   key = (path, attr_name)
-  if key not in _cached_attributes:
+  if key not in _cached_attributes or not cached:
     try:
       response = xattr.getxattr(path, attr_name)
     except OSError as e:
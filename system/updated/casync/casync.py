@@ -5,14 +5,18 @@ import os
 import pathlib
 import struct
 import sys
+import threading
 import time
 from abc import ABC, abstractmethod
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import IO
 
+import numpy as np
 import requests
 from Crypto.Hash import SHA512
+from requests.adapters import HTTPAdapter
 from openpilot.system.updated.casync import tar
 from openpilot.system.updated.casync.common import create_casync_tar_package
 
@@ -31,6 +35,14 @@ CHUNK_DOWNLOAD_RETRIES = 3
 
 CAIBX_DOWNLOAD_TIMEOUT = 120
 
+# chunks are downloaded, decompressed and verified in parallel, and written in order
+EXTRACT_WORKERS = 8
+MAX_IN_FLIGHT_BYTES = 128 * 1024 * 1024
+# adjacent chunks that are also adjacent in a local source are read at once
+MAX_COALESCED_READ = 8 * 1024 * 1024
+
+CAIBX_TABLE_DTYPE = np.dtype([('offset', '<u8'), ('sha', 'V32')])
+
 Chunk = namedtuple('Chunk', ['sha', 'offset', 'length'])
 ChunkDict = dict[bytes, Chunk]
 
@@ -46,16 +58,22 @@ class BinaryChunkReader(ChunkReader):
   def __init__(self, file_like: IO[bytes]) -> None:
     super().__init__()
     self.f = file_like
+    self.lock = threading.Lock()
 
   def read(self, chunk: Chunk) -> bytes:
-    self.f.seek(chunk.offset)
-    return self.f.read(chunk.length)
+    with self.lock:
+      self.f.seek(chunk.offset)
+      return self.f.read(chunk.length)
 
 
 class FileChunkReader(BinaryChunkReader):
   def __init__(self, path: str) -> None:
     super().__init__(open(path, 'rb'))
 
+  def read(self, chunk: Chunk) -> bytes:
+    # no shared file position, so reads from several threads don't need the lock
+    return os.pread(self.f.fileno(), chunk.length, chunk.offset)
+
   def __del__(self):
     self.f.close()
 
@@ -67,6 +85,10 @@ class RemoteChunkReader(ChunkReader):
     super().__init__()
     self.url = url
     self.session = requests.Session()
+    # one connection per extract worker
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=EXTRACT_WORKERS)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
 
   def read(self, chunk: Chunk) -> bytes:
     sha_hex = chunk.sha.hex()
@@ -131,25 +153,22 @@ def parse_caibx(caibx_path: str) -> list[Chunk]:
   length, magic = struct.unpack("<QQ", caibx.read(CA_TABLE_HEADER_LEN))
   assert magic == CA_FORMAT_TABLE
 
-  # Parse chunks
+  # Parse chunks, each table entry is the end offset of the chunk followed by its hash
   num_chunks = (caibx_len - CA_HEADER_LEN - CA_TABLE_MIN_LEN) // CA_TABLE_ENTRY_LEN
-  chunks = []
-
-  offset = 0
-  for i in range(num_chunks):
-    new_offset = struct.unpack("<Q", caibx.read(8))[0]
+  table = np.frombuffer(caibx.read(num_chunks * CA_TABLE_ENTRY_LEN), dtype=CAIBX_TABLE_DTYPE, count=num_chunks)
 
-    sha = caibx.read(32)
-    length = new_offset - offset
+  ends = table['offset']
+  offsets = np.zeros_like(ends)
+  offsets[1:] = ends[:-1]
+  lengths = ends - offsets
 
-    assert length <= max_size
+  assert np.all(ends >= offsets)
+  assert np.all(lengths <= max_size)
+  # Last chunk can be smaller
+  assert np.all(lengths[:-1] >= min_size)
 
-    # Last chunk can be smaller
-    if i < num_chunks - 1:
-      assert length >= min_size
-
-    chunks.append(Chunk(sha, offset, length))
-    offset = new_offset
+  shas = table['sha'].tobytes()
+  chunks = [Chunk(shas[32 * i:32 * (i + 1)], offset, length) for i, (offset, length) in enumerate(zip(offsets.tolist(), lengths.tolist(), strict=True))]
 
   caibx.close()
   return chunks
@@ -165,41 +184,128 @@ def build_chunk_dict(chunks: list[Chunk]) -> ChunkDict:
   return r
 
 
+def read_chunk(chunk: Chunk, sources: list[tuple[str, ChunkReader, ChunkDict]]) -> tuple[str, bytes]:
+  """Reads a chunk from the first source that has it with the right contents"""
+  for name, chunk_reader, store_chunks in sources:
+    if chunk.sha in store_chunks:
+      bts = chunk_reader.read(store_chunks[chunk.sha])
+      if verify_chunk(chunk, bts):
+        return name, bts
+
+  raise RuntimeError("Desired chunk not found in provided stores")
+
+
+def verify_chunk(chunk: Chunk, bts: bytes) -> bool:
+  return len(bts) == chunk.length and SHA512.new(bts, truncate="256").digest() == chunk.sha
+
+
+def read_run(run: list[Chunk], source: int | None, sources: list[tuple[str, ChunkReader, ChunkDict]]) -> list[tuple[str, bytes]]:
+  """Reads chunks that are adjacent in the target and in a local source with a single read"""
+  if source is None or len(run) == 1:
+    return [read_chunk(c, sources) for c in run]
+
+  name, chunk_reader, store_chunks = sources[source]
+  first = store_chunks[run[0].sha]
+  dat = chunk_reader.read(Chunk(None, first.offset, sum(c.length for c in run)))
+
+  ret = []
+  pos = 0
+  for c in run:
+    bts = dat[pos:pos + c.length]
+    pos += c.length
+    ret.append((name, bts) if verify_chunk(c, bts) else read_chunk(c, sources))
+  return ret
+
+
+def plan_reads(target: list[Chunk], sources: list[tuple[str, ChunkReader, ChunkDict]]):
+  """
+    Splits the target into runs of chunks read together, with the index of the local source they're read from.
+    Chunks that occurred before in the target are copied from where they were written instead, as (chunk, offset).
+  """
+  first_offset: dict[bytes, int] = {}
+  run: list[Chunk] = []
+  run_source: int | None = None
+  run_end = run_size = 0
+
+  for c in target:
+    if c.sha in first_offset:
+      if run:
+        yield run, run_source
+        run = []
+      yield (c, first_offset[c.sha]), None
+      continue
+    first_offset[c.sha] = c.offset
+
+    source = next((i for i, (_, _, store_chunks) in enumerate(sources) if c.sha in store_chunks), None)
+    local = source is not None and isinstance(sources[source][1], BinaryChunkReader)
+    store_chunk = sources[source][2][c.sha] if local else None
+
+    if run and local and source == run_source and store_chunk.offset == run_end and run_size + c.length <= MAX_COALESCED_READ:
+      run.append(c)
+    else:
+      if run:
+        yield run, run_source
+      run, run_source, run_size = [c], (source if local else None), 0
+    run_size += c.length
+    if local:
+      run_end = store_chunk.offset + store_chunk.length
+
+  if run:
+    yield run, run_source
+
+
 def extract(target: list[Chunk],
             sources: list[tuple[str, ChunkReader, ChunkDict]],
             out_path: str,
-            progress: Callable[[int], None] = None):
+            progress: Callable[[int], None] = None,
+            workers: int = EXTRACT_WORKERS):
   stats: dict[str, int] = defaultdict(int)
 
-  mode = 'rb+' if os.path.exists(out_path) else 'wb'
-  with open(out_path, mode) as out:
-    for cur_chunk in target:
-
-      # Find source for desired chunk
-      for name, chunk_reader, store_chunks in sources:
-        if cur_chunk.sha in store_chunks:
-          bts = chunk_reader.read(store_chunks[cur_chunk.sha])
-
-          # Check length
-          if len(bts) != cur_chunk.length:
-            continue
-
-          # Check hash
-          if SHA512.new(bts, truncate="256").digest() != cur_chunk.sha:
-            continue
-
-          # Write to output
-          out.seek(cur_chunk.offset)
-          out.write(bts)
-
-          stats[name] += cur_chunk.length
-
-          if progress is not None:
-            progress(sum(stats.values()))
-
-          break
-      else:
-        raise RuntimeError("Desired chunk not found in provided stores")
+  def write(chunk: Chunk, name: str, bts: bytes):
+    out.seek(chunk.offset)
+    out.write(bts)
+
+    stats[name] += chunk.length
+    if progress is not None:
+      progress(sum(stats.values()))
+
+  def write_done(item: tuple, future: Future | None):
+    if future is None:
+      # counted for the source it would have been read from
+      chunk, copy_offset = item
+      name = next(name for name, _, store_chunks in sources if chunk.sha in store_chunks)
+      out.flush()
+      write(chunk, name, os.pread(out.fileno(), chunk.length, copy_offset))
+    else:
+      for chunk, (name, bts) in zip(item, future.result(), strict=True):
+        write(chunk, name, bts)
+
+  mode = 'rb+' if os.path.exists(out_path) else 'wb+'
+  with open(out_path, mode) as out, ThreadPoolExecutor(max_workers=workers) as executor:
+    in_flight: deque[tuple[tuple, Future | None, int]] = deque()
+    in_flight_bytes = 0
+    try:
+      for run, source in plan_reads(target, sources):
+        if isinstance(run, tuple):
+          in_flight.append((run, None, 0))
+        else:
+          size = sum(c.length for c in run)
+          in_flight.append((run, executor.submit(read_run, run, source, sources), size))
+          in_flight_bytes += size
+
+        # results are written in target order, a bounded number of reads is kept ahead
+        while in_flight and (len(in_flight) > 2 * workers or in_flight_bytes > MAX_IN_FLIGHT_BYTES or in_flight[0][1] is None):
+          item, future, size = in_flight.popleft()
+          write_done(item, future)
+          in_flight_bytes -= size
+
+      while in_flight:
+        item, future, _ = in_flight.popleft()
+        write_done(item, future)
+    finally:
+      for _, future, _ in in_flight:
+        if future is not None:
+          future.cancel()
 
   return stats
 
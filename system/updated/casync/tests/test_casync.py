@@ -1,9 +1,14 @@
 import pytest
+import io
 import os
 import pathlib
+import random
+import struct
 import tempfile
 import subprocess
 
+from Crypto.Hash import SHA512
+
 from openpilot.system.updated.casync import casync
 from openpilot.system.updated.casync import tar
 
@@ -262,3 +267,75 @@ class TestCasyncDirectory:
     assert stats['remote'] > 0
     assert stats['cache'] > 0
     assert stats['cache'] > stats['remote']
+
+
+class CountingChunkReader(casync.ChunkReader):
+  """Serves chunks by hash, like a remote store"""
+  def __init__(self, blocks):
+    self.blocks = {SHA512.new(b, truncate="256").digest(): b for b in blocks}
+    self.reads = 0
+
+  def read(self, chunk):
+    self.reads += 1
+    return self.blocks[chunk.sha]
+
+
+class TestCasyncExtract:
+  """Tests parsing and extracting with a caibx written here, no casync binary needed"""
+
+  def setup_method(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.manifest_fn = os.path.join(self.tmpdir.name, 'orig.caibx')
+    self.target_fn = os.path.join(self.tmpdir.name, 'target')
+
+    random.seed(0)
+    self.blocks = [random.randbytes(random.randint(1024, 4096)) for _ in range(40)]
+    # includes reused chunks
+    self.target_blocks = self.blocks[:20] + self.blocks[3:5] + self.blocks[20:] + self.blocks[:1]
+    self.contents = b''.join(self.target_blocks)
+
+    table = b''
+    end = 0
+    for b in self.target_blocks:
+      end += len(b)
+      table += struct.pack("<Q", end) + SHA512.new(b, truncate="256").digest()
+    with open(self.manifest_fn, 'wb') as f:
+      f.write(struct.pack("<QQQQQQ", casync.CA_HEADER_LEN, casync.CA_FORMAT_INDEX, casync.FLAGS, 1024, 2048, 4096))
+      f.write(struct.pack("<QQ", 2**64 - 1, casync.CA_FORMAT_TABLE))
+      f.write(table)
+      f.write(struct.pack("<QQQQQ", 0, 0, casync.CA_HEADER_LEN, casync.CA_TABLE_HEADER_LEN + len(table) + 40, casync.CA_FORMAT_TABLE_TAIL_MARKER))
+
+  def teardown_method(self):
+    self.tmpdir.cleanup()
+
+  def test_parse_caibx(self):
+    target = casync.parse_caibx(self.manifest_fn)
+
+    assert [c.sha for c in target] == [SHA512.new(b, truncate="256").digest() for b in self.target_blocks]
+    assert [c.length for c in target] == [len(b) for b in self.target_blocks]
+    assert [c.offset for c in target] == [sum(len(b) for b in self.target_blocks[:i]) for i in range(len(self.target_blocks))]
+
+  @pytest.mark.parametrize("workers", [1, 4])
+  def test_extract(self, workers):
+    target = casync.parse_caibx(self.manifest_fn)
+
+    # seed has the first half, with a corrupted chunk
+    seed = bytearray(b''.join(self.blocks[:20]))
+    seed[len(self.blocks[0]) + 10] ^= 0xff
+    seed_chunks = casync.parse_caibx(self.manifest_fn)[:20]
+
+    remote = CountingChunkReader(self.blocks)
+    sources = [('seed', casync.BinaryChunkReader(io.BytesIO(bytes(seed))), casync.build_chunk_dict(seed_chunks))]
+    sources += [('remote', remote, casync.build_chunk_dict(target))]
+
+    progress = []
+    stats = casync.extract(target, sources, self.target_fn, progress.append, workers=workers)
+
+    with open(self.target_fn, 'rb') as f:
+      assert f.read() == self.contents
+
+    # only the corrupted chunk and the ones missing from the seed are downloaded, reused chunks once
+    assert remote.reads == 21
+    assert stats['remote'] == len(self.blocks[1]) + sum(len(b) for b in self.blocks[20:])
+    assert sum(stats.values()) == len(self.contents)
+    assert progress == sorted(progress) and progress[-1] == len(self.contents)
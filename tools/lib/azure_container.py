@@ -56,6 +56,22 @@ class AzureContainer:
   def get_url(self, route_name: str, segment_num: str, filename: str) -> str:
     return self.BASE_URL + f"{route_name.replace('|', '/')}/{segment_num}/{filename}"
 
+  def list_urls(self, prefix: str) -> list[str]:
+    # anonymous listing, only allowed on containers with public container access
+    import requests
+    from xml.etree import ElementTree
+    urls: list[str] = []
+    marker = ""
+    while True:
+      params = {"restype": "container", "comp": "list", "prefix": prefix, "marker": marker}
+      resp = requests.get(self.BASE_URL.rstrip("/"), params=params, timeout=10)
+      resp.raise_for_status()
+      listing = ElementTree.fromstring(resp.content)
+      urls += [self.BASE_URL + name.text for name in listing.iter("Name") if name.text is not None]
+      marker = listing.findtext("NextMarker") or ""
+      if not marker:
+        return urls
+
   def upload_bytes(self, data: bytes | IO, blob_name: str, overwrite=False) -> str:
     from azure.storage.blob import BlobClient
     blob = BlobClient(
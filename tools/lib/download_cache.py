@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from hashlib import sha256
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.hardware.hw import Paths
+
+DEFAULT_MAX_SIZE = int(os.environ.get("FILEREADER_CACHE_SIZE", 10 * 1024 * 1024 * 1024))
+# eviction frees down to this fraction of max_size, so it doesn't run on every write once the cache is full
+EVICTION_TARGET = 0.9
+INDEX_NAME = "cache_index.db"
+EXISTS_INDEX_NAME = "exists_index.db"
+# files get uploaded over time, so missing files are checked again sooner than found ones
+EXISTS_TTL = int(os.environ.get("FILE_EXISTS_TTL", 24 * 60 * 60))
+NOT_EXISTS_TTL = int(os.environ.get("FILE_NOT_EXISTS_TTL", 10 * 60))
+# stays below SQLite's limit on host parameters in one query
+MAX_QUERY_PARAMS = 500
+
+
+def hash_256(link: str) -> str:
+  return sha256((link.split("?")[0]).encode('utf-8')).hexdigest()
+
+
+def derived_cache_key(fn: str, name: str) -> str:
+  """Download cache key for data derived from a file, like an index. Local files are keyed by modification time too"""
+  key = fn
+  if os.path.isfile(fn):
+    # local files can change in place, invalidate on modification
+    st = os.stat(fn)
+    key = f"{os.path.abspath(fn)}:{st.st_mtime_ns}:{st.st_size}"
+  return f"{hash_256(key)}_{name}"
+
+
+@dataclass
+class CacheStats:
+  hits: int = 0
+  misses: int = 0
+  bytes_served: int = 0
+  bytes_written: int = 0
+  bytes_evicted: int = 0
+
+  @property
+  def hit_rate(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+
+class DownloadCache:
+  """
+    Size bounded cache of downloaded file chunks with least recently used eviction.
+    Entries are tracked in an SQLite index next to the files, which is safe to share between processes and threads.
+  """
+
+  def __init__(self, root: str | None = None, max_size: int = DEFAULT_MAX_SIZE):
+    self.root = root if root is not None else Paths.download_cache_root()
+    self.max_size = max_size
+    self.stats = CacheStats()
+
+    os.makedirs(self.root, exist_ok=True)
+    self.index_path = os.path.join(self.root, INDEX_NAME)
+    new_index = not os.path.exists(self.index_path)
+    # one connection shared by the threads of a process, e.g. LogReader prefetching and URLFile downloads
+    self._lock = threading.RLock()
+    self._db = sqlite3.connect(self.index_path, timeout=30, isolation_level=None, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL)")
+    self._db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+    # running total of the entry sizes, kept by triggers so it stays right for every process writing to the index
+    self._db.execute("BEGIN IMMEDIATE")
+    self._db.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)")
+    self._db.execute("INSERT OR IGNORE INTO total SELECT 0, COALESCE(SUM(size), 0) FROM entries")
+    self._db.execute("CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN UPDATE total SET size = size + new.size; END")
+    self._db.execute("CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN UPDATE total SET size = size - old.size; END")
+    self._db.execute("CREATE TRIGGER IF NOT EXISTS entries_size AFTER UPDATE OF size ON entries BEGIN UPDATE total SET size = size + new.size - old.size; END")
+    self._db.execute("COMMIT")
+    if new_index:
+      self._index_existing_files()
+
+  def _index_existing_files(self) -> None:
+    # files written before the index existed, or by older versions
+    entries = [(e.name, e.stat().st_size, e.stat().st_atime) for e in os.scandir(self.root)
+               if e.is_file() and not e.name.startswith((INDEX_NAME, EXISTS_INDEX_NAME, "tmp"))]
+    self._db.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?, ?)", entries)
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self.root, key)
+
+  def get(self, key: str) -> bytes | None:
+    with self._lock:
+      if self._db.execute("UPDATE entries SET atime = ? WHERE key = ?", (time.time(), key)).rowcount == 0:  # noqa: TID251
+        self.stats.misses += 1
+        return None
+
+    try:
+      with open(self._path(key), "rb") as f:
+        dat = f.read()
+    except FileNotFoundError:
+      # removed outside of the cache
+      with self._lock:
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.stats.misses += 1
+      return None
+
+    with self._lock:
+      self.stats.hits += 1
+      self.stats.bytes_served += len(dat)
+    return dat
+
+  def __contains__(self, key: str) -> bool:
+    with self._lock:
+      return self._db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+  def put(self, key: str, dat: bytes) -> None:
+    with atomic_write_in_dir(self._path(key), mode="wb", overwrite=True) as f:
+      f.write(dat)
+    with self._lock:
+      # an upsert instead of INSERT OR REPLACE, whose implicit delete doesn't fire the triggers
+      self._db.execute("INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET size = excluded.size, atime = excluded.atime",
+                       (key, len(dat), time.time()))  # noqa: TID251
+      self.stats.bytes_written += len(dat)
+
+      if self.size() > self.max_size:
+        self.evict(int(self.max_size * EVICTION_TARGET))
+
+  def size(self) -> int:
+    with self._lock:
+      return self._db.execute("SELECT size FROM total").fetchone()[0]
+
+  def evict(self, target_size: int) -> None:
+    """Deletes the least recently accessed entries until the cache is at most target_size bytes"""
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        excess = self.size() - target_size
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM entries ORDER BY atime"):
+          if excess <= 0:
+            break
+          evicted.append((key,))
+          excess -= size
+          self.stats.bytes_evicted += size
+        self._db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self._db.execute("COMMIT")
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+
+    # other processes reading an evicted file keep their open handle
+    for key, in evicted:
+      try:
+        os.remove(self._path(key))
+      except FileNotFoundError:
+        pass
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+
+class ExistenceCache:
+  """Results of remote file existence checks, kept in an SQLite index in the download cache root"""
+
+  def __init__(self, root: str | None = None, ttl: float = EXISTS_TTL, negative_ttl: float = NOT_EXISTS_TTL):
+    self.root = root if root is not None else Paths.download_cache_root()
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+
+    os.makedirs(self.root, exist_ok=True)
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(os.path.join(self.root, EXISTS_INDEX_NAME), timeout=30, isolation_level=None, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, found INTEGER NOT NULL, checked REAL NOT NULL)")
+
+  def get(self, urls: list[str]) -> dict[str, bool]:
+    """Returns the results for the urls that were checked within their TTL"""
+    keys = {hash_256(url): url for url in urls}
+    key_list = list(keys)
+    now = time.time()  # noqa: TID251
+    ret = {}
+    with self._lock:
+      for i in range(0, len(key_list), MAX_QUERY_PARAMS):
+        batch = key_list[i:i + MAX_QUERY_PARAMS]
+        query = f"SELECT key, found, checked FROM results WHERE key IN ({','.join('?' * len(batch))})"
+        for key, found, checked in self._db.execute(query, batch):
+          if now - checked < (self.ttl if found else self.negative_ttl):
+            ret[keys[key]] = bool(found)
+    return ret
+
+  def put(self, results: dict[str, bool]) -> None:
+    now = time.time()  # noqa: TID251
+    with self._lock:
+      self._db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", [(hash_256(url), int(found), now) for url, found in results.items()])
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
@@ -1,8 +1,8 @@
-from collections.abc import Callable
+from collections.abc import Callable, Collection
 
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
-from openpilot.tools.lib.openpilotci import get_url
-from openpilot.tools.lib.filereader import DATA_ENDPOINT, file_exists, internal_source_available
+from openpilot.tools.lib.openpilotci import get_url, list_urls
+from openpilot.tools.lib.filereader import DATA_ENDPOINT, files_exist, internal_source_available
 from openpilot.tools.lib.route import Route, SegmentRange, FileName
 
 # When passed a tuple of file names, each source will return the first that exists (rlog.zst, rlog.bz2)
@@ -16,10 +16,8 @@ def comma_api_source(sr: SegmentRange, seg_idxs: list[int], fns: FileNames) -> d
   route = Route(sr.route_name)
 
   # comma api will have already checked if the file exists
-  if fns == FileName.RLOG:
-    return {seg: route.log_paths()[seg] for seg in seg_idxs if route.log_paths()[seg] is not None}
-  else:
-    return {seg: route.qlog_paths()[seg] for seg in seg_idxs if route.qlog_paths()[seg] is not None}
+  paths = route.log_paths() if fns == FileName.RLOG else route.qlog_paths()
+  return {seg: paths[seg] for seg in seg_idxs if paths[seg] is not None}
 
 
 def internal_source(sr: SegmentRange, seg_idxs: list[int], fns: FileNames, endpoint_url: str = DATA_ENDPOINT) -> dict[int, str]:
@@ -33,25 +31,33 @@ def internal_source(sr: SegmentRange, seg_idxs: list[int], fns: FileNames, endpo
 
 
 def openpilotci_source(sr: SegmentRange, seg_idxs: list[int], fns: FileNames) -> dict[int, str]:
-  return eval_source({seg: [get_url(sr.route_name, seg, fn) for fn in fns] for seg in seg_idxs})
+  # one listing of the route answers for all segments
+  try:
+    available = set(list_urls(f"{sr.route_name.replace('|', '/')}/"))
+  except Exception:
+    # listing isn't allowed, check each file instead
+    available = None
+
+  return eval_source({seg: [get_url(sr.route_name, seg, fn) for fn in fns] for seg in seg_idxs}, available)
 
 
 def comma_car_segments_source(sr: SegmentRange, seg_idxs: list[int], fns: FileNames) -> dict[int, str]:
   return eval_source({seg: get_comma_segments_url(sr.route_name, seg) for seg in seg_idxs})
 
 
-def eval_source(files: dict[int, list[str] | str]) -> dict[int, str]:
+def eval_source(files: dict[int, list[str] | str], available: Collection[str] | None = None) -> dict[int, str]:
   # Returns valid file URLs given a list of possible file URLs for each segment (e.g. rlog.bz2, rlog.zst)
+  # If the source already listed the files that exist, they are checked against available instead
+  candidates = {seg_idx: [urls] if isinstance(urls, str) else urls for seg_idx, urls in files.items()}
   valid_files: dict[int, str] = {}
 
-  for seg_idx, urls in files.items():
-    if isinstance(urls, str):
-      urls = [urls]
-
-    # Add first valid file URL
-    for url in urls:
-      if file_exists(url):
-        valid_files[seg_idx] = url
-        break
+  # Check the first choice of all segments at once, then the next choice for segments that are still missing
+  for i in range(max((len(urls) for urls in candidates.values()), default=0)):
+    urls = {seg_idx: urls[i] for seg_idx, urls in candidates.items() if seg_idx not in valid_files and i < len(urls)}
+    if available is not None:
+      exists = {url: url in available for url in urls.values()}
+    else:
+      exists = files_exist(urls.values())
+    valid_files |= {seg_idx: url for seg_idx, url in urls.items() if exists[url]}
 
-  return valid_files
+  return {seg_idx: valid_files[seg_idx] for seg_idx in candidates if seg_idx in valid_files}
@@ -1,13 +1,18 @@
 import os
 import posixpath
 import socket
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from functools import cache
 from openpilot.common.retry import retry
 from urllib.parse import urlparse
 
+from openpilot.tools.lib.download_cache import ExistenceCache
 from openpilot.tools.lib.url_file import URLFile
 
 DATA_ENDPOINT = os.getenv("DATA_ENDPOINT", "http://data-raw.comma.internal/")
+# concurrent HEAD requests when checking many files, these share URLFile's connection pool
+EXISTS_CONCURRENCY = int(os.getenv("FILE_EXISTS_CONCURRENCY", "32"))
 
 
 @cache
@@ -34,12 +39,43 @@ def resolve_name(fn):
   return fn
 
 
+def _url_exists(url: str) -> bool:
+  return URLFile(url).get_length_online() != -1
+
+
+def files_exist(fns: Iterable[str], cache: bool | None = None) -> dict[str, bool]:
+  """
+    Checks if each file exists. URLs are checked concurrently, and with the cache enabled
+    (FILEREADER_CACHE, or the cache input) results are reused across processes until their TTL expires.
+  """
+  paths = {fn: resolve_name(fn) for fn in fns}
+  urls = list(dict.fromkeys(p for p in paths.values() if p.startswith(("http://", "https://"))))
+  if cache is None:
+    cache = bool(int(os.environ.get("FILEREADER_CACHE", "0")))
+
+  found: dict[str, bool] = {}
+  if len(urls):
+    exists_cache = ExistenceCache() if cache else None
+    if exists_cache is not None:
+      found = exists_cache.get(urls)
+
+    to_check = [url for url in urls if url not in found]
+    if len(to_check):
+      with ThreadPoolExecutor(max_workers=min(EXISTS_CONCURRENCY, len(to_check)), thread_name_prefix="file_exists") as executor:
+        checked = dict(zip(to_check, executor.map(_url_exists, to_check), strict=True))
+      found |= checked
+      if exists_cache is not None:
+        exists_cache.put(checked)
+
+    if exists_cache is not None:
+      exists_cache.close()
+
+  return {fn: found[p] if p in found else os.path.exists(p) for fn, p in paths.items()}
+
+
 @cache
 def file_exists(fn):
-  fn = resolve_name(fn)
-  if fn.startswith(("http://", "https://")):
-    return URLFile(fn).get_length_online() != -1
-  return os.path.exists(fn)
+  return files_exist([fn])[fn]
 
 
 def FileReader(fn, debug=False):
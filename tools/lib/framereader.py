@@ -1,38 +1,106 @@
+import io
 import os
 import subprocess
 import json
+import threading
+import weakref
+import zipfile
 from collections.abc import Iterator
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import numpy as np
+from openpilot.tools.lib.download_cache import derived_cache_key
 from openpilot.tools.lib.filereader import FileReader, resolve_name
+from openpilot.tools.lib.url_file import URLFile
 from openpilot.tools.lib.exceptions import DataUnreadableError
-from openpilot.tools.lib.vidindex import hevc_index
+from openpilot.tools.lib.vidindex import get_hevc_dimensions, hevc_index
 
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+# bump when the stored video index layout changes, old indexes are then rebuilt
+VIDEO_INDEX_VERSION = 1
 
-class LRUCache:
+# decoded GOPs kept across all FrameReaders in bytes, when larger than what the open readers reserve
+GOP_CACHE_SIZE = int(os.getenv("FRAMEREADER_CACHE_SIZE", 0))
+# concurrent ffmpeg processes decoding GOPs
+DECODE_WORKERS = int(os.getenv("FRAMEREADER_DECODE_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
+
+
+class GOPCache:
+  """
+    Size bounded LRU cache of decoded GOPs, keyed by (file, pixel format, first frame index).
+    It holds capacity bytes, or the bytes reserved by the readers using it if that's more.
+  """
   def __init__(self, capacity: int):
     self._cache: OrderedDict = OrderedDict()
     self.capacity = capacity
+    self.reserved = 0
+    self.size = 0
 
-  def __getitem__(self, key):
+  def get(self, key) -> np.ndarray | None:
+    if key not in self._cache:
+      return None
     self._cache.move_to_end(key)
     return self._cache[key]
 
-  def __setitem__(self, key, value):
-    self._cache[key] = value
-    if len(self._cache) > self.capacity:
-        self._cache.popitem(last=False)
+  def put(self, key, gop: np.ndarray) -> None:
+    if key in self._cache:
+      self.size -= self._cache.pop(key).nbytes
+    self._cache[key] = gop
+    self.size += gop.nbytes
+    self._evict()
+
+  def reserve(self, nbytes: int) -> None:
+    self.reserved += nbytes
+
+  def release(self, nbytes: int) -> None:
+    self.reserved -= nbytes
+    self._evict()
+
+  def _evict(self) -> None:
+    # always keep the newest GOP, even when it alone exceeds the capacity
+    while self.size > max(self.capacity, self.reserved) and len(self._cache) > 1:
+      self.size -= self._cache.popitem(last=False)[1].nbytes
 
   def __contains__(self, key):
     return key in self._cache
 
 
+_gop_cache = GOPCache(GOP_CACHE_SIZE)
+_decode_pool: ThreadPoolExecutor | None = None
+# GOPs being decoded, until they are moved to the GOP cache
+_decoding: dict[tuple, Future[np.ndarray]] = {}
+# guards _gop_cache and _decoding, reentrant since a finished decode's callback runs in the thread adding it
+_gop_lock = threading.RLock()
+
+
+def _reset_decode_pool() -> None:
+  global _decode_pool, _decoding, _gop_lock
+  _decode_pool = None
+  _decoding = {}
+  _gop_lock = threading.RLock()
+
+
+def decode_pool() -> ThreadPoolExecutor:
+  # the threads only wait on ffmpeg processes, so decodes run in parallel
+  global _decode_pool
+  if _decode_pool is None:
+    _decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="framereader")
+  return _decode_pool
+
+
+os.register_at_fork(after_in_child=_reset_decode_pool)
+
+
+def _release_gop_cache(cache: GOPCache, nbytes: int) -> None:
+  with _gop_lock:
+    cache.release(nbytes)
+
+
 def assert_hvec(fn: str) -> None:
   with FileReader(fn) as f:
     header = f.read(4)
@@ -87,17 +155,47 @@ def get_index_data(fn: str, index_data: dict|None = None):
   stream = index_data["probe"]["streams"][0]
   return index_data["index"], index_data["global_prefix"], stream["width"], stream["height"]
 
-def get_video_index(fn):
-  assert_hvec(fn)
-  frame_types, dat_len, prefix = hevc_index(fn)
-  index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
-  probe = ffprobe(fn, "hevc")
+def _video_index_data(index: np.ndarray, prefix: bytes, w: int, h: int) -> dict:
   return {
     'index': index,
     'global_prefix': prefix,
-    'probe': probe
+    # same layout as ffprobe output, only with what readers use
+    'probe': {'streams': [{'width': w, 'height': h}]},
   }
 
+def load_video_index(key: str) -> dict | None:
+  if (raw := URLFile.cache().get(key)) is None:
+    return None
+  try:
+    with np.load(io.BytesIO(raw)) as dat:
+      return _video_index_data(dat['index'], dat['global_prefix'].tobytes(), int(dat['width']), int(dat['height']))
+  except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+    return None
+
+def save_video_index(key: str, index_data: dict) -> None:
+  stream = index_data['probe']['streams'][0]
+  f = io.BytesIO()
+  np.savez(f, index=index_data['index'], global_prefix=np.frombuffer(index_data['global_prefix'], dtype=np.uint8),
+           width=stream['width'], height=stream['height'])
+  URLFile.cache().put(key, f.getvalue())
+
+def get_video_index(fn, cache: bool | None = None):
+  # with FILEREADER_CACHE, or the cache input, indexes are download cache entries keyed by URL or by path and modification time for local files
+  if cache is None:
+    cache = bool(int(os.environ.get("FILEREADER_CACHE", "0")))
+  key = derived_cache_key(resolve_name(fn), f"vidindex_v{VIDEO_INDEX_VERSION}.npz")
+  if cache and (index_data := load_video_index(key)) is not None:
+    return index_data
+
+  assert_hvec(fn)
+  frame_types, dat_len, prefix = hevc_index(fn)
+  index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
+  w, h = get_hevc_dimensions(prefix)
+  index_data = _video_index_data(index, prefix, w, h)
+  if cache:
+    save_video_index(key, index_data)
+  return index_data
+
 
 class FfmpegDecoder:
   def __init__(self, fn: str, index_data: dict|None = None,
@@ -107,6 +205,9 @@ class FfmpegDecoder:
     self.frame_count = len(self.index) - 1          # sentinel row at the end
     self.iframes = np.where(self.index[:, 0] == HEVC_SLICE_I)[0]
     self.pix_fmt = pix_fmt
+    # bytes of the longest decoded GOP
+    self.frame_size = self.w * self.h * 3 if pix_fmt == "rgb24" else self.w * self.h * 3 // 2
+    self.gop_size = self.frame_size * int(np.diff(self.iframes, prepend=0, append=self.frame_count).max())
 
   def _gop_bounds(self, frame_idx: int):
     f_b = frame_idx
@@ -123,23 +224,78 @@ class FfmpegDecoder:
   def get_gop_start(self, frame_idx: int):
     return self.iframes[np.searchsorted(self.iframes, frame_idx, side="right") - 1]
 
+  def _decode_range(self, off_b: int, off_e: int) -> np.ndarray:
+    with FileReader(self.fn) as f:
+      f.seek(off_b)
+      raw = self.prefix + f.read(off_e - off_b)
+    gop = decompress_video_data(raw, self.w, self.h, self.pix_fmt)
+    # shared by all readers through the GOP cache
+    gop.setflags(write=False)
+    return gop
+
+  def _decode_gop_async(self, f_b: int, off_b: int, off_e: int) -> Future[np.ndarray]:
+    # called with _gop_lock held
+    key = (self.fn, self.pix_fmt, f_b)
+    if key in _decoding:
+      return _decoding[key]
+
+    def done(future: Future[np.ndarray]) -> None:
+      # decoded GOPs go to the cache whether or not they're asked for, so read-ahead is bounded by its size
+      with _gop_lock:
+        if future.exception() is None:
+          _gop_cache.put(key, future.result())
+        if _decoding.get(key) is future:
+          del _decoding[key]
+
+    future = _decoding[key] = decode_pool().submit(self._decode_range, off_b, off_e)
+    future.add_done_callback(done)
+    return future
+
+  def get_gop(self, frame_idx: int, readahead: int = 0) -> tuple[int, np.ndarray]:
+    """
+      Returns the first frame index and all decoded frames of the GOP containing frame_idx, from the shared GOP cache if possible.
+      Frames are views into the decoded GOP, readahead starts decoding the following GOPs in the background.
+    """
+    f_b, f_e, off_b, off_e = self._gop_bounds(frame_idx)
+    with _gop_lock:
+      gop = _gop_cache.get((self.fn, self.pix_fmt, f_b))
+      future = self._decode_gop_async(f_b, off_b, off_e) if gop is None else None
+
+    next_fidx = f_e
+    for _ in range(readahead):
+      if next_fidx >= self.frame_count:
+        break
+      n_b, n_e, n_off_b, n_off_e = self._gop_bounds(next_fidx)
+      with _gop_lock:
+        if (self.fn, self.pix_fmt, n_b) not in _gop_cache:
+          self._decode_gop_async(n_b, n_off_b, n_off_e)
+      next_fidx = n_e
+
+    if future is not None:
+      gop = future.result()
+    return f_b, gop
+
   def get_iterator(self, start_fidx: int = 0, end_fidx: int|None = None,
                    frame_skip: int = 1) -> Iterator[tuple[int, np.ndarray]]:
     end_fidx = end_fidx or self.frame_count
     fidx = start_fidx
-    while fidx < end_fidx:
-      f_b, f_e, off_b, off_e = self._gop_bounds(fidx)
-      with FileReader(self.fn) as f:
-        f.seek(off_b)
-        raw = self.prefix + f.read(off_e - off_b)
-      # number of frames to discard inside this GOP before the wanted one
-      for i, frm in enumerate(decompress_video_data(raw, self.w, self.h, self.pix_fmt)):
-        fidx = f_b + i
-        if fidx >= end_fidx:
-          return
-        elif fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
-          yield fidx, frm
-      fidx += 1
+    # keep the GOP read ahead until it's needed
+    reserved, cache = 2 * self.gop_size, _gop_cache
+    with _gop_lock:
+      cache.reserve(reserved)
+    try:
+      while fidx < end_fidx:
+        f_b, gop = self.get_gop(fidx, readahead=1)
+        # number of frames to discard inside this GOP before the wanted one
+        for i, frm in enumerate(gop):
+          fidx = f_b + i
+          if fidx >= end_fidx:
+            return
+          elif fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
+            yield fidx, frm
+        fidx = max(fidx, f_b + len(gop) - 1) + 1
+    finally:
+      _release_gop_cache(cache, reserved)
 
 def FrameIterator(fn: str, index_data: dict|None=None,
                         pix_fmt: str = "rgb24",
@@ -150,24 +306,21 @@ def FrameIterator(fn: str, index_data: dict|None=None,
 
 class FrameReader:
   def __init__(self, fn: str, index_data: dict|None = None,
-               cache_size: int = 30, pix_fmt: str = "rgb24"):
+               cache_size: int = 30, pix_fmt: str = "rgb24", readahead: bool | int = False):
     self.decoder = FfmpegDecoder(fn, index_data, pix_fmt)
     self.iframes = self.decoder.iframes
-    self._cache: LRUCache = LRUCache(cache_size)
     self.w, self.h, self.frame_count, = self.decoder.w, self.decoder.h, self.decoder.frame_count
     self.pix_fmt = pix_fmt
+    # number of following GOPs to decode in the background on each get
+    self.readahead = int(readahead)
 
-    self.it: Iterator[tuple[int, np.ndarray]] | None = None
-    self.fidx = -1
+    # frames live in the GOP cache shared by all readers. while this reader is alive, it holds cache_size of our frames
+    # or the GOPs around the last one read, whichever is more
+    reserved = max(cache_size * self.decoder.frame_size, (self.readahead + 2) * self.decoder.gop_size)
+    with _gop_lock:
+      _gop_cache.reserve(reserved)
+    weakref.finalize(self, _release_gop_cache, _gop_cache, reserved)
 
   def get(self, fidx:int):
-    if fidx in self._cache:  # If frame is cached, return it
-      return self._cache[fidx]
-    read_start = self.decoder.get_gop_start(fidx)
-    if not self.it or fidx < self.fidx or read_start != self.decoder.get_gop_start(self.fidx):  # If the frame is in a different GOP, reset the iterator
-      self.it = self.decoder.get_iterator(read_start)
-      self.fidx = -1
-    while self.fidx < fidx:
-      self.fidx, frame = next(self.it)
-      self._cache[self.fidx] = frame
-    return self._cache[fidx]
+    f_b, gop = self.decoder.get_gop(fidx, readahead=self.readahead)
+    return gop[fidx - f_b]
@@ -0,0 +1,85 @@
+import capnp
+import io
+import zipfile
+import numpy as np
+from collections.abc import Iterable
+
+from openpilot.tools.lib.download_cache import derived_cache_key
+from openpilot.tools.lib.url_file import URLFile
+
+# bump when the stored layout changes, old indexes are then rebuilt
+INDEX_VERSION = 1
+NON_UNION = -1
+
+
+def log_index_key(fn: str) -> str:
+  return derived_cache_key(fn, f"index_v{INDEX_VERSION}.npz")
+
+
+class LogIndex:
+  """Union type, logMonoTime and byte span in the decompressed log of every event in a log file"""
+
+  def __init__(self, types: list[str], which: np.ndarray, log_mono_time: np.ndarray, offset: np.ndarray, length: np.ndarray):
+    self.types = types
+    self.which = which
+    self.log_mono_time = log_mono_time
+    self.offset = offset
+    self.length = length
+
+  def __len__(self) -> int:
+    return len(self.which)
+
+  def select(self, msg_types: Iterable[str] | None = None, start_time: int | None = None, end_time: int | None = None,
+             only_union_types: bool = False) -> np.ndarray:
+    """Returns the positions of the matching events, in log order"""
+    mask = np.ones(len(self), dtype=bool)
+    if msg_types is not None:
+      mask &= np.isin(self.which, [self.types.index(t) for t in msg_types if t in self.types])
+    elif only_union_types:
+      mask &= self.which != NON_UNION
+    if start_time is not None:
+      mask &= self.log_mono_time >= start_time
+    if end_time is not None:
+      mask &= self.log_mono_time < end_time
+    return np.flatnonzero(mask)
+
+  def save(self, key: str) -> None:
+    # stored as a download cache entry, so it counts towards the cache size and gets evicted with it
+    f = io.BytesIO()
+    np.savez(f, types=np.array(self.types, dtype=str), which=self.which, log_mono_time=self.log_mono_time,
+             offset=self.offset, length=self.length)
+    URLFile.cache().put(key, f.getvalue())
+
+  @staticmethod
+  def load(key: str) -> 'LogIndex | None':
+    if (raw := URLFile.cache().get(key)) is None:
+      return None
+    try:
+      with np.load(io.BytesIO(raw)) as dat:
+        return LogIndex(dat['types'].tolist(), dat['which'], dat['log_mono_time'], dat['offset'], dat['length'])
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+      # truncated or from an incompatible version, rebuilt by the caller
+      return None
+
+
+class LogIndexBuilder:
+  def __init__(self):
+    self._types: dict[str, int] = {}
+    self._which: list[int] = []
+    self._log_mono_time: list[int] = []
+    self._offset: list[int] = []
+    self._length: list[int] = []
+
+  def add(self, offset: int, length: int, evt) -> None:
+    try:
+      which = self._types.setdefault(evt.which(), len(self._types))
+    except capnp.KjException:
+      which = NON_UNION
+    self._which.append(which)
+    self._log_mono_time.append(evt.logMonoTime)
+    self._offset.append(offset)
+    self._length.append(length)
+
+  def finish(self) -> LogIndex:
+    return LogIndex(list(self._types), np.array(self._which, dtype=np.int16), np.array(self._log_mono_time, dtype=np.uint64),
+                    np.array(self._offset, dtype=np.uint64), np.array(self._length, dtype=np.uint32))
@@ -1,4 +1,13 @@
+import capnp
 import numpy as np
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+# initial rows of a column, grown by doubling
+COLUMN_CHUNK_SIZE = 1024
+
+# message types mapped to the field paths to extract, e.g. {"carState": ["vEgo", "cruiseState/speed"]}
+Projection = dict[str, list[str]]
 
 
 def flatten_type_dict(d, sep="/", prefix=None):
@@ -76,6 +85,153 @@ def msgs_to_time_series(msgs):
   return values
 
 
+@dataclass
+class RaggedArray:
+  """Variable length rows stored as a flat values array and row offsets (len(self) + 1 entries)"""
+  offsets: np.ndarray
+  values: np.ndarray
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+  def take(self, idxs: np.ndarray) -> 'RaggedArray':
+    lengths = np.diff(self.offsets)[idxs]
+    offsets = np.zeros(len(idxs) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # gather every value of the selected rows in one fancy index
+    starts = np.repeat(self.offsets[:-1][idxs] - offsets[:-1], lengths)
+    return RaggedArray(offsets, self.values[starts + np.arange(offsets[-1])])
+
+  @staticmethod
+  def from_2d(arr: np.ndarray) -> 'RaggedArray':
+    return RaggedArray(np.arange(len(arr) + 1, dtype=np.int64) * arr.shape[1], arr.reshape(-1))
+
+  @staticmethod
+  def concatenate(arrs: list['RaggedArray']) -> 'RaggedArray':
+    shifts = np.cumsum([0] + [len(a.values) for a in arrs[:-1]])
+    offsets = np.concatenate([arrs[0].offsets[:1]] + [a.offsets[1:] + shift for a, shift in zip(arrs, shifts, strict=True)])
+    return RaggedArray(offsets, np.concatenate([a.values for a in arrs]))
+
+
+def _to_value(value):
+  if isinstance(value, capnp.lib.capnp._DynamicEnum):
+    return str(value)
+  return value
+
+
+class _Column:
+  """Preallocated column, grown in chunks on append"""
+  def __init__(self):
+    self.arr: np.ndarray | None = None
+    self.n = 0
+
+  def _reserve(self, n: int, dtype) -> None:
+    if self.arr is None:
+      self.arr = np.empty(max(n, COLUMN_CHUNK_SIZE), dtype=dtype)
+    elif self.n + n > len(self.arr):
+      self.arr = np.resize(self.arr, max(self.n + n, 2 * len(self.arr)))
+
+  def append(self, value) -> None:
+    value = _to_value(value)
+    self._reserve(1, object if isinstance(value, str | bytes) else np.asarray(value).dtype)
+    self.arr[self.n] = value
+    self.n += 1
+
+  def extend(self, values) -> None:
+    values = [_to_value(v) for v in values]
+    if len(values):
+      self._reserve(len(values), object if isinstance(values[0], str | bytes) else np.asarray(values[0]).dtype)
+      self.arr[self.n:self.n + len(values)] = values
+      self.n += len(values)
+
+  def finish(self) -> np.ndarray:
+    return self.arr[:self.n] if self.arr is not None else np.empty(0)
+
+
+class _ListColumn:
+  """List field, stored as a 2D array if all rows have the same length and as a RaggedArray otherwise"""
+  def __init__(self):
+    self.values = _Column()
+    self.offsets = [0]
+
+  def append(self, value) -> None:
+    self.values.extend(value)
+    self.offsets.append(self.values.n)
+
+  def finish(self) -> np.ndarray | RaggedArray:
+    offsets = np.array(self.offsets, dtype=np.int64)
+    values = self.values.finish()
+    lengths = np.diff(offsets)
+    if len(lengths) and np.all(lengths == lengths[0]):
+      return values.reshape(len(lengths), lengths[0])
+    return RaggedArray(offsets, values)
+
+
+def _get_field(obj, path: list[str]):
+  for i, name in enumerate(path):
+    # lists of structs map the rest of the path over their elements
+    if isinstance(obj, capnp.lib.capnp._DynamicListReader):
+      return [_get_field(o, path[i:]) for o in obj]
+    obj = getattr(obj, name)
+
+  if isinstance(obj, capnp.lib.capnp._DynamicStructReader):
+    raise ValueError(f"field path {'/'.join(path)} does not point to a primitive or a list of primitives")
+  return obj
+
+
+def msgs_to_columns(msgs: Iterable, projection: Projection) -> dict[str, dict[str, np.ndarray | RaggedArray]]:
+  """
+    Columnar msgs_to_time_series, only extracting the projected fields.
+    Time series are returned in log order, use sort_columns or LogReader.time_series_columns to sort them by time.
+  """
+  paths = {typ: [f.split("/") for f in fields] for typ, fields in projection.items()}
+  columns: dict[str, dict[str, _Column | _ListColumn]] = {}
+  for msg in msgs:
+    typ = msg.which()
+    if typ not in paths:
+      continue
+
+    group = columns.setdefault(typ, {"t": _Column(), "_valid": _Column()})
+    group["t"].append(msg.logMonoTime / 1.0e9)
+    group["_valid"].append(msg.valid)
+
+    evt = getattr(msg, typ)
+    for path in paths[typ]:
+      name = "/".join(path)
+      value = _get_field(evt, path)
+      if name not in group:
+        is_list = isinstance(value, list | capnp.lib.capnp._DynamicListReader)
+        group[name] = _ListColumn() if is_list else _Column()
+      group[name].append(value)
+
+  return {typ: {name: col.finish() for name, col in group.items()} for typ, group in columns.items()}
+
+
+def concatenate_columns(parts: list[dict[str, dict[str, np.ndarray | RaggedArray]]]) -> dict[str, dict[str, np.ndarray | RaggedArray]]:
+  values: dict[str, dict[str, np.ndarray | RaggedArray]] = {}
+  for typ in dict.fromkeys(typ for part in parts for typ in part):
+    groups = [part[typ] for part in parts if typ in part]
+    values[typ] = {}
+    for name in groups[0]:
+      cols = [g[name] for g in groups]
+      if all(isinstance(c, np.ndarray) for c in cols) and len({c.shape[1:] for c in cols}) == 1:
+        values[typ][name] = np.concatenate(cols)
+      else:
+        values[typ][name] = RaggedArray.concatenate([c if isinstance(c, RaggedArray) else RaggedArray.from_2d(c) for c in cols])
+  return values
+
+
+def sort_columns(values: dict[str, dict[str, np.ndarray | RaggedArray]]) -> dict[str, dict[str, np.ndarray | RaggedArray]]:
+  for group in values.values():
+    order = np.argsort(group["t"], kind="stable")
+    for name, col in group.items():
+      group[name] = col.take(order) if isinstance(col, RaggedArray) else col[order]
+  return values
+
+
 if __name__ == "__main__":
   import sys
   from openpilot.tools.lib.logreader import LogReader
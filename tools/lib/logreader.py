@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 import bz2
+import concurrent.futures
 from functools import partial
 import multiprocessing
 import capnp
 import enum
+import heapq
+import itertools
+import mmap
 import os
 import pathlib
 import sys
+import tempfile
+import threading
 import tqdm
 import urllib.parse
 import warnings
@@ -17,16 +23,27 @@ from typing import cast
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
+from cereal.framing import segment_table
 from openpilot.common.swaglog import cloudlog
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.file_sources import comma_api_source, internal_source, openpilotci_source, comma_car_segments_source, Source
+from openpilot.tools.lib.log_index import LogIndex, LogIndexBuilder, log_index_key
 from openpilot.tools.lib.route import SegmentRange, FileName
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.log_time_series import Projection, concatenate_columns, msgs_to_columns, msgs_to_time_series, sort_columns
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
+# compressed bytes read per step when streaming, keeps HTTP requests for remote files large
+STREAM_CHUNK_SIZE = 1024 * 1024
+# max number of events held back for reordering when streaming with sort_by_time
+REORDER_WINDOW = 10000
+# segments loaded ahead of the one being iterated, opt-in since loaded segments stay in memory until the LogReader is freed
+PREFETCH_SEGMENTS = 0
+# run_across_segments(shared_memory=True) passes worker results through files here, tmpfs where available
+SHARED_MEMORY_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
 
 def save_log(dest, log_msgs, compress=True):
   dat = b"".join(msg.as_builder().to_bytes() for msg in log_msgs)
@@ -50,13 +67,103 @@ def decompress_stream(data: bytes):
   return decompressed_data
 
 
+def _decompress_chunks(chunks: Iterator[bytes], new_decompressor) -> Iterator[bytes]:
+  # concatenated bz2 streams and zstd frames are both valid log files, start a new decompressor after each one
+  dctx = new_decompressor()
+  for chunk in chunks:
+    while chunk:
+      yield dctx.decompress(chunk)
+      chunk = b""
+      if dctx.eof:
+        chunk = dctx.unused_data
+        dctx = new_decompressor()
+
+
+def _read_chunks(f, head: bytes, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+  chunk = head
+  while chunk:
+    yield chunk
+    chunk = f.read(chunk_size)
+
+
+def decompress_chunks(f, ext: str | None = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+  """Incrementally decompresses a bz2, zstd or uncompressed log from a file-like object"""
+  head = f.read(chunk_size)
+  chunks = _read_chunks(f, head, chunk_size)
+  if ext == ".bz2" or head.startswith(b'BZh9'):
+    return _decompress_chunks(chunks, bz2.BZ2Decompressor)
+  elif ext == ".zst" or head.startswith(b'\x28\xB5\x2F\xFD'):
+    return _decompress_chunks(chunks, lambda: zstd.ZstdDecompressor().decompressobj())
+  return chunks
+
+
+def _event_size(buf: bytearray, pos: int) -> int | None:
+  try:
+    table = segment_table(buf, pos)
+  except ValueError as e:
+    raise capnp.KjException(str(e)) from e
+  if table is None:
+    return None
+  header_size, segment_sizes = table
+  return header_size + 8 * sum(segment_sizes)
+
+
+def _iter_frames(chunks: Iterable[bytes]) -> Iterator[tuple[int, bytearray, int, int]]:
+  # yields (stream offset, buffer, buffer position, size) per event, the buffer is only valid until the next step
+  buf = bytearray()
+  buf_offset = 0
+  for chunk in chunks:
+    buf += chunk
+    pos = 0
+    while (size := _event_size(buf, pos)) is not None and pos + size <= len(buf):
+      yield buf_offset + pos, buf, pos, size
+      pos += size
+    del buf[:pos]
+    buf_offset += pos
+
+  if len(buf):
+    raise capnp.KjException(f"log ends with a truncated event ({len(buf)} bytes)")
+
+
+def split_events(chunks: Iterable[bytes]) -> Iterator[bytes]:
+  """Splits a stream of decompressed log bytes into serialized events, buffering at most one partial event"""
+  for _, buf, pos, size in _iter_frames(chunks):
+    yield bytes(buf[pos:pos + size])
+
+
+def select_events(chunks: Iterable[bytes], offsets: Iterable[int]) -> Iterator[bytes]:
+  """Yields only the events starting at the given ascending offsets, stopping after the last one"""
+  targets = iter(offsets)
+  target = next(targets, None)
+  for offset, buf, pos, size in _iter_frames(chunks):
+    if target is None:
+      return
+    if offset == target:
+      yield bytes(buf[pos:pos + size])
+      target = next(targets, None)
+
+
+def sort_window(events: Iterable, window: int = REORDER_WINDOW) -> Iterator:
+  """Sorts events by logMonoTime, assuming no event is more than window events away from its sorted position"""
+  heap: list = []
+  counter = itertools.count()
+  for evt in events:
+    heapq.heappush(heap, (evt.logMonoTime, next(counter), evt))
+    if len(heap) > window:
+      yield heapq.heappop(heap)[2]
+  while heap:
+    yield heapq.heappop(heap)[2]
+
+
 class CachedEventReader:
-  __slots__ = ('_evt', '_enum')
+  __slots__ = ('_evt', '_enum', '_buf')
 
-  def __init__(self, evt: capnp._DynamicStructReader, _enum: str | None = None):
+  def __init__(self, evt: capnp._DynamicStructReader, _enum: str | None = None, _buf=None):
     """All capnp attribute accesses are expensive, and which() is often called multiple times"""
     self._evt = evt
     self._enum: str | None = _enum
+    # keeps a buffer alive that the reader points into without holding a reference itself, like a shared memory mapping
+    self._buf = _buf
 
   # fast pickle support
   def __reduce__(self):
@@ -108,6 +215,10 @@ class _LogFileReader:
       # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
       dat = decompress_stream(dat)
 
+    self.size = len(dat)
+    self._dat = dat
+    self._spans: list[int] | None = None
+    self._positions: dict[int, int] = {}
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
     self._ents = []
@@ -117,19 +228,116 @@ class _LogFileReader:
     except capnp.KjException:
       warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
+    # the i-th event is the i-th frame in the decompressed log, needed to find raw bytes after sorting
+    self._log_order = self._ents
     if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+      self._ents = sorted(self._ents, key=lambda x: x.logMonoTime)
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
-      if self._only_union_types:
-        try:
-          ent.which()
-          yield ent
-        except capnp.lib.capnp.KjException:
-          pass
-      else:
-        yield ent
+    yield from _filter_union_types(self._ents) if self._only_union_types else self._ents
+
+  def raw_event(self, e) -> memoryview | None:
+    """Serialized event sliced from the decompressed log, or None if it wasn't read from it"""
+    if self._spans is None:
+      pos, self._spans = 0, [0]
+      while pos < len(self._dat) and len(self._spans) <= len(self._log_order):
+        pos += cast(int, _event_size(self._dat, pos))
+        self._spans.append(pos)
+      self._positions = {id(e): i for i, e in enumerate(self._log_order)}
+
+    i = self._positions.get(id(e))
+    return memoryview(self._dat)[self._spans[i]:self._spans[i + 1]] if i is not None else None
+
+  def raw_events(self, ents: Iterable) -> Iterator[bytes | memoryview]:
+    """Serialized events, sliced from the decompressed log when they were read from it instead of reserialized"""
+    for e in ents:
+      dat = self.raw_event(e)
+      yield dat if dat is not None else _event_bytes(e)
+
+
+class _StreamingLogFileReader:
+  def __init__(self, fn, only_union_types=False, sort_by_time=False, reorder_window=REORDER_WINDOW):
+    """Reads the log on every iteration, only holding a compressed chunk and the reorder window in memory"""
+    self.fn = fn
+    self._only_union_types = only_union_types
+    self._sort_by_time = sort_by_time
+    self._reorder_window = reorder_window
+
+    _, self._ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+    if self._ext not in ('', '.bz2', '.zst'):
+      # old rlogs weren't compressed
+      raise ValueError(f"unknown extension {self._ext}")
+
+  def _events(self) -> Iterator[CachedEventReader]:
+    for _, _, ent in self.events_with_spans():
+      yield ent
+
+  def events_with_spans(self) -> Iterator[tuple[int, int, CachedEventReader]]:
+    """Yields (offset, length, event) with the byte span of each event in the decompressed log"""
+    with FileReader(self.fn) as f:
+      try:
+        for offset, buf, pos, size in _iter_frames(decompress_chunks(f, self._ext)):
+          with capnp_log.Event.from_bytes(bytes(buf[pos:pos + size])) as evt:
+            yield offset, size, CachedEventReader(evt)
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  def events_at(self, offsets: Iterable[int]) -> Iterator[CachedEventReader]:
+    """Parses only the events at the given ascending offsets in the decompressed log"""
+    with FileReader(self.fn) as f:
+      for dat in select_events(decompress_chunks(f, self._ext), offsets):
+        with capnp_log.Event.from_bytes(dat) as evt:
+          yield CachedEventReader(evt)
+
+  def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
+    ents = self._events()
+    if self._only_union_types:
+      ents = _filter_union_types(ents)
+    if self._sort_by_time:
+      ents = sort_window(ents, self._reorder_window)
+    yield from ents
+
+
+def _event_bytes(evt) -> bytes:
+  if isinstance(evt, CachedEventReader):
+    evt = evt._evt
+  if not isinstance(evt, capnp._DynamicStructReader | capnp._DynamicStructBuilder):
+    raise TypeError(f"expected log events, got {type(evt).__name__}")
+  return evt.as_builder().to_bytes() if isinstance(evt, capnp._DynamicStructReader) else evt.to_bytes()
+
+
+def _write_shared_events(lr, ents: list) -> tuple[str, list[int], list[str | None]]:
+  raw = list(lr.raw_events(ents)) if isinstance(lr, _LogFileReader) else [_event_bytes(e) for e in ents]
+  with tempfile.NamedTemporaryFile(dir=SHARED_MEMORY_ROOT, prefix="logreader_", delete=False) as f:
+    f.writelines(raw)
+  return f.name, list(itertools.accumulate((len(r) for r in raw), initial=0)), [getattr(e, '_enum', None) for e in ents]
+
+
+def _map_shared_events(path: str, offsets: list[int], enums: list[str | None]) -> list[CachedEventReader]:
+  try:
+    if offsets[-1] == 0:
+      return []
+    with open(path, "rb") as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    # the mapping stays valid after unlinking and is freed with the last event referencing it
+    os.unlink(path)
+
+  dat = memoryview(buf)
+  ents = []
+  for start, end, which in zip(offsets[:-1], offsets[1:], enums, strict=True):
+    with capnp_log.Event.from_bytes(dat[start:end]) as evt:
+      ents.append(CachedEventReader(evt, which, buf))
+  return ents
+
+
+def _filter_union_types(ents: Iterable[CachedEventReader]) -> Iterator[CachedEventReader]:
+  for ent in ents:
+    try:
+      ent.which()
+      yield ent
+    except capnp.lib.capnp.KjException:
+      pass
 
 
 class ReadMode(enum.StrEnum):
@@ -243,7 +451,9 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               sources: list[Source] = None, sort_by_time=False, only_union_types=False):
+               sources: list[Source] = None, sort_by_time=False, only_union_types=False,
+               streaming=False, reorder_window=REORDER_WINDOW, use_index=False,
+               prefetch=PREFETCH_SEGMENTS):
     if sources is None:
       sources = [internal_source, comma_api_source, openpilotci_source, comma_car_segments_source]
 
@@ -255,30 +465,115 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
-
-    self.__lrs: dict[int, _LogFileReader] = {}
+    # streaming re-reads the files on every iteration with bounded memory, sort_by_time then only reorders within the window
+    self.streaming = streaming
+    self.reorder_window = reorder_window
+    # filter, first and time_range only parse matching events using a per-segment index, kept in the download cache with FILEREADER_CACHE
+    self.use_index = use_index
+    # iteration downloads and decompresses the next segments in a thread pool, 0 disables prefetching
+    self.prefetch = prefetch
+
+    self.__lrs: dict[int, _LogFileReader | _StreamingLogFileReader] = {}
+    # segments being loaded, by the prefetch threads or another caller
+    self.__loading: dict[int, concurrent.futures.Future] = {}
+    self.__lock = threading.Lock()
+    self.__indexes: dict[str, LogIndex] = {}
     self.reset()
 
+  def __getstate__(self):
+    # run_across_segments pickles the LogReader, locks and futures stay in this process
+    state = self.__dict__.copy()
+    del state["_LogReader__loading"], state["_LogReader__lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.__loading = {}
+    self.__lock = threading.Lock()
+
   def _get_lr(self, i):
-    if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
-    return self.__lrs[i]
+    # also called from the prefetch threads, which can still be loading a segment that an iteration or another call needs.
+    # the first caller loads it and the others wait for the same reader
+    with self.__lock:
+      if i in self.__lrs:
+        return self.__lrs[i]
+      waiting = i in self.__loading
+      future = self.__loading.setdefault(i, concurrent.futures.Future())
+    if waiting:
+      return future.result()
+
+    try:
+      if self.streaming:
+        lr = _StreamingLogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time,
+                                     only_union_types=self.only_union_types, reorder_window=self.reorder_window)
+      else:
+        lr = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+    except BaseException as e:
+      # a later call tries again
+      with self.__lock:
+        del self.__loading[i]
+      future.set_exception(e)
+      raise
+
+    with self.__lock:
+      self.__lrs[i] = lr
+      del self.__loading[i]
+    future.set_result(lr)
+    return lr
 
   def __iter__(self):
-    for i in range(len(self.logreader_identifiers)):
-      yield from self._get_lr(i)
+    num_segs = len(self.logreader_identifiers)
+    # streaming readers only load while being iterated, nothing to prefetch
+    if self.prefetch < 1 or self.streaming or num_segs < 2:
+      for i in range(num_segs):
+        yield from self._get_lr(i)
+      return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.prefetch)
+    futures: dict[int, concurrent.futures.Future] = {}
+    try:
+      next_i = 0
+      for i in range(num_segs):
+        # keep up to prefetch segments ahead of this one loading
+        while next_i < num_segs and len(futures) < self.prefetch:
+          if next_i not in self.__lrs:
+            futures[next_i] = executor.submit(self._get_lr, next_i)
+          next_i += 1
+
+        # waits for the prefetch of this segment, if there is one
+        futures.pop(i, None)
+        yield from self._get_lr(i)
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
 
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
 
-  def run_across_segments(self, num_processes, func, disable_tqdm=False, desc=None):
+  def _run_on_segment_shared(self, func, i):
+    lr = self._get_lr(i)
+    return _write_shared_events(lr, list(func(lr)))
+
+  def run_across_segments(self, num_processes, func, disable_tqdm=False, desc=None, shared_memory=False):
+    """
+      Runs func on each segment in a process pool and concatenates the returned lists.
+      With shared_memory, func must return log events. Workers write their raw bytes to shared memory
+      and the parent maps them as zero-copy readers instead of unpickling each event.
+    """
+    run = self._run_on_segment_shared if shared_memory else self._run_on_segment
     with multiprocessing.Pool(num_processes) as pool:
       ret = []
       num_segs = len(self.logreader_identifiers)
-      for p in tqdm.tqdm(pool.imap(partial(self._run_on_segment, func), range(num_segs)), total=num_segs, disable=disable_tqdm, desc=desc):
-        ret.extend(p)
+      for p in tqdm.tqdm(pool.imap(partial(run, func), range(num_segs)), total=num_segs, disable=disable_tqdm, desc=desc):
+        ret.extend(_map_shared_events(*p) if shared_memory else p)
       return ret
 
+  def raw_events(self, ents: Iterable) -> Iterator[bytes | memoryview]:
+    """Serialized events, sliced from the decompressed logs of loaded segments when they were read from them instead of reserialized"""
+    lrs = [lr for lr in self.__lrs.values() if isinstance(lr, _LogFileReader)]
+    for e in ents:
+      dat = next((dat for lr in lrs if (dat := lr.raw_event(e)) is not None), None)
+      yield dat if dat is not None else _event_bytes(e)
+
   def reset(self):
     self.logreader_identifiers = []
     for identifier in self.identifier:
@@ -288,16 +583,73 @@ class LogReader:
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
+  def _index_segment(self, i) -> tuple[LogIndex, list[CachedEventReader] | None]:
+    # returns the cached index, or builds it with a full pass and returns the parsed events too
+    fn = self.logreader_identifiers[i]
+    if (index := self.__indexes.get(fn)) is not None:
+      return index, None
+    key = log_index_key(fn)
+    cache = bool(int(os.environ.get("FILEREADER_CACHE", "0")))
+    if cache and (index := LogIndex.load(key)) is not None:
+      self.__indexes[fn] = index
+      return index, None
+
+    builder = LogIndexBuilder()
+    ents = []
+    for offset, length, ent in _StreamingLogFileReader(fn).events_with_spans():
+      builder.add(offset, length, ent)
+      ents.append(ent)
+    index = self.__indexes[fn] = builder.finish()
+    if cache:
+      index.save(key)
+    return index, ents
+
+  def _indexed(self, msg_types: list[str] | None = None, start_time: int | None = None, end_time: int | None = None):
+    for i in range(len(self.logreader_identifiers)):
+      index, ents = self._index_segment(i)
+      sel = index.select(msg_types, start_time, end_time, only_union_types=self.only_union_types)
+      if not len(sel):
+        continue
+
+      if ents is not None:
+        msgs = (ents[j] for j in sel)
+      else:
+        msgs = _StreamingLogFileReader(self.logreader_identifiers[i]).events_at(index.offset[sel].tolist())
+
+      if self.sort_by_time:
+        msgs = sorted(msgs, key=lambda m: m.logMonoTime)
+      yield from msgs
+
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    msgs = self._indexed([msg_type]) if self.use_index else filter(lambda m: m.which() == msg_type, self)
+    return (getattr(m, m.which()) for m in msgs)
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def time_range(self, start_time: int | None = None, end_time: int | None = None, msg_types: list[str] | None = None):
+    """Events with start_time <= logMonoTime < end_time, optionally only of the given types"""
+    if self.use_index:
+      return self._indexed(msg_types, start_time, end_time)
+    return (m for m in self if (start_time is None or m.logMonoTime >= start_time) and (end_time is None or m.logMonoTime < end_time) and
+            (msg_types is None or m.which() in msg_types))
+
   @property
   def time_series(self):
+    """Time series of every field, time_series_columns is much faster for only some fields"""
     return msgs_to_time_series(self)
 
+  def time_series_columns(self, projection: Projection, num_processes: int = 1):
+    """Time series of only the projected fields, extracted per segment in parallel when num_processes > 1"""
+    func = partial(msgs_to_columns, projection=projection)
+    num_segs = len(self.logreader_identifiers)
+    if num_processes > 1:
+      with multiprocessing.Pool(num_processes) as pool:
+        parts = list(pool.imap(partial(self._run_on_segment, func), range(num_segs)))
+    else:
+      parts = [self._run_on_segment(func, i) for i in range(num_segs)]
+    return sort_columns(concatenate_columns(parts))
+
 
 if __name__ == "__main__":
   import codecs
@@ -3,6 +3,9 @@ from openpilot.tools.lib.openpilotcontainers import OpenpilotCIContainer
 def get_url(*args, **kwargs):
   return OpenpilotCIContainer.get_url(*args, **kwargs)
 
+def list_urls(*args, **kwargs):
+  return OpenpilotCIContainer.list_urls(*args, **kwargs)
+
 def upload_file(*args, **kwargs):
   return OpenpilotCIContainer.upload_file(*args, **kwargs)
 
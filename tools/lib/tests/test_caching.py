@@ -1,12 +1,19 @@
 import http.server
 import os
+import re
 import shutil
 import socket
+import tempfile
+import time
 import pytest
 
+from openpilot.common.timeout import Timeout
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.download_cache import DownloadCache, ExistenceCache
+from openpilot.tools.lib.file_sources import eval_source
+from openpilot.tools.lib.filereader import files_exist
+from openpilot.tools.lib.url_file import CHUNK_SIZE, URLFile
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -28,11 +35,49 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeTestRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = bytes(range(256)) * (CHUNK_SIZE * 5 // 256 + 7)
+  requests: list[str] = []
+
+  def do_GET(self):
+    body = self.DATA
+    if "Range" in self.headers:
+      start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", self.headers["Range"]).groups())
+      body = self.DATA[start:end + 1]
+    RangeTestRequestHandler.requests.append(self.headers.get("Range", ""))
+    self.send_response(206 if "Range" in self.headers else 200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+
+class ExistsTestRequestHandler(http.server.BaseHTTPRequestHandler):
+  EXISTING: set[str] = set()
+  requests: list[str] = []
+
+  def do_HEAD(self):
+    ExistsTestRequestHandler.requests.append(self.path)
+    self.send_response(200 if self.path in self.EXISTING else 404)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+
 @pytest.fixture
 def host():
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
     yield f"http://{host}:{port}"
 
+def wait_read_ahead():
+  with Timeout(5, "Timeout waiting for read-ahead downloads"):
+    while URLFile._inflight:
+      time.sleep(0.01)
+
+
 class TestFileDownload:
 
   def test_pipeline_defaults(self, host):
@@ -128,3 +173,122 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+  def test_concurrent_chunks(self):
+    os.environ.pop("FILEREADER_CACHE", None)
+    data = RangeTestRequestHandler.DATA
+    with http_server_context(handler=RangeTestRequestHandler) as (host, port):
+      url = f"http://{host}:{port}/test.bin"
+
+      # every missing chunk is requested once, and reads are assembled across chunk boundaries
+      RangeTestRequestHandler.requests = []
+      f = URLFile(url, cache=True)
+      f.seek(CHUNK_SIZE - 10)
+      assert f.read(2 * CHUNK_SIZE) == data[CHUNK_SIZE - 10:3 * CHUNK_SIZE - 10]
+      assert sorted(RangeTestRequestHandler.requests) == [f"bytes={i * CHUNK_SIZE}-{(i + 1) * CHUNK_SIZE - 1}" for i in range(3)]
+
+      RangeTestRequestHandler.requests = []
+      f.seek(0)
+      assert f.read() == data
+      assert len(RangeTestRequestHandler.requests) == 3
+
+      # read-ahead chunks are downloaded once and picked up by the next read
+      shutil.rmtree(Paths.download_cache_root())
+      RangeTestRequestHandler.requests = []
+      f = URLFile(url, cache=True, read_ahead=2)
+      assert f.read(10) == data[:10]
+      wait_read_ahead()
+      assert len(RangeTestRequestHandler.requests) == 3
+
+      assert f.read(3 * CHUNK_SIZE) == data[10:3 * CHUNK_SIZE + 10]
+      wait_read_ahead()
+      assert sorted(set(RangeTestRequestHandler.requests)) == sorted(RangeTestRequestHandler.requests)
+      assert len(RangeTestRequestHandler.requests) == 6
+
+      # read-ahead chunks that are never read still end up in the cache
+      assert URLFile(url, cache=True).read() == data
+      assert len(RangeTestRequestHandler.requests) == 6
+
+
+class TestDownloadCache:
+  def test_lru_eviction(self):
+    with tempfile.TemporaryDirectory() as d:
+      cache = DownloadCache(d, max_size=1000)
+      for i in range(10):
+        cache.put(f"chunk_{i}", b"a" * 150)
+        # keep the first chunk recently used
+        assert cache.get("chunk_0") is not None
+
+      assert cache.size() <= 1000
+      assert cache.get("chunk_1") is None
+      assert cache.get("chunk_9") is not None
+      assert not os.path.exists(os.path.join(d, "chunk_1"))
+
+      assert cache.stats.hits == 11
+      assert cache.stats.misses == 1
+      assert cache.stats.bytes_served == 11 * 150
+      assert cache.stats.hit_rate == 11 / 12
+
+  def test_shared_index(self):
+    with tempfile.TemporaryDirectory() as d:
+      # files from before the index existed are picked up
+      with open(os.path.join(d, "old_chunk"), "wb") as f:
+        f.write(b"1234")
+
+      cache1, cache2 = DownloadCache(d), DownloadCache(d)
+      assert cache1.get("old_chunk") == b"1234"
+      cache1.put("new_chunk", b"5678")
+      assert cache2.get("new_chunk") == b"5678"
+      assert cache2.size() == 8
+
+      os.remove(os.path.join(d, "new_chunk"))
+      assert cache1.get("new_chunk") is None
+      assert cache2.size() == 4
+
+      # overwriting an entry replaces its size
+      cache2.put("old_chunk", b"123456")
+      assert cache1.size() == 6
+
+
+class TestFileExists:
+  def test_eval_source(self):
+    with http_server_context(handler=ExistsTestRequestHandler) as (host, port):
+      # rlog.zst for even segments, rlog.bz2 for odd segments, nothing for the last
+      ExistsTestRequestHandler.EXISTING = {f"/{seg}/rlog.{'zst' if seg % 2 == 0 else 'bz2'}" for seg in range(19)}
+      ExistsTestRequestHandler.requests = []
+      files = {seg: [f"http://{host}:{port}/{seg}/rlog.zst", f"http://{host}:{port}/{seg}/rlog.bz2"] for seg in range(20)}
+      valid_files = eval_source(files)
+      assert list(valid_files) == list(range(19))
+      assert all(valid_files[seg].endswith(f"/{seg}/rlog.{'zst' if seg % 2 == 0 else 'bz2'}") for seg in range(19))
+      # fallbacks are only checked for segments without the first choice
+      assert len(ExistsTestRequestHandler.requests) == 20 + 10
+
+      # sources that list their files don't make requests
+      ExistsTestRequestHandler.requests = []
+      assert eval_source(files, available={files[3][1], files[4][0], files[4][1]}) == {3: files[3][1], 4: files[4][0]}
+      assert len(ExistsTestRequestHandler.requests) == 0
+
+  def test_persisted_results(self):
+    shutil.rmtree(Paths.download_cache_root(), ignore_errors=True)
+    with http_server_context(handler=ExistsTestRequestHandler) as (host, port):
+      ExistsTestRequestHandler.EXISTING = {"/a"}
+      ExistsTestRequestHandler.requests = []
+      urls = [f"http://{host}:{port}/a", f"http://{host}:{port}/b"]
+      assert files_exist(urls, cache=True) == {urls[0]: True, urls[1]: False}
+      assert files_exist(urls, cache=True) == {urls[0]: True, urls[1]: False}
+      assert len(ExistsTestRequestHandler.requests) == 2
+
+      # not cached, checked again
+      assert files_exist(urls, cache=False) == {urls[0]: True, urls[1]: False}
+      assert len(ExistsTestRequestHandler.requests) == 4
+
+  def test_existence_cache_ttl(self):
+    with tempfile.TemporaryDirectory() as d:
+      ExistenceCache(d).put({"http://host/found": True, "http://host/missing": False})
+      assert ExistenceCache(d).get(["http://host/found", "http://host/missing", "http://host/new"]) == {
+        "http://host/found": True,
+        "http://host/missing": False,
+      }
+      # missing files expire sooner
+      assert ExistenceCache(d, negative_ttl=0).get(["http://host/found", "http://host/missing"]) == {"http://host/found": True}
+      assert ExistenceCache(d, ttl=0, negative_ttl=0).get(["http://host/found"]) == {}
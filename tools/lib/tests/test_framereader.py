@@ -0,0 +1,108 @@
+import numpy as np
+import tempfile
+import time
+
+from openpilot.common.timeout import Timeout
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.framereader import HEVC_SLICE_I, HEVC_SLICE_P, FrameReader, GOPCache
+
+W, H = 4, 2
+GOP_LEN = 5
+NUM_FRAMES = 20
+
+
+def fake_decode(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc'):
+  # each "frame" in the fake stream is one byte holding its index
+  return np.repeat(np.frombuffer(rawdat, dtype=np.uint8), h * w * 3).reshape(-1, h, w, 3)
+
+
+def fake_index_data():
+  frame_types = [(HEVC_SLICE_I if i % GOP_LEN == 0 else HEVC_SLICE_P, i) for i in range(NUM_FRAMES)]
+  return {
+    'index': np.array(frame_types + [(0xFFFFFFFF, NUM_FRAMES)], dtype=np.uint32),
+    'global_prefix': b"",
+    'probe': {'streams': [{'width': W, 'height': H}]},
+  }
+
+
+class TestFrameReader:
+  def test_gop_cache_eviction(self):
+    cache = GOPCache(capacity=250)
+    for i in range(4):
+      cache.put(i, np.zeros(100, dtype=np.uint8))
+      assert cache.get(0) is not None
+    assert 0 in cache and 3 in cache
+    assert 1 not in cache and 2 not in cache
+    assert cache.size == 200
+
+  def test_shared_gop_decoding(self, mocker):
+    decode_mock = mocker.patch("openpilot.tools.lib.framereader.decompress_video_data", side_effect=fake_decode)
+    mocker.patch.object(framereader, "_gop_cache", GOPCache(framereader.GOP_CACHE_SIZE))
+
+    index_data = fake_index_data()
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(bytes(range(NUM_FRAMES)))
+      f.flush()
+
+      fr = FrameReader(f.name, index_data=index_data)
+      for fidx in [7, 2, 8, 19, 5, 9, 1]:
+        assert np.all(fr.get(fidx) == fidx)
+      # every GOP is decoded once, and shared with other readers of the same file
+      assert decode_mock.call_count == 3
+
+      fr2 = FrameReader(f.name, index_data=index_data)
+      assert np.all(fr2.get(12) == 12)
+      assert np.all(fr2.get(8) == 8)
+      assert decode_mock.call_count == 4
+
+      frames = list(framereader.FrameIterator(f.name, index_data=index_data, start_fidx=3, end_fidx=17, frame_skip=2))
+      assert [frm[0, 0, 0] for frm in frames] == list(range(3, 17, 2))
+
+  def test_readahead_to_cache(self, mocker):
+    decode_mock = mocker.patch("openpilot.tools.lib.framereader.decompress_video_data", side_effect=fake_decode)
+    # larger than the reservation of the iterator, as with FRAMEREADER_CACHE_SIZE
+    mocker.patch.object(framereader, "_gop_cache", GOPCache(1024 * 1024))
+
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(bytes(range(NUM_FRAMES)))
+      f.flush()
+
+      # an iterator that stops early still leaves the GOP it read ahead in the cache, not in _decoding
+      frames = framereader.FrameIterator(f.name, index_data=fake_index_data())
+      assert next(frames)[0, 0, 0] == 0
+      frames.close()
+      with Timeout(5, "Timeout waiting for read-ahead decode"):
+        while framereader._decoding:
+          time.sleep(0.01)
+      assert (f.name, "rgb24", GOP_LEN) in framereader._gop_cache
+      assert framereader._gop_cache.size == 2 * GOP_LEN * W * H * 3
+
+      fr = FrameReader(f.name, index_data=fake_index_data())
+      assert np.all(fr.get(GOP_LEN + 1) == GOP_LEN + 1)
+      assert decode_mock.call_count == 2
+
+  def test_reader_reservation(self, mocker):
+    mocker.patch("openpilot.tools.lib.framereader.decompress_video_data", side_effect=fake_decode)
+    cache = GOPCache(framereader.GOP_CACHE_SIZE)
+    mocker.patch.object(framereader, "_gop_cache", cache)
+    gop_size = GOP_LEN * W * H * 3
+
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(bytes(range(NUM_FRAMES)))
+      f.flush()
+
+      fr = FrameReader(f.name, index_data=fake_index_data(), cache_size=0)
+      assert cache.reserved == 2 * gop_size
+      for fidx in range(NUM_FRAMES):
+        frame = fr.get(fidx)
+        # frames are views into GOPs shared with other readers
+        assert not frame.flags.writeable
+      with Timeout(5, "Timeout waiting for decode"):
+        while framereader._decoding:
+          time.sleep(0.01)
+      assert cache.size == 2 * gop_size
+
+      # without readers only the newest GOP is kept
+      del fr, frame
+      assert cache.reserved == 0
+      assert cache.size == gop_size
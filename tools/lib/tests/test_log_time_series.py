@@ -0,0 +1,67 @@
+import numpy as np
+
+from cereal import log as capnp_log
+from openpilot.tools.lib.log_time_series import RaggedArray, concatenate_columns, msgs_to_columns, msgs_to_time_series, sort_columns
+
+PROJECTION = {
+  "carState": ["vEgo", "cruiseState/speed", "gearShifter"],
+  "modelV2": ["position/x", "leadsV3/prob"],
+}
+
+
+def make_msgs(num_msgs: int, ragged: bool = False):
+  msgs = []
+  for i in range(num_msgs):
+    t = (num_msgs - i) * 10_000_000
+    if i % 2:
+      evt = capnp_log.Event.new_message(logMonoTime=t, valid=bool(i % 3))
+      cs = evt.init("carState")
+      cs.vEgo = i
+      cs.cruiseState.speed = 2 * i
+      cs.gearShifter = "drive" if i % 4 == 1 else "park"
+    else:
+      evt = capnp_log.Event.new_message(logMonoTime=t)
+      model = evt.init("modelV2")
+      model.position.x = [float(i + j) for j in range(i % 3 if ragged else 33)]
+      leads = model.init("leadsV3", 2)
+      leads[0].prob, leads[1].prob = i / num_msgs, -i / num_msgs
+    msgs.append(evt.as_reader())
+  return msgs
+
+
+class TestLogTimeSeries:
+  def test_matches_time_series(self):
+    msgs = make_msgs(200)
+    ts = msgs_to_time_series(msgs)
+    cols = sort_columns(msgs_to_columns(msgs, PROJECTION))
+
+    for typ, fields in PROJECTION.items():
+      assert np.array_equal(cols[typ]["t"], ts[typ]["t"])
+      assert np.array_equal(cols[typ]["_valid"], ts[typ]["_valid"])
+      for field in fields:
+        if field != "leadsV3/prob":
+          assert np.array_equal(cols[typ][field], ts[typ][field]), field
+
+    assert cols["modelV2"]["position/x"].shape == (100, 33)
+    assert np.array_equal(cols["modelV2"]["leadsV3/prob"], [[m.modelV2.leadsV3[0].prob, m.modelV2.leadsV3[1].prob]
+                                                            for m in sorted(msgs[::2], key=lambda m: m.logMonoTime)])
+
+  def test_ragged(self):
+    msgs = make_msgs(200, ragged=True)
+    cols = sort_columns(msgs_to_columns(msgs, PROJECTION))
+    x = cols["modelV2"]["position/x"]
+    assert isinstance(x, RaggedArray)
+
+    expected = [list(m.modelV2.position.x) for m in sorted(msgs[::2], key=lambda m: m.logMonoTime)]
+    assert len(x) == len(expected)
+    assert all(np.array_equal(x[i], row) for i, row in enumerate(expected))
+
+  def test_concatenate(self):
+    msgs = make_msgs(200)
+    parts = [msgs_to_columns(msgs[:100], PROJECTION), msgs_to_columns(make_msgs(50, ragged=True), PROJECTION)]
+    cols = sort_columns(concatenate_columns(parts))
+
+    assert len(cols["carState"]["vEgo"]) == 75
+    assert isinstance(cols["modelV2"]["position/x"], RaggedArray)
+    assert len(cols["modelV2"]["position/x"]) == len(cols["modelV2"]["t"]) == 75
+    assert np.all(np.diff(cols["carState"]["t"]) >= 0)
@@ -1,19 +1,27 @@
+import bz2
 import capnp
 import contextlib
 import io
+import itertools
+import numpy as np
+import random
 import shutil
 import tempfile
 import os
 import pytest
 import requests
+import time
+import zstandard as zstd
 
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogsUnavailable, LogIterable, LogReader, parse_indirect, ReadMode
+from openpilot.tools.lib.log_index import LogIndex, log_index_key
+from openpilot.tools.lib.log_time_series import msgs_to_columns, sort_columns
+from openpilot.tools.lib.logreader import LogsUnavailable, LogIterable, LogReader, parse_indirect, ReadMode, _LogFileReader
 from openpilot.tools.lib.file_sources import comma_api_source, InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
-from openpilot.tools.lib.url_file import URLFileException
+from openpilot.tools.lib.url_file import URLFile, URLFileException
 
 NUM_SEGS = 17  # number of segments in the test route
 ALL_SEGS = list(range(NUM_SEGS))
@@ -25,6 +33,15 @@ def noop(segment: LogIterable):
   return segment
 
 
+def make_log(num_msgs: int, max_disorder: int = 0) -> bytes:
+  msgs = []
+  for i in range(num_msgs):
+    evt = capnp_log.Event.new_message(logMonoTime=i * 100 + random.randint(0, max_disorder * 100))
+    evt.init('carState' if i % 2 else 'initData')
+    msgs.append(evt.to_bytes())
+  return b"".join(msgs)
+
+
 @contextlib.contextmanager
 def setup_source_scenario(mocker, is_internal=False):
   internal_source_mock = mocker.patch("openpilot.tools.lib.logreader.internal_source")
@@ -254,3 +271,126 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("compression", ["", ".bz2", ".zst"])
+  def test_streaming(self, compression):
+    dat = make_log(1000)
+    if compression == ".bz2":
+      # multi-stream files must be read across stream boundaries
+      dat = bz2.compress(dat[:len(dat) // 2]) + bz2.compress(dat[len(dat) // 2:])
+    elif compression == ".zst":
+      dat = zstd.compress(dat)
+
+    with tempfile.NamedTemporaryFile(suffix=compression) as f:
+      f.write(dat)
+      f.flush()
+
+      msgs = [(m.logMonoTime, m.which()) for m in LogReader(f.name)]
+      streamed_msgs = [(m.logMonoTime, m.which()) for m in LogReader(f.name, streaming=True)]
+      assert len(msgs) == 1000
+      assert msgs == streamed_msgs
+
+  def test_streaming_sort_by_time(self):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(make_log(1000, max_disorder=10))
+      f.flush()
+
+      msgs = list(LogReader(f.name, sort_by_time=True))
+      streamed_msgs = list(LogReader(f.name, streaming=True, sort_by_time=True, reorder_window=25))
+      assert [m.logMonoTime for m in msgs] == [m.logMonoTime for m in streamed_msgs]
+
+  def test_streaming_truncated(self):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(make_log(100)[:-1])
+      f.flush()
+
+      with pytest.warns(RuntimeWarning, match="Corrupted events detected"):
+        msgs = list(LogReader(f.name, streaming=True))
+      assert len(msgs) == 99
+
+  def test_index(self, mocker, monkeypatch):
+    monkeypatch.setenv("FILEREADER_CACHE", "1")
+    with tempfile.NamedTemporaryFile(suffix=".zst") as f:
+      f.write(zstd.compress(make_log(1000, max_disorder=10)))
+      f.flush()
+
+      lr = LogReader(f.name)
+      num_car_states = len(list(lr.filter("carState")))
+      in_range = [m.logMonoTime for m in lr.time_range(20000, 40000, ["initData"])]
+
+      # first pass builds the index, later ones only parse the matching events
+      for _ in range(2):
+        lr = LogReader(f.name, use_index=True)
+        assert len(list(lr.filter("carState"))) == num_car_states == 500
+        assert [m.logMonoTime for m in lr.time_range(20000, 40000, ["initData"])] == in_range
+        assert lr.first("carParams") is None
+
+      # the index is a download cache entry, a truncated one is rebuilt
+      key = log_index_key(f.name)
+      URLFile.cache().put(key, URLFile.cache().get(key)[:100])
+      assert LogIndex.load(key) is None
+      assert len(list(LogReader(f.name, use_index=True).filter("carState"))) == num_car_states
+      assert LogIndex.load(key) is not None
+
+      full_read_mock = mocker.patch("openpilot.tools.lib.logreader._StreamingLogFileReader.events_with_spans")
+      lr = LogReader(f.name, use_index=True, sort_by_time=True)
+      msgs = [m.logMonoTime for m in lr.time_range(20000, 40000)]
+      assert msgs == sorted(msgs)
+      assert lr.first("initData") is not None
+      assert full_read_mock.call_count == 0
+
+  def test_prefetch(self, mocker):
+    with tempfile.TemporaryDirectory() as d:
+      fns = []
+      for i in range(5):
+        fns.append(os.path.join(d, f"rlog{i}.zst"))
+        with open(fns[-1], "wb") as f:
+          f.write(zstd.compress(make_log(200)))
+
+      msgs = [m.logMonoTime for m in LogReader(fns)]
+
+      def slow_load(fn, *args, **kwargs):
+        if fn != fns[0]:
+          time.sleep(0.2)
+        return _LogFileReader(fn, *args, **kwargs)
+
+      init_mock = mocker.patch("openpilot.tools.lib.logreader._LogFileReader", side_effect=slow_load)
+      lr = LogReader(fns, prefetch=3)
+      # the prefetches of the stopped iteration are still loading while the next one needs them
+      first = [m.logMonoTime for m in itertools.islice(lr, 10)]
+      assert first == msgs[:10]
+      assert [m.logMonoTime for m in lr] == msgs
+      assert [m.logMonoTime for m in lr] == msgs
+      assert init_mock.call_count == len(fns)
+
+  @pytest.mark.parametrize("num_processes", [1, 2])
+  def test_time_series_columns(self, num_processes):
+    with tempfile.TemporaryDirectory() as d:
+      fns = []
+      for i in range(3):
+        fns.append(os.path.join(d, f"rlog{i}.zst"))
+        with open(fns[-1], "wb") as f:
+          f.write(zstd.compress(make_log(200, max_disorder=10)))
+
+      lr = LogReader(fns)
+      ts = lr.time_series_columns({"carState": ["vEgo"]}, num_processes=num_processes)
+      expected = sort_columns(msgs_to_columns(lr, {"carState": ["vEgo"]}))
+      assert list(ts) == ["carState"]
+      assert len(ts["carState"]["t"]) == 300
+      for name in ("t", "_valid", "vEgo"):
+        assert np.array_equal(ts["carState"][name], expected["carState"][name]), name
+
+  @pytest.mark.parametrize("sort_by_time", [True, False])
+  def test_run_across_segments_shared_memory(self, sort_by_time):
+    with tempfile.TemporaryDirectory() as d:
+      fns = []
+      for i in range(3):
+        fns.append(os.path.join(d, f"rlog{i}.zst"))
+        with open(fns[-1], "wb") as f:
+          f.write(zstd.compress(make_log(200, max_disorder=10)))
+
+      lr = LogReader(fns, sort_by_time=sort_by_time)
+      msgs = lr.run_across_segments(2, noop)
+      shared_msgs = lr.run_across_segments(2, noop, shared_memory=True)
+      assert [(m.logMonoTime, m.which()) for m in msgs] == [(m.logMonoTime, m.which()) for m in shared_msgs]
+      assert len(shared_msgs) == 600
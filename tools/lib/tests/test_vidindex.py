@@ -0,0 +1,112 @@
+import tempfile
+
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.vidindex import HevcNalUnitType, get_hevc_dimensions, hevc_index
+
+HEVC_SLICE_I = 2
+HEVC_SLICE_P = 1
+
+
+class BitWriter:
+  def __init__(self):
+    self.bits: list[int] = []
+
+  def u(self, val: int, num_bits: int) -> None:
+    self.bits += [(val >> (num_bits - 1 - i)) & 1 for i in range(num_bits)]
+
+  def ue(self, val: int) -> None:
+    num_bits = (val + 1).bit_length()
+    self.u(0, num_bits - 1)
+    self.u(val + 1, num_bits)
+
+  def rbsp(self) -> bytes:
+    # rbsp_trailing_bits
+    bits = self.bits + [1]
+    bits += [0] * (-len(bits) % 8)
+    return bytes(int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+
+
+def nal_unit(nal_unit_type: HevcNalUnitType, rbsp: bytes) -> bytes:
+  # insert emulation_prevention_three_byte where the payload could look like a start code
+  dat = bytearray()
+  zeros = 0
+  for b in rbsp:
+    if zeros >= 2 and b <= 0x03:
+      dat.append(0x03)
+      zeros = 0
+    dat.append(b)
+    zeros = zeros + 1 if b == 0x00 else 0
+  return b"\x00\x00\x01" + bytes([nal_unit_type << 1, 0x01]) + bytes(dat)
+
+
+def sps(width: int, height: int, crop_bottom: int) -> bytes:
+  w = BitWriter()
+  w.u(0, 4)  # sps_video_parameter_set_id
+  w.u(0, 3)  # sps_max_sub_layers_minus1
+  w.u(1, 1)  # sps_temporal_id_nesting_flag
+  w.u(0, 96)  # profile_tier_level, all zeros to exercise emulation prevention
+  w.ue(0)  # sps_seq_parameter_set_id
+  w.ue(1)  # chroma_format_idc, 4:2:0
+  w.ue(width)
+  w.ue(height)
+  w.u(1, 1)  # conformance_window_flag
+  for offset in (0, 0, 0, crop_bottom):
+    w.ue(offset)
+  return nal_unit(HevcNalUnitType.SPS_NUT, w.rbsp())
+
+
+def slice_segment(nal_unit_type: HevcNalUnitType, slice_type: int) -> bytes:
+  w = BitWriter()
+  w.u(1, 1)  # first_slice_segment_in_pic_flag
+  if nal_unit_type >= HevcNalUnitType.BLA_W_LP:
+    w.u(0, 1)  # no_output_of_prior_pics_flag
+  w.ue(0)  # slice_pic_parameter_set_id
+  w.ue(slice_type)
+  return nal_unit(nal_unit_type, w.rbsp() + b"\xaa" * 16)
+
+
+def make_hevc() -> bytes:
+  dat = b"\x00" + nal_unit(HevcNalUnitType.VPS_NUT, b"\x0c\x01\xff") + sps(1928, 1216, 4) + nal_unit(HevcNalUnitType.PPS_NUT, b"\xc1\x73")
+  for i in range(6):
+    if i % 3 == 0:
+      dat += slice_segment(HevcNalUnitType.IDR_W_RADL, HEVC_SLICE_I)
+    else:
+      dat += slice_segment(HevcNalUnitType.TRAIL_R, HEVC_SLICE_P)
+  return dat
+
+
+class TestVidIndex:
+  def test_sps_dimensions(self):
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(make_hevc())
+      f.flush()
+
+      frame_types, dat_len, prefix = hevc_index(f.name)
+      assert [t for t, _ in frame_types] == [HEVC_SLICE_I, HEVC_SLICE_P, HEVC_SLICE_P] * 2
+      assert dat_len == len(make_hevc())
+      # 4 chroma rows cropped at the bottom
+      assert get_hevc_dimensions(prefix) == (1928, 1208)
+
+  def test_cached_video_index(self, mocker, monkeypatch):
+    monkeypatch.setenv("FILEREADER_CACHE", "1")
+    spy = mocker.spy(framereader, "hevc_index")
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(make_hevc())
+      f.flush()
+
+      index_data = framereader.get_video_index(f.name)
+      assert spy.call_count == 1
+      assert index_data['probe']['streams'][0]['width'] == 1928
+      assert index_data['probe']['streams'][0]['height'] == 1208
+
+      cached = framereader.get_video_index(f.name)
+      assert spy.call_count == 1
+      assert (cached['index'] == index_data['index']).all()
+      assert cached['global_prefix'] == index_data['global_prefix']
+      assert cached['probe'] == index_data['probe']
+
+      # modifying the file invalidates the cached index
+      f.write(slice_segment(HevcNalUnitType.TRAIL_R, HEVC_SLICE_P))
+      f.flush()
+      assert len(framereader.get_video_index(f.name)['index']) == len(index_data['index']) + 1
+      assert spy.call_count == 2
@@ -1,36 +1,59 @@
 import logging
 import os
 import socket
+import threading
 import time
-from hashlib import sha256
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
 from urllib3.util import Timeout
 
-from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.download_cache import DownloadCache, hash_256
 
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+#  Max concurrent range requests for missing chunks, across all files
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("FILEREADER_CONCURRENCY", "8"))
+#  Max read-ahead chunks downloading or queued, across all files
+MAX_READ_AHEAD_CHUNKS = 2 * MAX_CONCURRENT_REQUESTS
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
-def hash_256(link: str) -> str:
-  return sha256((link.split("?")[0]).encode('utf-8')).hexdigest()
-
-
 class URLFileException(Exception):
   pass
 
 
 class URLFile:
   _pool_manager: PoolManager | None = None
+  _cache: DownloadCache | None = None
+  _executor: ThreadPoolExecutor | None = None
+  # read-ahead downloads by chunk key, until they are written to the cache
+  _inflight: dict[str, Future[bytes]] = {}
+  _inflight_lock = threading.Lock()
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    URLFile._cache = None
+    URLFile._executor = None
+    URLFile._inflight = {}
+    URLFile._inflight_lock = threading.Lock()
+
+  @staticmethod
+  def executor() -> ThreadPoolExecutor:
+    if URLFile._executor is None:
+      URLFile._executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix="urlfile")
+    return URLFile._executor
+
+  @staticmethod
+  def cache() -> DownloadCache:
+    # the cache root can change or be removed between reads, e.g. by OpenpilotPrefix
+    if URLFile._cache is None or URLFile._cache.root != Paths.download_cache_root() or not os.path.exists(URLFile._cache.index_path):
+      URLFile._cache = DownloadCache()
+    return URLFile._cache
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -40,7 +63,7 @@ class URLFile:
       URLFile._pool_manager = PoolManager(num_pools=10, maxsize=100, socket_options=socket_options, retries=retries)
     return URLFile._pool_manager
 
-  def __init__(self, url: str, timeout: int = 10, debug: bool = False, cache: bool | None = None):
+  def __init__(self, url: str, timeout: int = 10, debug: bool = False, cache: bool | None = None, read_ahead: int = 0):
     self._url = url
     self._timeout = Timeout(connect=timeout, read=timeout)
     self._pos = 0
@@ -50,9 +73,8 @@ class URLFile:
     self._force_download = not int(os.environ.get("FILEREADER_CACHE", "0"))
     if cache is not None:
       self._force_download = not cache
-
-    if not self._force_download:
-      os.makedirs(Paths.download_cache_root(), exist_ok=True)
+    #  Number of chunks after each cached read to start downloading in the background
+    self._read_ahead = read_ahead
 
   def __enter__(self):
     return self
@@ -74,50 +96,93 @@ class URLFile:
     if self._length is not None:
       return self._length
 
-    file_length_path = os.path.join(Paths.download_cache_root(), hash_256(self._url) + "_length")
-    if not self._force_download and os.path.exists(file_length_path):
-      with open(file_length_path) as file_length:
-        content = file_length.read()
-        self._length = int(content)
-        return self._length
+    if self._force_download:
+      self._length = self.get_length_online()
+      return self._length
+
+    cache = URLFile.cache()
+    length_key = hash_256(self._url) + "_length"
+    if (content := cache.get(length_key)) is not None:
+      self._length = int(content)
+      return self._length
 
     self._length = self.get_length_online()
-    if not self._force_download and self._length != -1:
-      with atomic_write_in_dir(file_length_path, mode="w", overwrite=True) as file_length:
-        file_length.write(str(self._length))
+    if self._length != -1:
+      cache.put(length_key, str(self._length).encode())
     return self._length
 
+  def _chunk_key(self, chunk_idx: int) -> str:
+    return hash_256(self._url) + "_" + str(float(chunk_idx))
+
+  def _fetch_chunk(self, chunk_idx: int) -> Future[bytes]:
+    start = chunk_idx * CHUNK_SIZE
+    end = min(start + CHUNK_SIZE, self.get_length()) - 1
+    return URLFile.executor().submit(self._get, {'Range': f"bytes={start}-{end}"}, True)
+
+  def _start_read_ahead(self, cache: DownloadCache, first_chunk: int, last_chunk: int) -> None:
+    for chunk_idx in range(first_chunk, last_chunk):
+      key = self._chunk_key(chunk_idx)
+      if key in cache:
+        continue
+      with URLFile._inflight_lock:
+        if key in URLFile._inflight or len(URLFile._inflight) >= MAX_READ_AHEAD_CHUNKS:
+          continue
+        future = URLFile._inflight[key] = self._fetch_chunk(chunk_idx)
+
+      # the chunk goes to the cache whether or not it's read, and is only kept in memory until then
+      def done(future: Future[bytes], key: str = key) -> None:
+        try:
+          if future.exception() is None:
+            cache.put(key, future.result())
+        finally:
+          with URLFile._inflight_lock:
+            if URLFile._inflight.get(key) is future:
+              del URLFile._inflight[key]
+      future.add_done_callback(done)
+
   def read(self, ll: int | None = None) -> bytes:
     if self._force_download:
       return self.read_aux(ll=ll)
 
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
+    length = self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
+    file_end = min(self._pos + ll, length) if ll is not None else length
+    if file_begin >= file_end:
+      return b""
+
+    #  We have to align with chunks we store, the first chunk starts before or at our position
+    cache = URLFile.cache()
+    first_chunk, last_chunk = file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE
+    chunks: dict[int, bytes] = {}
+    missing: dict[int, Future[bytes]] = {}
+    read_ahead: dict[int, Future[bytes]] = {}
+    for chunk_idx in range(first_chunk, last_chunk + 1):
+      data = cache.get(self._chunk_key(chunk_idx))
+      if data is not None:
+        chunks[chunk_idx] = data
+        continue
+      # chunks requested by an earlier read-ahead are picked up instead of downloaded again
+      with URLFile._inflight_lock:
+        future = URLFile._inflight.get(self._chunk_key(chunk_idx))
+      if future is not None:
+        read_ahead[chunk_idx] = future
       else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+        missing[chunk_idx] = self._fetch_chunk(chunk_idx)
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+    num_chunks = (length + CHUNK_SIZE - 1) // CHUNK_SIZE
+    self._start_read_ahead(cache, last_chunk + 1, min(last_chunk + 1 + self._read_ahead, num_chunks))
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    #  Downloads run concurrently, only the cache writes happen here. Read-ahead chunks are written by their callback
+    for chunk_idx, future in read_ahead.items():
+      chunks[chunk_idx] = future.result()
+    for chunk_idx, future in missing.items():
+      chunks[chunk_idx] = future.result()
+      cache.put(self._chunk_key(chunk_idx), chunks[chunk_idx])
+
+    self._pos = file_end
+    return b"".join(memoryview(chunks[chunk_idx])[max(0, file_begin - chunk_idx * CHUNK_SIZE):file_end - chunk_idx * CHUNK_SIZE]
+                    for chunk_idx in range(first_chunk, last_chunk + 1))
 
   def read_aux(self, ll: int | None = None) -> bytes:
     download_range = False
@@ -127,11 +192,16 @@ class URLFile:
         end = self.get_length() - 1
       else:
         end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+      if self._pos > end:
         return b""
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
 
+    ret = self._get(headers, download_range)
+    self._pos += len(ret)
+    return ret
+
+  def _get(self, headers: dict[str, str], download_range: bool) -> bytes:
     if self._debug:
       t1 = time.monotonic()
 
@@ -150,8 +220,6 @@ class URLFile:
       raise URLFileException(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
     if (not download_range) and response_code != 200:  # OK
       raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
-
-    self._pos += len(ret)
     return ret
 
   def seek(self, pos: int) -> None:
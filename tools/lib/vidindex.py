@@ -147,6 +147,29 @@ def get_ue(dat: bytes, start_idx: int, skip_bits: int) -> tuple[int, int]:
 
   raise VideoFileInvalid("invalid exponential-golomb code")
 
+def get_u(dat: bytes, start_idx: int, skip_bits: int, num_bits: int) -> int:
+  val = 0
+  for bit in range(skip_bits, skip_bits + num_bits):
+    i = start_idx + bit // 8
+    if i >= len(dat):
+      raise VideoFileInvalid("unexpected end of data")
+    val = (val << 1) | ((dat[i] >> (7 - bit % 8)) & 1)
+  return val
+
+def remove_emulation_prevention(dat: bytes) -> bytes:
+  # 7.4.2 NAL unit semantics
+  # emulation_prevention_three_byte is a byte equal to 0x03. When an emulation_prevention_three_byte is present in the NAL unit,
+  # it shall be discarded by the decoding process.
+  rbsp = bytearray()
+  zeros = 0
+  for b in dat:
+    if zeros >= 2 and b == 0x03:
+      zeros = 0
+      continue
+    rbsp.append(b)
+    zeros = zeros + 1 if b == 0x00 else 0
+  return bytes(rbsp)
+
 def require_nal_unit_start(dat: bytes, nal_unit_start: int) -> None:
   if nal_unit_start < 1:
     raise ValueError("start index must be greater than zero")
@@ -258,6 +281,85 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
+def get_hevc_sps_dimensions(dat: bytes, nal_unit_start: int, nal_unit_len: int) -> tuple[int, int]:
+  # 7.3.2.2.1 General sequence parameter set RBSP syntax
+  # seq_parameter_set_rbsp( ) {                                           // descriptor
+  #   sps_video_parameter_set_id                                          u(4)
+  #   sps_max_sub_layers_minus1                                           u(3)
+  #   sps_temporal_id_nesting_flag                                        u(1)
+  #   profile_tier_level( 1, sps_max_sub_layers_minus1 )
+  #   sps_seq_parameter_set_id                                           ue(v)
+  #   chroma_format_idc                                                  ue(v)
+  #   if( chroma_format_idc = = 3 )
+  #     separate_colour_plane_flag                                        u(1)
+  #   pic_width_in_luma_samples                                          ue(v)
+  #   pic_height_in_luma_samples                                         ue(v)
+  #   conformance_window_flag                                             u(1)
+  #   if( conformance_window_flag ) {
+  #     conf_win_left_offset                                             ue(v)
+  #     conf_win_right_offset                                            ue(v)
+  #     conf_win_top_offset                                              ue(v)
+  #     conf_win_bottom_offset                                           ue(v)
+  #   }
+  # ...
+  rbsp = remove_emulation_prevention(dat[nal_unit_start + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE:nal_unit_start + nal_unit_len])
+
+  max_sub_layers_minus1 = get_u(rbsp, 0, 4, 3)
+  skip_bits = 8
+
+  # 7.3.3 Profile, tier and level syntax
+  # 96 bits of general profile, tier and level, then per sub-layer present flags, padding and profile/level
+  skip_bits += 96
+  sub_layer_flags = [(get_u(rbsp, 0, skip_bits + 2 * i, 1), get_u(rbsp, 0, skip_bits + 2 * i + 1, 1)) for i in range(max_sub_layers_minus1)]
+  skip_bits += 2 * max_sub_layers_minus1
+  if max_sub_layers_minus1 > 0:
+    skip_bits += 2 * (8 - max_sub_layers_minus1)
+  for profile_present, level_present in sub_layer_flags:
+    skip_bits += 88 * profile_present + 8 * level_present
+
+  _, size = get_ue(rbsp, 0, skip_bits)
+  skip_bits += size # skip past sps_seq_parameter_set_id
+  chroma_format_idc, size = get_ue(rbsp, 0, skip_bits)
+  skip_bits += size
+  separate_colour_plane = False
+  if chroma_format_idc == 3:
+    separate_colour_plane = get_u(rbsp, 0, skip_bits, 1) == 1
+    skip_bits += 1
+
+  width, size = get_ue(rbsp, 0, skip_bits)
+  skip_bits += size
+  height, size = get_ue(rbsp, 0, skip_bits)
+  skip_bits += size
+
+  # 7.4.3.2.1 General sequence parameter set RBSP semantics
+  # the conformance cropping window is given in chroma samples, Table 6-1 gives SubWidthC and SubHeightC
+  if get_u(rbsp, 0, skip_bits, 1):
+    skip_bits += 1
+    offsets = []
+    for _ in range(4):
+      offset, size = get_ue(rbsp, 0, skip_bits)
+      skip_bits += size
+      offsets.append(offset)
+    sub_width_c, sub_height_c = {1: (2, 2), 2: (2, 1)}.get(chroma_format_idc, (1, 1))
+    if separate_colour_plane:
+      sub_width_c, sub_height_c = 1, 1
+    width -= sub_width_c * (offsets[0] + offsets[1])
+    height -= sub_height_c * (offsets[2] + offsets[3])
+
+  if DEBUG:
+    print("  sps dimensions:", width, height)
+  return width, height
+
+def get_hevc_dimensions(prefix_dat: bytes) -> tuple[int, int]:
+  """Width and height of the pictures from the SPS in the parameter set prefix returned by hevc_index"""
+  i = prefix_dat.find(NAL_UNIT_START_CODE)
+  while i != -1:
+    nal_unit_len = get_hevc_nal_unit_length(prefix_dat, i)
+    if get_hevc_nal_unit_type(prefix_dat, i) == HevcNalUnitType.SPS_NUT:
+      return get_hevc_sps_dimensions(prefix_dat, i, nal_unit_len)
+    i = prefix_dat.find(NAL_UNIT_START_CODE, i + nal_unit_len)
+  raise VideoFileInvalid("no SPS found")
+
 def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
   with FileReader(hevc_file_name) as f:
     dat = f.read()